@@ -3,6 +3,7 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime
+from typing import Dict, Any
 import sys
 import os
 from pathlib import Path
@@ -35,7 +36,8 @@ except Exception as e:
 # Estos deberían funcionar siempre
 from app.components.data_processor import DataProcessor
 from app.components.visualizer import KeywordVisualizer
-from app.utils.helpers import export_to_excel, calculate_metrics
+from app.utils.helpers import export_to_excel, calculate_metrics, dataframe_to_csv_bytes
+from app.utils import fast_json
 
 # Logo (opcional)
 LOGO_URL = None
@@ -308,6 +310,79 @@ def reset_multi_analyses():
     st.session_state.current_dataset_hash = None
 
 
+def get_file_preview(uploaded_file, rows: int = 10) -> Dict[str, Any]:
+    """
+    Preview de un archivo subido (primeras filas, nº de filas y columnas)
+    
+    Se calcula una vez por archivo y se guarda en session_state, así los
+    reruns no vuelven a parsear el archivo completo ni a enviar más filas
+    de las que se muestran.
+    """
+    previews = st.session_state.setdefault('file_previews', {})
+    file_key = getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+    
+    if file_key not in previews:
+        if uploaded_file.name.endswith('.csv'):
+            df = pd.read_csv(uploaded_file)
+        else:
+            df = pd.read_excel(uploaded_file)
+        uploaded_file.seek(0)
+        
+        previews[file_key] = {
+            'head': df.head(rows),
+            'total_rows': len(df),
+            'columns': [str(col) for col in df.columns]
+        }
+    
+    return previews[file_key]
+
+
+def get_topics_summary(result: Dict) -> Dict[str, Any]:
+    """
+    Resumen de los topics de un universo (totales y distribución por tier)
+    
+    Se guarda en session_state junto al universo del que procede, así que
+    solo se recalcula cuando cambia el análisis y no en cada rerun.
+    """
+    cached = st.session_state.get('topics_summary')
+    if cached is not None and cached['source'] is result:
+        return cached['summary']
+    
+    topics_df = pd.DataFrame(result['topics'])
+    summary = {
+        'total_topics': len(topics_df),
+        'total_keywords': int(topics_df['keyword_count'].sum()),
+        'total_volume': float(topics_df['volume'].sum()),
+        'tier_distribution': topics_df.groupby('tier').size().to_dict()
+    }
+    
+    st.session_state.topics_summary = {'source': result, 'summary': summary}
+    return summary
+
+
+def get_topic_figures(result: Dict) -> Dict[str, go.Figure]:
+    """
+    Gráficos de la pestaña de visualización para un universo
+    
+    Igual que get_topics_summary, se guardan en session_state junto al
+    universo y solo se reconstruyen cuando cambia el análisis.
+    """
+    cached = st.session_state.get('topic_figures')
+    if cached is not None and cached['source'] is result:
+        return cached['figures']
+    
+    visualizer = KeywordVisualizer()
+    topics_df = pd.DataFrame(result['topics'])
+    figures = {
+        'bubble': visualizer.create_bubble_chart(topics_df),
+        'treemap': visualizer.create_treemap(topics_df),
+        'sunburst': visualizer.create_sunburst(topics_df)
+    }
+    
+    st.session_state.topic_figures = {'source': result, 'figures': figures}
+    return figures
+
+
 def display_logo():
     """Muestra el logo con sistema de fallback en cascada"""
     if LOGO_URL:
@@ -346,6 +421,9 @@ def display_logo():
 
 
 def main():
+    # Fecha para los nombres de archivo de descarga (una vez por ejecución)
+    export_date = datetime.now().strftime('%Y%m%d')
+    
     # Mostrar errores de importación si los hay (AHORA sí podemos usar st.error)
     if IMPORT_ERRORS:
         st.error("⚠️ Algunos servicios no están disponibles:")
@@ -700,13 +778,10 @@ Parámetros: {analysis['parameters'].get('analysis_type', 'N/A')} | Tiers: {anal
                 for file in uploaded_files:
                     with st.expander(f"👁️ Preview: {file.name}"):
                         try:
-                            if file.name.endswith('.csv'):
-                                df = pd.read_csv(file)
-                            else:
-                                df = pd.read_excel(file)
+                            preview = get_file_preview(file)
                             
-                            st.dataframe(df.head(10), use_container_width=True)
-                            st.caption(f"Total rows: {len(df)} | Columns: {', '.join(df.columns)}")
+                            st.dataframe(preview['head'], use_container_width=True)
+                            st.caption(f"Total rows: {preview['total_rows']} | Columns: {', '.join(preview['columns'])}")
                         except Exception as e:
                             st.error(f"Error al leer el archivo: {str(e)}")
         
@@ -779,22 +854,30 @@ Parámetros: {analysis['parameters'].get('analysis_type', 'N/A')} | Tiers: {anal
                 if st.button("🔍 Obtener Keywords de Semrush", type="primary", use_container_width=True):
                     if targets_input:
                         targets_list = []
+                        seen_targets = set()
                         
-                        if target_type == 'mixed':
-                            for line in targets_input.split('\n'):
-                                line = line.strip()
-                                if '|' in line:
-                                    tipo, valor = line.split('|', 1)
-                                    tipo = tipo.strip().lower()
-                                    valor = valor.strip()
-                                    
-                                    if tipo in ['domain', 'url', 'directory'] and valor:
-                                        targets_list.append({'target': valor, 'type': tipo})
-                        else:
-                            for line in targets_input.split('\n'):
-                                line = line.strip()
-                                if line:
-                                    targets_list.append({'target': line, 'type': target_type})
+                        # Una entrada por línea; los duplicados se descartan para
+                        # no pedir (y pagar) el mismo target dos veces a Semrush
+                        for line in targets_input.splitlines():
+                            line = line.strip()
+                            
+                            if target_type == 'mixed':
+                                if '|' not in line:
+                                    continue
+                                tipo, valor = line.split('|', 1)
+                                tipo = tipo.strip().lower()
+                                valor = valor.strip()
+                                
+                                if tipo not in ['domain', 'url', 'directory'] or not valor:
+                                    continue
+                            elif line:
+                                tipo, valor = target_type, line
+                            else:
+                                continue
+                            
+                            if (tipo, valor) not in seen_targets:
+                                seen_targets.add((tipo, valor))
+                                targets_list.append({'target': valor, 'type': tipo})
                         
                         if not targets_list:
                             st.error("❌ No se encontraron targets válidos")
@@ -1034,15 +1117,23 @@ Quedará guardado en caché para futuras consultas.
                             
                             prompt = anthropic_service.create_universe_prompt(df, **analysis_params)
                             
+                            stream_status = st.empty()
                             result = anthropic_service.analyze_keywords(
                                 prompt,
                                 df,
+                                on_progress=lambda chars: stream_status.caption(
+                                    f"📡 Recibiendo respuesta de Claude... {chars:,} caracteres"
+                                ),
                                 use_cache=cache_enabled,
                                 **analysis_params
                             )
+                            stream_status.empty()
                             result['provider'] = 'Claude'
                             result['model'] = model_choice
                             
+                            if result.get('truncated'):
+                                st.warning("⚠️ La respuesta de Claude se cortó por el límite de tokens. Se muestran solo los topics completos.")
+                            
                         elif ai_provider == "OpenAI":
                             from app.services.openai_service import OpenAIService
                             
@@ -1050,21 +1141,34 @@ Quedará guardado en caché para futuras consultas.
                             
                             messages = openai_service.create_universe_prompt(df, **analysis_params)
                             
+                            stream_status = st.empty()
+                            received_topics = []
                             result = openai_service.analyze_keywords(
                                 messages,
                                 df,
+                                on_progress=lambda chars: stream_status.caption(
+                                    f"📡 Recibiendo respuesta de OpenAI... {chars:,} caracteres "
+                                    f"· {len(received_topics)} topics"
+                                ),
                                 use_cache=cache_enabled,
+                                on_topic=received_topics.append,
                                 **analysis_params
                             )
+                            stream_status.empty()
                             result['provider'] = 'OpenAI'
                             result['model'] = model_choice
                             
+                            if result.get('truncated'):
+                                st.warning("⚠️ La respuesta de OpenAI se cortó por el límite de tokens. Se muestran solo los topics completos.")
+                            
                         else:
                             from app.services.openai_service import OpenAIService
                             
-                            st.info("1️⃣ Analizando con Claude...")
+                            # Validar ambos servicios antes de lanzar el primer análisis
                             anthropic_service = AnthropicService(anthropic_key, claude_model)
+                            openai_service = OpenAIService(openai_key, openai_model)
                             
+                            st.info("1️⃣ Analizando con Claude...")
                             prompt_claude = anthropic_service.create_universe_prompt(df, **analysis_params)
                             result_claude = anthropic_service.analyze_keywords(
                                 prompt_claude,
@@ -1073,20 +1177,18 @@ Quedará guardado en caché para futuras consultas.
                                 **analysis_params
                             )
                             
-                            st.info("2️⃣ Analizando con OpenAI...")
-                            openai_service = OpenAIService(openai_key, openai_model)
-                            
+                            # La comparación solo depende del resultado de Claude:
+                            # se lanza a la vez que el análisis de OpenAI
+                            st.info("2️⃣ Analizando con OpenAI y comparando resultados...")
                             messages_openai = openai_service.create_universe_prompt(df, **analysis_params)
-                            result_openai = openai_service.analyze_keywords(
+                            result_openai, comparison = openai_service.analyze_and_compare(
                                 messages_openai,
                                 df,
+                                result_claude,
                                 use_cache=cache_enabled,
                                 **analysis_params
                             )
                             
-                            st.info("3️⃣ Comparando resultados...")
-                            comparison = openai_service.compare_with_claude(result_claude, df)
-                            
                             result = {
                                 'summary': f"**Análisis de Claude:**\n{result_claude.get('summary', '')}\n\n**Análisis de OpenAI:**\n{result_openai.get('summary', '')}",
                                 'topics': result_claude.get('topics', []),
@@ -1284,24 +1386,20 @@ Quedará guardado en caché para futuras consultas.
         result = st.session_state.keyword_universe
         
         if 'topics' in result:
-            visualizer = KeywordVisualizer()
-            topics_df = pd.DataFrame(result['topics'])
+            figures = get_topic_figures(result)
             
             st.subheader("🫧 Mapa de Topics (Bubble Chart)")
-            fig_bubble = visualizer.create_bubble_chart(topics_df)
-            st.plotly_chart(fig_bubble, use_container_width=True)
+            st.plotly_chart(figures['bubble'], use_container_width=True, key="topics_bubble_chart")
             
             col1, col2 = st.columns(2)
             
             with col1:
                 st.subheader("🗺️ Treemap por Volumen")
-                fig_treemap = visualizer.create_treemap(topics_df)
-                st.plotly_chart(fig_treemap, use_container_width=True)
+                st.plotly_chart(figures['treemap'], use_container_width=True, key="topics_treemap")
             
             with col2:
                 st.subheader("☀️ Distribución por Tier")
-                fig_sunburst = visualizer.create_sunburst(topics_df)
-                st.plotly_chart(fig_sunburst, use_container_width=True)
+                st.plotly_chart(figures['sunburst'], use_container_width=True, key="topics_sunburst")
             
             if 'gaps' in result:
                 st.divider()
@@ -1363,12 +1461,21 @@ Quedará guardado en caché para futuras consultas.
                         openai_model=openai_model
                     )
                     
+                    stream_status = st.empty()
+                    received_chars = [0]
+                    
+                    def show_architecture_progress(text: str) -> None:
+                        received_chars[0] += len(text)
+                        stream_status.caption(f"📡 Recibiendo arquitectura... {received_chars[0]:,} caracteres")
+                    
                     architecture = arch_service.generate_architecture(
                         analysis_results=st.session_state.keyword_universe,
                         df=st.session_state.processed_data,
                         provider=arch_provider,
-                        custom_instructions=custom_arch_instructions
+                        custom_instructions=custom_arch_instructions,
+                        on_token=show_architecture_progress
                     )
+                    stream_status.empty()
                     
                     st.session_state.architecture = architecture
                     
@@ -1627,11 +1734,11 @@ Quedará guardado en caché para futuras consultas.
                 col1, col2 = st.columns([3, 1])
                 
                 with col2:
-                    csv_opps = priority_df.to_csv(index=False)
+                    csv_opps = dataframe_to_csv_bytes(priority_df)
                     st.download_button(
                         "📥 Exportar Oportunidades",
                         data=csv_opps,
-                        file_name=f"oportunidades_{datetime.now().strftime('%Y%m%d')}.csv",
+                        file_name=f"oportunidades_{export_date}.csv",
                         mime="text/csv",
                         type="primary"
                     )
@@ -1668,25 +1775,24 @@ Quedará guardado en caché para futuras consultas.
                             st.download_button(
                                 "⬇️ Descargar Excel",
                                 data=file_data,
-                                file_name=f"keyword_universe_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                                file_name=f"keyword_universe_{export_date}.xlsx",
                                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                             )
                         elif export_format == "CSV":
                             topics_df = pd.DataFrame(st.session_state.keyword_universe['topics'])
-                            csv_data = topics_df.to_csv(index=False)
+                            csv_data = dataframe_to_csv_bytes(topics_df)
                             st.download_button(
                                 "⬇️ Descargar CSV",
                                 data=csv_data,
-                                file_name=f"keyword_universe_{datetime.now().strftime('%Y%m%d')}.csv",
+                                file_name=f"keyword_universe_{export_date}.csv",
                                 mime="text/csv"
                             )
                         else:
-                            import json
-                            json_data = json.dumps(st.session_state.keyword_universe, indent=2)
+                            json_data = fast_json.dumps(st.session_state.keyword_universe)
                             st.download_button(
                                 "⬇️ Descargar JSON",
                                 data=json_data,
-                                file_name=f"keyword_universe_{datetime.now().strftime('%Y%m%d')}.json",
+                                file_name=f"keyword_universe_{export_date}.json",
                                 mime="application/json"
                             )
                         
@@ -1700,17 +1806,16 @@ Quedará guardado en caché para futuras consultas.
             result = st.session_state.keyword_universe
             
             if 'topics' in result:
-                topics_df = pd.DataFrame(result['topics'])
+                topics_summary = get_topics_summary(result)
                 
-                st.metric("Total Topics", len(topics_df))
-                st.metric("Keywords Analizadas", topics_df['keyword_count'].sum())
-                st.metric("Volumen Total", f"{topics_df['volume'].sum():,.0f}")
+                st.metric("Total Topics", topics_summary['total_topics'])
+                st.metric("Keywords Analizadas", topics_summary['total_keywords'])
+                st.metric("Volumen Total", f"{topics_summary['total_volume']:,.0f}")
                 
                 st.divider()
                 
                 st.caption("Distribución por Tier:")
-                tier_dist = topics_df.groupby('tier').size()
-                for tier, count in tier_dist.items():
+                for tier, count in topics_summary['tier_distribution'].items():
                     st.text(f"Tier {tier}: {count} topics")
         
         if st.session_state.architecture:
@@ -1726,12 +1831,11 @@ Quedará guardado en caché para futuras consultas.
             if st.button("💾 Exportar Arquitectura", key="export_arch"):
                 try:
                     if arch_format == "JSON":
-                        import json
-                        json_data = json.dumps(st.session_state.architecture, indent=2, ensure_ascii=False)
+                        json_data = fast_json.dumps(st.session_state.architecture, indent=True)
                         st.download_button(
                             "⬇️ Descargar Arquitectura JSON",
                             data=json_data,
-                            file_name=f"web_architecture_{datetime.now().strftime('%Y%m%d')}.json",
+                            file_name=f"web_architecture_{export_date}.json",
                             mime="application/json"
                         )
                     elif arch_format == "Excel":
@@ -1762,7 +1866,7 @@ Quedará guardado en caché para futuras consultas.
                         st.download_button(
                             "⬇️ Descargar Arquitectura Excel",
                             data=output.getvalue(),
-                            file_name=f"web_architecture_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                            file_name=f"web_architecture_{export_date}.xlsx",
                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                         )
                     else:
@@ -1771,7 +1875,7 @@ Quedará guardado en caché para futuras consultas.
                         st.download_button(
                             "⬇️ Descargar Mapa del Sitio",
                             data=sitemap,
-                            file_name=f"sitemap_{datetime.now().strftime('%Y%m%d')}.txt",
+                            file_name=f"sitemap_{export_date}.txt",
                             mime="text/plain"
                         )
                     
@@ -1,6 +1,35 @@
 """
 Servicios de integración con APIs externas
+
+Los servicios se cargan de forma lazy (PEP 562): importar el paquete no
+importa los SDK de Anthropic/OpenAI ni BeautifulSoup hasta que se accede a
+la clase correspondiente. Esto también evita importaciones circulares.
 """
 
-# Archivo vacío - los imports se hacen directamente en main.py
-# para evitar problemas de importación circular
+from importlib import import_module
+
+# Nombre público -> módulo que lo define
+_LAZY_SERVICES = {
+    'AnthropicService': 'app.services.anthropic_service',
+    'OpenAIService': 'app.services.openai_service',
+    'SemrushService': 'app.services.semrush_service',
+    'ArchitectureService': 'app.services.architecture_service',
+    'URLAnalyzerService': 'app.services.url_analyzer_service',
+}
+
+__all__ = list(_LAZY_SERVICES)
+
+
+def __getattr__(name):
+    """Importa el servicio solicitado en el primer acceso"""
+    module_name = _LAZY_SERVICES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    service = getattr(import_module(module_name), name)
+    globals()[name] = service
+    return service
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
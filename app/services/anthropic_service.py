@@ -1,11 +1,184 @@
 import anthropic
+import asyncio
+import atexit
+import copy
+import functools
+import hashlib
+import importlib.util
 import pandas as pd
+import numpy as np
 import json
-from typing import Dict, List, Any, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Callable, Union, Set
+
+from app.utils import fast_json
+from app.utils.helpers import (
+    cached_top_volume_positions,
+    top_volume_csv,
+    collapse_keyword_variants,
+    dataframe_fingerprint,
+    decode_json_block,
+    extract_json_block,
+    get_safe_columns,
+    summarize_keyword_stats,
+    extract_json_value,
+    extract_partial_array,
+    filter_by_keyword_index,
+    keyword_index
+)
+
+# Reintentos del SDK ante 408/409/429/5xx y errores de conexión, con backoff
+# exponencial y jitter: un error transitorio no tira una llamada de 20 s
+MAX_RETRIES = 5
+
+# HTTP/2 solo si el paquete opcional h2 está instalado (pip install httpx[http2])
+_HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+@functools.lru_cache(maxsize=1)
+def _get_http_client():
+    """
+    Devuelve el cliente HTTP del proceso, compartido por todos los clientes
+    
+    Un único pool de conexiones keep-alive (HTTP/2 si está disponible) para
+    todas las API keys: las peticiones concurrentes, como los detalles de
+    varios topics, se multiplexan sobre la misma conexión TLS.
+    """
+    http_client = anthropic.DefaultHttpxClient(http2=_HTTP2_AVAILABLE)
+    atexit.register(http_client.close)
+    return http_client
+
+
+@functools.lru_cache(maxsize=4)
+def _get_anthropic_client(api_key: str) -> anthropic.Anthropic:
+    """
+    Devuelve un cliente de Anthropic compartido por API key
+    
+    Reutilizar el cliente (y su pool de conexiones keep-alive) evita
+    repetir el handshake TLS cada vez que se crea un AnthropicService en
+    un rerun de Streamlit.
+    """
+    return anthropic.Anthropic(api_key=api_key, max_retries=MAX_RETRIES, http_client=_get_http_client())
+
+
+# Caché LRU de prompts: construir el prompt (top 1000 + JSON) es determinista
+# para unos mismos datos y opciones, así que se reutiliza entre re-análisis
+_PROMPT_CACHE_SIZE = 8
+_prompt_cache: "OrderedDict[tuple, List[Dict[str, Any]]]" = OrderedDict()
+_prompt_cache_lock = threading.Lock()
+
+# Caché de respuestas de Claude: una huella del modelo y el prompt completo
+# (que ya incluye stats, keywords y opciones) -> respuesta parseada. Evita
+# repetir la llamada al re-analizar el mismo dataset con las mismas opciones
+RESPONSE_CACHE_TTL_SECONDS = 24 * 3600
+_RESPONSE_CACHE_SIZE = 32
+_response_cache: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+# Marca de prompt caching de Anthropic: el prefijo hasta este bloque se
+# cachea en el servidor y se factura a ~10% en las siguientes llamadas
+_EPHEMERAL_CACHE = {"type": "ephemeral"}
+
+# Plantillas del prompt de universo, construidas una sola vez al cargar el módulo.
+# Los datos (stats + keywords) van primero para que su bloque, el más grande,
+# se reutilice desde la caché de Anthropic al repetir el análisis con otro
+# tipo de agrupación, tiers u opciones sobre el mismo dataset.
+_UNIVERSE_SYSTEM_PROMPT = 'Eres un experto en SEO y análisis de keywords. Tu tarea es crear un "Keyword Universe" completo y estratégico.'
+
+_UNIVERSE_DATA_TEMPLATE = """# DATOS PROPORCIONADOS
+- Total de keywords: {total_keywords:,}
+- Volumen total de búsqueda: {total_volume:,}
+- Volumen promedio: {avg_volume:,}
+- Keywords únicas: {unique_keywords:,}{traffic_stats}
+
+# KEYWORDS A ANALIZAR (TOP {count} POR VOLUMEN, CSV)
+"""
+
+_TRAFFIC_STATS_TEMPLATE = "\n- Tráfico total: {total_traffic:,}\n- Tráfico promedio: {avg_traffic:,}"
+
+_UNIVERSE_TASK_HEADER = """# TIPO DE ANÁLISIS
+{analysis_type}
+
+# TU MISIÓN
+Analiza las keywords anteriores y agrúpalas en {num_tiers} tiers (niveles) de prioridad:
+- Tier 1: Alto volumen y máxima prioridad estratégica
+- Tier {num_tiers}: Menor volumen pero oportunidades específicas
+
+# FORMATO DE RESPUESTA (CRÍTICO - RESPONDER EN JSON)
+Debes responder ÚNICAMENTE con un JSON válido con esta estructura exacta:
+
+{{
+    "summary": "Resumen ejecutivo del universo de keywords en 3-4 párrafos",
+    "topics": [
+        {{
+            "topic": "Nombre del topic",
+            "tier": 1,
+            "keyword_count": 50,
+            "volume": 150000,
+            "traffic": 45000,
+            "priority": "high",
+            "description": "Descripción del topic y por qué es importante",
+            "example_keywords": ["keyword1", "keyword2", "keyword3"]
+        }}
+    ]"""
+
+_GAPS_SCHEMA = """,
+    "gaps": [
+        {
+            "topic": "Nombre del gap/oportunidad",
+            "volume": 50000,
+            "description": "Por qué es una oportunidad",
+            "difficulty": "medium"
+        }
+    ]"""
+
+_TRENDS_SCHEMA = """,
+    "trends": [
+        {
+            "trend": "Nombre de la tendencia",
+            "keywords": ["keyword1", "keyword2"],
+            "insight": "Insight sobre la tendencia"
+        }
+    ]"""
+
+_UNIVERSE_PROMPT_INSTRUCTIONS = """
+}
+
+# INSTRUCCIONES ESPECÍFICAS
+1. Agrupa keywords por tema semántico y relevancia
+2. Calcula el volumen total y número de keywords por topic
+3. Asigna tiers basándote en: volumen, competencia y oportunidad estratégica
+4. Identifica 5-10 topics principales por tier"""
+
+_SEMANTIC_INSTRUCTION = "Realiza análisis semántico profundo para entender intención real del usuario"
+_TRENDS_INSTRUCTION = "Identifica tendencias emergentes y keywords en crecimiento"
+_GAPS_INSTRUCTION = "Detecta gaps de contenido: topics con alto volumen pero poca cobertura competitiva"
+
+_TOPIC_DETAILS_TEMPLATE = """Dado el topic "{topic_name}", identifica qué keywords de la lista anterior pertenecen a este topic.
+
+Responde SOLO con un JSON con esta estructura:
+{{
+    "keywords": ["keyword1", "keyword2", ...]
+}}
+
+IMPORTANTE: Responde ÚNICAMENTE con el JSON, sin explicaciones adicionales."""
+
+_UNIVERSE_PROMPT_FOOTER = "\n\nIMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después."
 
 class AnthropicService:
     """Servicio para interactuar con la API de Anthropic (Claude)"""
     
+    # Columnas de keywords que se envían a Claude (traffic solo si existe)
+    PROMPT_COLUMNS = ['keyword', 'volume', 'traffic']
+    
+    # Claves de la respuesta de Claude que se conservan en el resultado
+    RESULT_KEYS = ('summary', 'topics', 'gaps', 'trends', 'truncated')
+    
+    # Huellas de las API keys ya validadas en este proceso
+    _validated_keys: Set[str] = set()
+    
     # Modelos válidos de Claude
     VALID_MODELS = [
         "claude-sonnet-4-5-20250929",
@@ -30,9 +203,14 @@ class AnthropicService:
         if model not in self.VALID_MODELS:
             raise ValueError(f"Modelo '{model}' no válido. Modelos disponibles: {', '.join(self.VALID_MODELS)}")
         
-        self.client = anthropic.Anthropic(api_key=api_key)
+        self.client = _get_anthropic_client(api_key)
+        self._api_key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
         self.model = model
         self.max_tokens = 16000
+        
+        # Uso de tokens y motivo de parada de la última respuesta en streaming
+        self.last_usage = None
+        self.last_stop_reason = None
     
     def create_universe_prompt(
         self,
@@ -43,10 +221,15 @@ class AnthropicService:
         include_semantic: bool = True,
         include_trends: bool = True,
         include_gaps: bool = True
-    ) -> str:
+    ) -> List[Dict[str, Any]]:
         """
         Crea el prompt optimizado para analizar keywords
         
+        El prompt se devuelve como bloques de contenido del mensaje de usuario:
+        primero los datos (stats + keywords), marcados con cache_control para
+        el prompt caching de Anthropic, y después las instrucciones del tipo
+        de análisis elegido.
+        
         Args:
             df: DataFrame con las keywords
             analysis_type: Tipo de análisis a realizar
@@ -57,7 +240,7 @@ class AnthropicService:
             include_gaps: Si incluir detección de gaps
         
         Returns:
-            Prompt completo para enviar a Claude
+            Bloques de contenido para enviar a Claude con analyze_keywords
         """
         # Validar DataFrame
         if df.empty:
@@ -66,142 +249,149 @@ class AnthropicService:
         if 'keyword' not in df.columns or 'volume' not in df.columns:
             raise ValueError("El DataFrame debe contener al menos las columnas 'keyword' y 'volume'")
         
+        # Reutilizar el prompt si ya se construyó para estos datos y opciones
+        cache_key = (
+            dataframe_fingerprint(df),
+            analysis_type,
+            num_tiers,
+            custom_instructions,
+            include_semantic,
+            include_trends,
+            include_gaps
+        )
+        with _prompt_cache_lock:
+            cached_prompt = _prompt_cache.get(cache_key)
+            if cached_prompt is not None:
+                _prompt_cache.move_to_end(cache_key)
+                return cached_prompt
+        
         # Seleccionar solo columnas disponibles
-        columns_to_use = ['keyword', 'volume']
-        if 'traffic' in df.columns:
-            columns_to_use.append('traffic')
-        
-        # Preparar datos de keywords (top por volumen)
-        top_keywords = df.nlargest(min(1000, len(df)), 'volume')[columns_to_use].to_dict('records')
-        
-        # Crear resumen estadístico
-        stats = {
-            'total_keywords': len(df),
-            'total_volume': int(df['volume'].sum()),
-            'avg_volume': int(df['volume'].mean()),
-            'unique_keywords': df['keyword'].nunique()
-        }
+        columns_to_use = get_safe_columns(df, self.PROMPT_COLUMNS)
+        has_traffic = 'traffic' in columns_to_use
         
-        # Añadir stats de traffic si existe
-        if 'traffic' in df.columns:
-            stats['total_traffic'] = int(df['traffic'].sum())
-            stats['avg_traffic'] = int(df['traffic'].mean())
+        # Preparar datos de keywords (top por volumen) como tabla CSV, indexando
+        # directamente los arrays de cada columna sin pasar por to_dict('records')
+        keywords = collapse_keyword_variants(df)
+        keywords_table = top_volume_csv(keywords, 1000, columns_to_use)
         
-        # Construir secciones opcionales ANTES del f-string
-        gaps_section = ""
-        if include_gaps:
-            gaps_section = """,
-    "gaps": [
-        {
-            "topic": "Nombre del gap/oportunidad",
-            "volume": 50000,
-            "description": "Por qué es una oportunidad",
-            "difficulty": "medium"
-        }
-    ]"""
+        # Crear resumen estadístico con una sola agregación
+        stats = summarize_keyword_stats(df, include_traffic=has_traffic)
         
-        trends_section = ""
-        if include_trends:
-            trends_section = """,
-    "trends": [
-        {
-            "trend": "Nombre de la tendencia",
-            "keywords": ["keyword1", "keyword2"],
-            "insight": "Insight sobre la tendencia"
-        }
-    ]"""
+        # Formatear stats de traffic si existe
+        traffic_stats = ""
+        if has_traffic:
+            traffic_stats = _TRAFFIC_STATS_TEMPLATE.format(**stats)
         
-        # Construir instrucciones adicionales
-        extra_instructions = []
-        instruction_number = 5
+        # Bloque de datos: solo depende del DataFrame (cacheable en Anthropic)
+        data_text = "".join([
+            _UNIVERSE_DATA_TEMPLATE.format(
+                traffic_stats=traffic_stats,
+                count=min(len(keywords), 1000),
+                **stats
+            ),
+            keywords_table
+        ])
         
-        if custom_instructions:
-            extra_instructions.append(f"{instruction_number}. {custom_instructions}")
-            instruction_number += 1
+        prompt = [
+            {"type": "text", "text": data_text, "cache_control": _EPHEMERAL_CACHE},
+            {
+                "type": "text",
+                "text": self._build_task_prompt(
+                    analysis_type,
+                    num_tiers,
+                    custom_instructions,
+                    include_semantic,
+                    include_trends,
+                    include_gaps
+                )
+            }
+        ]
         
-        if include_semantic:
-            extra_instructions.append(
-                f"{instruction_number}. Realiza análisis semántico profundo para entender intención real del usuario"
-            )
-            instruction_number += 1
+        with _prompt_cache_lock:
+            _prompt_cache[cache_key] = prompt
+            if len(_prompt_cache) > _PROMPT_CACHE_SIZE:
+                _prompt_cache.popitem(last=False)
+
+        return prompt
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _build_task_prompt(
+        analysis_type: str,
+        num_tiers: int,
+        custom_instructions: str,
+        include_semantic: bool,
+        include_trends: bool,
+        include_gaps: bool
+    ) -> str:
+        """
+        Construye el bloque de tarea del prompt de universo
         
-        if include_trends:
-            extra_instructions.append(
-                f"{instruction_number}. Identifica tendencias emergentes y keywords en crecimiento"
-            )
-            instruction_number += 1
+        Solo depende de las opciones del análisis (no de los datos), así que
+        se memoiza: las combinaciones posibles son pocas.
         
-        if include_gaps:
-            extra_instructions.append(
-                f"{instruction_number}. Detecta gaps de contenido: topics con alto volumen pero poca cobertura competitiva"
-            )
+        Args:
+            analysis_type: Tipo de análisis a realizar
+            num_tiers: Número de niveles de prioridad
+            custom_instructions: Instrucciones adicionales personalizadas
+            include_semantic: Si incluir análisis semántico
+            include_trends: Si incluir detección de tendencias
+            include_gaps: Si incluir detección de gaps
         
-        # Formatear instrucciones adicionales
-        extra_instructions_text = ""
-        if extra_instructions:
-            extra_instructions_text = "\n" + "\n".join(extra_instructions)
+        Returns:
+            Texto con el tipo de análisis, el esquema JSON y las instrucciones
+        """
+        # Instrucciones adicionales numeradas a partir de la 5
+        optional_instructions = []
+        if custom_instructions:
+            optional_instructions.append(custom_instructions)
+        if include_semantic:
+            optional_instructions.append(_SEMANTIC_INSTRUCTION)
+        if include_trends:
+            optional_instructions.append(_TRENDS_INSTRUCTION)
+        if include_gaps:
+            optional_instructions.append(_GAPS_INSTRUCTION)
         
-        # Formatear stats de traffic si existe
-        traffic_stats = ""
-        if 'total_traffic' in stats:
-            traffic_stats = f"\n- Tráfico total: {stats['total_traffic']:,}\n- Tráfico promedio: {stats['avg_traffic']:,}"
+        task_parts = [
+            _UNIVERSE_TASK_HEADER.format(analysis_type=analysis_type, num_tiers=num_tiers)
+        ]
+        if include_gaps:
+            task_parts.append(_GAPS_SCHEMA)
+        if include_trends:
+            task_parts.append(_TRENDS_SCHEMA)
+        task_parts.append(_UNIVERSE_PROMPT_INSTRUCTIONS)
+        for number, instruction in enumerate(optional_instructions, start=5):
+            task_parts.append(f"\n{number}. {instruction}")
+        task_parts.append(_UNIVERSE_PROMPT_FOOTER)
         
-        # Construir el prompt
-        prompt = f"""Eres un experto en SEO y análisis de keywords. Tu tarea es crear un "Keyword Universe" completo y estratégico.
-
-# DATOS PROPORCIONADOS
-- Total de keywords: {stats['total_keywords']:,}
-- Volumen total de búsqueda: {stats['total_volume']:,}
-- Volumen promedio: {stats['avg_volume']:,}
-- Keywords únicas: {stats['unique_keywords']:,}{traffic_stats}
-
-# TIPO DE ANÁLISIS
-{analysis_type}
-
-# TU MISIÓN
-Analiza las siguientes keywords y agrúpalas en {num_tiers} tiers (niveles) de prioridad:
-- Tier 1: Alto volumen y máxima prioridad estratégica
-- Tier {num_tiers}: Menor volumen pero oportunidades específicas
-
-# FORMATO DE RESPUESTA (CRÍTICO - RESPONDER EN JSON)
-Debes responder ÚNICAMENTE con un JSON válido con esta estructura exacta:
-
-{{
-    "summary": "Resumen ejecutivo del universo de keywords en 3-4 párrafos",
-    "topics": [
-        {{
-            "topic": "Nombre del topic",
-            "tier": 1,
-            "keyword_count": 50,
-            "volume": 150000,
-            "traffic": 45000,
-            "priority": "high",
-            "description": "Descripción del topic y por qué es importante",
-            "example_keywords": ["keyword1", "keyword2", "keyword3"]
-        }}
-    ]{gaps_section}{trends_section}
-}}
-
-# INSTRUCCIONES ESPECÍFICAS
-1. Agrupa keywords por tema semántico y relevancia
-2. Calcula el volumen total y número de keywords por topic
-3. Asigna tiers basándote en: volumen, competencia y oportunidad estratégica
-4. Identifica 5-10 topics principales por tier{extra_instructions_text}
-
-# KEYWORDS A ANALIZAR (TOP {len(top_keywords)} POR VOLUMEN)
-{json.dumps(top_keywords, indent=2, ensure_ascii=False)}
-
-IMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después."""
-
-        return prompt
+        return "".join(task_parts)
     
-    def analyze_keywords(self, prompt: str, df: pd.DataFrame) -> Dict[str, Any]:
+    def analyze_keywords(
+        self,
+        prompt: Union[str, List[Dict[str, Any]]],
+        df: pd.DataFrame,
+        on_progress: Optional[Callable[[int], None]] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        use_cache: bool = True,
+        **analysis_params
+    ) -> Dict[str, Any]:
         """
         Envía el prompt a Claude y procesa la respuesta
         
+        La respuesta se recibe en streaming para poder informar del progreso
+        mientras Claude genera el JSON. El uso de tokens de la llamada queda
+        disponible en self.last_usage. Si el mismo prompt ya se analizó con
+        este modelo dentro del TTL, se devuelve el resultado cacheado sin
+        llamar a la API.
+        
         Args:
-            prompt: Prompt completo a enviar
+            prompt: Bloques de create_universe_prompt (o un prompt en texto plano)
             df: DataFrame original con las keywords
+            on_progress: Callback opcional que recibe los caracteres recibidos
+            on_chunk: Callback opcional que recibe cada fragmento de texto
+            use_cache: Si reutilizar respuestas cacheadas para el mismo prompt
+            **analysis_params: Opciones del análisis; ya van incluidas en el
+                prompt y se aceptan para mantener la firma de la app
         
         Returns:
             Diccionario con los resultados del análisis
@@ -209,36 +399,43 @@ IMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después."""
         Raises:
             Exception: Si hay error en la API o en el parsing
         """
+        cache_key = self._response_cache_key(prompt, _UNIVERSE_SYSTEM_PROMPT)
+        if use_cache:
+            cached_result = self._get_cached_response(cache_key)
+            if cached_result is not None:
+                return cached_result
+        
         try:
-            message = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                temperature=0.3,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
+            response_text = self._stream_response_text(
+                prompt,
+                on_progress=on_progress,
+                on_chunk=on_chunk
             )
             
-            # Extraer el contenido de la respuesta
-            response_text = message.content[0].text
-            
             # Intentar parsear el JSON
             try:
-                result = json.loads(response_text)
+                result = fast_json.loads(response_text)
             except json.JSONDecodeError as e:
                 # Si falla, intentar extraer el JSON del texto
-                import re
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
+                result = None
+                json_block = extract_json_block(response_text)
+                if json_block:
                     try:
-                        result = json.loads(json_match.group())
+                        result = fast_json.loads(json_block)
                     except json.JSONDecodeError:
-                        raise ValueError(
-                            f"No se pudo parsear JSON de la respuesta. "
-                            f"Error original: {str(e)}\n"
-                            f"Respuesta de Claude: {response_text[:500]}..."
-                        )
-                else:
+                        pass
+                
+                # Respuesta cortada: conservar los topics que llegaron completos
+                if result is None:
+                    result = self._salvage_truncated_response(response_text)
+                
+                if result is None and json_block:
+                    raise ValueError(
+                        f"No se pudo parsear JSON de la respuesta. "
+                        f"Error original: {str(e)}\n"
+                        f"Respuesta de Claude: {response_text[:500]}..."
+                    )
+                if result is None:
                     raise ValueError(
                         f"No se encontró JSON válido en la respuesta de Claude.\n"
                         f"Respuesta: {response_text[:500]}..."
@@ -248,9 +445,17 @@ IMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después."""
             if 'topics' not in result:
                 raise ValueError("La respuesta de Claude no contiene la clave 'topics'")
             
+            # Conservar solo las claves que usa la app: el resultado se guarda en
+            # session_state y cualquier campo extra se arrastra en cada rerun
+            result = {key: result[key] for key in self.RESULT_KEYS if key in result}
+            
             # Validar y enriquecer resultados
             result = self._enrich_results(result, df)
             
+            # Un resultado parcial no se cachea para poder reintentarlo
+            if not result.get('truncated'):
+                self._store_cached_response(cache_key, result)
+            
             return result
             
         except anthropic.APIError as e:
@@ -258,10 +463,172 @@ IMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después."""
         except Exception as e:
             raise Exception(f"Error al analizar con Claude: {str(e)}")
     
+    def _salvage_truncated_response(self, response_text: str) -> Optional[Dict[str, Any]]:
+        """
+        Reconstruye un resultado parcial a partir de una respuesta truncada
+        
+        Args:
+            response_text: Texto de la respuesta de Claude
+        
+        Returns:
+            Diccionario con los topics completos y truncated=True, o None si
+            no se pudo recuperar ningún topic
+        """
+        topics = extract_partial_array(response_text, 'topics')
+        if not topics:
+            return None
+        
+        result = {'topics': topics, 'truncated': True}
+        
+        summary = extract_json_value(response_text, 'summary')
+        if isinstance(summary, str):
+            result['summary'] = summary
+        
+        print(f"Warning: Respuesta de Claude truncada; se recuperaron {len(topics)} topics completos")
+        return result
+    
+    def _response_cache_key(
+        self,
+        prompt: Union[str, List[Dict[str, Any]]],
+        system: Optional[str] = None
+    ) -> str:
+        """
+        Calcula la huella de una petición para la caché de respuestas
+        
+        Args:
+            prompt: Contenido del mensaje de usuario (texto o bloques)
+            system: Prompt de sistema enviado con la petición
+        
+        Returns:
+            Digest blake2b del modelo, el prompt de sistema y el prompt
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model.encode('utf-8'))
+        digest.update(b'\x00')
+        digest.update((system or '').encode('utf-8'))
+        digest.update(b'\x00')
+        if isinstance(prompt, str):
+            digest.update(prompt.encode('utf-8'))
+        else:
+            for block in prompt:
+                digest.update(block.get('text', '').encode('utf-8'))
+                digest.update(b'\x00')
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _get_cached_response(cache_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Devuelve una copia de la respuesta cacheada si no ha expirado
+        
+        Args:
+            cache_key: Huella calculada con _response_cache_key
+        
+        Returns:
+            Copia del resultado cacheado o None
+        """
+        with _response_cache_lock:
+            cached = _response_cache.get(cache_key)
+            if cached is None:
+                return None
+            if time.monotonic() - cached[0] > RESPONSE_CACHE_TTL_SECONDS:
+                del _response_cache[cache_key]
+                return None
+            _response_cache.move_to_end(cache_key)
+            result = cached[1]
+        
+        # Copia para que los cambios del llamante no alteren la caché
+        return copy.deepcopy(result)
+    
+    @staticmethod
+    def _store_cached_response(cache_key: str, result: Dict[str, Any]) -> None:
+        """
+        Guarda una copia de la respuesta en la caché LRU
+        
+        Args:
+            cache_key: Huella calculada con _response_cache_key
+            result: Resultado parseado de Claude
+        """
+        entry = (time.monotonic(), copy.deepcopy(result))
+        with _response_cache_lock:
+            _response_cache[cache_key] = entry
+            _response_cache.move_to_end(cache_key)
+            if len(_response_cache) > _RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+    
+    @staticmethod
+    def clear_response_cache() -> int:
+        """
+        Vacía la caché de respuestas de Claude
+        
+        Returns:
+            Número de entradas eliminadas
+        """
+        with _response_cache_lock:
+            count = len(_response_cache)
+            _response_cache.clear()
+        return count
+    
+    def _stream_response_text(
+        self,
+        prompt: Union[str, List[Dict[str, Any]]],
+        on_progress: Optional[Callable[[int], None]] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        system: Optional[str] = _UNIVERSE_SYSTEM_PROMPT
+    ) -> str:
+        """
+        Envía el prompt en modo streaming y acumula el texto de la respuesta
+        
+        Args:
+            prompt: Contenido del mensaje de usuario (texto o bloques)
+            on_progress: Callback opcional que recibe los caracteres recibidos
+            on_chunk: Callback opcional que recibe cada fragmento de texto
+            max_tokens: Límite de tokens de salida (por defecto self.max_tokens)
+            system: Prompt de sistema (None para no enviarlo)
+        
+        Returns:
+            Texto completo de la respuesta de Claude
+        """
+        chunks = []
+        received = 0
+        
+        request = {
+            "model": self.model,
+            "max_tokens": max_tokens or self.max_tokens,
+            "temperature": 0.3,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ]
+        }
+        if system:
+            request["system"] = system
+        
+        with self.client.messages.stream(**request) as stream:
+            for text in stream.text_stream:
+                chunks.append(text)
+                if on_chunk:
+                    on_chunk(text)
+                if on_progress:
+                    received += len(text)
+                    on_progress(received)
+            
+            # Uso de tokens (incluye lecturas/escrituras de prompt caching)
+            final_message = stream.get_final_message()
+            self.last_usage = final_message.usage
+            self.last_stop_reason = final_message.stop_reason
+        
+        if self.last_stop_reason == "max_tokens":
+            print(f"Warning: La respuesta de Claude alcanzó el límite de {request['max_tokens']} tokens")
+        
+        return "".join(chunks)
+    
     def _enrich_results(self, result: Dict, df: pd.DataFrame) -> Dict:
         """
         Enriquece los resultados con datos adicionales y validación
         
+        Los campos numéricos se normalizan de forma vectorizada sobre todos
+        los topics a la vez y después se escriben de vuelta en cada dict.
+        
         Args:
             result: Resultados crudos de Claude
             df: DataFrame original con las keywords
@@ -269,58 +636,142 @@ IMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después."""
         Returns:
             Resultados enriquecidos y validados
         """
-        has_traffic_column = 'traffic' in df.columns
-        
-        if 'topics' in result:
-            for i, topic in enumerate(result['topics']):
-                try:
-                    # Asegurar que todos los campos numéricos sean int/float
-                    topic['keyword_count'] = int(topic.get('keyword_count', 0))
-                    topic['volume'] = int(topic.get('volume', 0))
-                    topic['tier'] = int(topic.get('tier', 1))
-                    
-                    # Manejar traffic: usar valor de Claude o estimar
-                    if 'traffic' in topic and topic['traffic'] is not None:
-                        topic['traffic'] = int(topic['traffic'])
-                    elif has_traffic_column:
-                        # Si no lo proporcionó Claude pero existe en el DF, estimar
-                        topic['traffic'] = int(topic['volume'] * 0.3)
-                    else:
-                        # Si no existe la columna traffic, estimar basado en volumen
-                        topic['traffic'] = int(topic['volume'] * 0.3)
-                    
-                    # Calcular métricas adicionales
-                    if topic['keyword_count'] > 0:
-                        topic['avg_volume_per_keyword'] = round(
-                            topic['volume'] / topic['keyword_count'], 
-                            2
-                        )
-                    else:
-                        topic['avg_volume_per_keyword'] = 0
-                    
-                    # Asegurar que priority existe
-                    if 'priority' not in topic:
-                        # Inferir prioridad basada en tier
-                        if topic['tier'] == 1:
-                            topic['priority'] = 'high'
-                        elif topic['tier'] == 2:
-                            topic['priority'] = 'medium'
-                        else:
-                            topic['priority'] = 'low'
-                    
-                    # Asegurar que example_keywords existe y es una lista
-                    if 'example_keywords' not in topic:
-                        topic['example_keywords'] = []
-                    elif not isinstance(topic['example_keywords'], list):
-                        topic['example_keywords'] = []
-                    
-                except (ValueError, KeyError, TypeError) as e:
-                    print(f"Warning: Error procesando topic {i}: {str(e)}")
-                    # Continuar con el siguiente topic en vez de fallar completamente
-                    continue
+        topics = [topic for topic in result.get('topics') or [] if isinstance(topic, dict)]
+        if not topics:
+            return result
+        
+        topics_df = pd.DataFrame(topics)
+        
+        def numeric_column(column: str, default: int) -> pd.Series:
+            if column not in topics_df.columns:
+                return pd.Series(default, index=topics_df.index, dtype='float64')
+            return pd.to_numeric(topics_df[column], errors='coerce').fillna(default)
+        
+        # Asegurar que todos los campos numéricos sean int
+        keyword_count = numeric_column('keyword_count', 0).astype('int64')
+        volume = numeric_column('volume', 0).astype('int64')
+        tier = numeric_column('tier', 1).astype('int64')
+        
+        # Traffic: usar valor de Claude o estimar como 30% del volumen
+        traffic = numeric_column('traffic', np.nan).fillna(volume * 0.3).astype('int64')
+        
+        # Volumen medio por keyword (0 si no hay keywords)
+        avg_volume = np.round(
+            np.divide(
+                volume.to_numpy(dtype=float),
+                keyword_count.to_numpy(dtype=float),
+                out=np.zeros(len(topics_df)),
+                where=keyword_count.to_numpy() > 0
+            ),
+            2
+        )
+        
+        # Inferir prioridad basada en tier cuando Claude no la proporciona
+        inferred_priority = tier.map({1: 'high', 2: 'medium'}).fillna('low')
+        
+        for topic, kc, vol, tr, tf, avg, priority in zip(
+            topics,
+            keyword_count.tolist(),
+            volume.tolist(),
+            tier.tolist(),
+            traffic.tolist(),
+            avg_volume.tolist(),
+            inferred_priority.tolist()
+        ):
+            topic['keyword_count'] = kc
+            topic['volume'] = vol
+            topic['tier'] = tr
+            topic['traffic'] = tf
+            topic['avg_volume_per_keyword'] = avg
+            
+            if 'priority' not in topic:
+                topic['priority'] = priority
+            
+            # Asegurar que example_keywords existe y es una lista
+            if not isinstance(topic.get('example_keywords'), list):
+                topic['example_keywords'] = []
         
         return result
     
+    def _topic_details_prompt(self, topic_name: str, sample_data: str) -> List[Dict[str, Any]]:
+        """
+        Construye los bloques del prompt de detalle de un topic
+        
+        Args:
+            topic_name: Nombre del topic
+            sample_data: Lista de keywords ya serializada en JSON
+        
+        Returns:
+            Bloques de contenido para el mensaje de usuario
+        """
+        # La lista es la misma para todos los topics del dataset: va primero y
+        # marcada como cacheable; solo la pregunta sobre el topic cambia
+        return [
+            {"type": "text", "text": f"Keywords:\n{sample_data}", "cache_control": _EPHEMERAL_CACHE},
+            {"type": "text", "text": _TOPIC_DETAILS_TEMPLATE.format(topic_name=topic_name)}
+        ]
+    
+    def _topic_sample_data(self, df: pd.DataFrame) -> str:
+        """
+        Serializa las keywords que se envían en los prompts de detalle
+        
+        Args:
+            df: DataFrame con todas las keywords
+        
+        Returns:
+            JSON con la lista de keywords de mayor volumen
+        """
+        # Limitar a 500 keywords para evitar exceder límites de tokens.
+        # Claude solo necesita los textos para elegir, no volumen ni tráfico
+        top_positions = cached_top_volume_positions(df, 500)
+        return fast_json.dumps(df['keyword'].to_numpy()[top_positions].tolist())
+    
+    def _parse_topic_keywords(self, response_text: str, topic_name: str, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Parsea la respuesta de detalle de un topic y filtra el DataFrame
+        
+        Args:
+            response_text: Texto devuelto por Claude
+            topic_name: Nombre del topic (para los avisos)
+            df: DataFrame con todas las keywords
+        
+        Returns:
+            DataFrame filtrado con las keywords del topic
+        """
+        # Intentar parsear JSON
+        try:
+            result = fast_json.loads(response_text)
+        except json.JSONDecodeError:
+            # Decodificar el objeto JSON que empieza en la primera llave
+            result = decode_json_block(response_text)
+            if result is None:
+                print(f"Warning: No se pudo parsear respuesta para topic '{topic_name}'")
+                return pd.DataFrame()
+        
+        # Filtrar el dataframe
+        matching_keywords = result.get('keywords', [])
+        if not matching_keywords:
+            return pd.DataFrame()
+        
+        return self._filter_topic_keywords(df, matching_keywords)
+    
+    def _filter_topic_keywords(self, df: pd.DataFrame, keywords: List[str]) -> pd.DataFrame:
+        """
+        Filtra las filas de df cuyas keywords están en la lista
+        
+        La tabla hash de keywords (un pd.Index) se memoriza por DataFrame y se
+        reutiliza entre topics e instancias, así que cada filtrado solo busca
+        las keywords devueltas por Claude en vez de recorrer la columna.
+        
+        Args:
+            df: DataFrame con todas las keywords
+            keywords: Keywords a conservar
+        
+        Returns:
+            Filas coincidentes en el orden original de df (como isin)
+        """
+        return filter_by_keyword_index(df, keyword_index(df), keywords)
+    
     def get_topic_details(self, topic_name: str, df: pd.DataFrame) -> pd.DataFrame:
         """
         Obtiene las keywords específicas de un topic usando Claude
@@ -335,56 +786,69 @@ IMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después."""
         if df.empty:
             return pd.DataFrame()
         
-        # Preparar datos de forma segura
-        columns_to_use = ['keyword', 'volume']
-        if 'traffic' in df.columns:
-            columns_to_use.append('traffic')
+        prompt = self._topic_details_prompt(topic_name, self._topic_sample_data(df))
         
-        # Limitar a 500 keywords para evitar exceder límites de tokens
-        sample_df = df.nlargest(min(500, len(df)), 'volume')
-        sample_data = sample_df[columns_to_use].to_json(orient='records', force_ascii=False)
+        # Se cachea la lista de keywords devuelta y se vuelve a filtrar df
+        cache_key = self._response_cache_key(prompt)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            return self._filter_topic_keywords(df, cached['keywords'])
         
-        prompt = f"""Dado el topic "{topic_name}", identifica qué keywords del siguiente dataset pertenecen a este topic.
-
-Responde SOLO con un JSON con esta estructura:
-{{
-    "keywords": ["keyword1", "keyword2", ...]
-}}
-
-Dataset:
-{sample_data}
-
-IMPORTANTE: Responde ÚNICAMENTE con el JSON, sin explicaciones adicionales."""
+        try:
+            response_text = self._stream_response_text(prompt, max_tokens=4000, system=None)
+            details = self._parse_topic_keywords(response_text, topic_name, df)
+            if not details.empty:
+                self._store_cached_response(cache_key, {'keywords': details['keyword'].tolist()})
+            return details
+            
+        except anthropic.APIError as e:
+            print(f"Error en API obteniendo detalles del topic '{topic_name}': {str(e)}")
+            return pd.DataFrame()
+        except Exception as e:
+            print(f"Error obteniendo detalles del topic '{topic_name}': {str(e)}")
+            return pd.DataFrame()
+    
+    async def get_topic_details_async(
+        self,
+        topic_name: str,
+        df: pd.DataFrame,
+        async_client: anthropic.AsyncAnthropic,
+        sample_data: Optional[str] = None
+    ) -> pd.DataFrame:
+        """
+        Versión asíncrona de get_topic_details
+        
+        Args:
+            topic_name: Nombre del topic
+            df: DataFrame con todas las keywords
+            async_client: Cliente asíncrono de Anthropic
+            sample_data: Lista de keywords ya serializada (se calcula si falta)
+        
+        Returns:
+            DataFrame filtrado con las keywords del topic
+        """
+        if df.empty:
+            return pd.DataFrame()
+        
+        prompt = self._topic_details_prompt(topic_name, sample_data or self._topic_sample_data(df))
+        
+        cache_key = self._response_cache_key(prompt)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            return self._filter_topic_keywords(df, cached['keywords'])
         
         try:
-            message = self.client.messages.create(
+            message = await async_client.messages.create(
                 model=self.model,
                 max_tokens=4000,
                 temperature=0.3,
                 messages=[{"role": "user", "content": prompt}]
             )
             
-            response_text = message.content[0].text
-            
-            # Intentar parsear JSON
-            try:
-                result = json.loads(response_text)
-            except json.JSONDecodeError:
-                # Intentar extraer JSON
-                import re
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                else:
-                    print(f"Warning: No se pudo parsear respuesta para topic '{topic_name}'")
-                    return pd.DataFrame()
-            
-            # Filtrar el dataframe
-            matching_keywords = result.get('keywords', [])
-            if not matching_keywords:
-                return pd.DataFrame()
-            
-            return df[df['keyword'].isin(matching_keywords)]
+            details = self._parse_topic_keywords(message.content[0].text, topic_name, df)
+            if not details.empty:
+                self._store_cached_response(cache_key, {'keywords': details['keyword'].tolist()})
+            return details
             
         except anthropic.APIError as e:
             print(f"Error en API obteniendo detalles del topic '{topic_name}': {str(e)}")
@@ -393,24 +857,174 @@ IMPORTANTE: Responde ÚNICAMENTE con el JSON, sin explicaciones adicionales."""
             print(f"Error obteniendo detalles del topic '{topic_name}': {str(e)}")
             return pd.DataFrame()
     
+    def get_topic_details_many(
+        self,
+        topic_names: List[str],
+        df: pd.DataFrame,
+        max_concurrency: int = 5
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        Obtiene las keywords de varios topics con llamadas concurrentes
+        
+        Alternativa síncrona a get_topic_details_batch cuando la Message
+        Batches API no está disponible: las peticiones se lanzan en paralelo
+        con AsyncAnthropic, limitadas por un semáforo para respetar los
+        rate limits.
+        
+        Args:
+            topic_names: Nombres de los topics
+            df: DataFrame con todas las keywords
+            max_concurrency: Número máximo de peticiones simultáneas
+        
+        Returns:
+            Diccionario topic -> DataFrame con sus keywords (vacío si falló)
+        """
+        unique_topics = list(dict.fromkeys(topic_names))
+        if df.empty or not unique_topics:
+            return {topic_name: pd.DataFrame() for topic_name in unique_topics}
+        
+        return asyncio.run(self._gather_topic_details(unique_topics, df, max_concurrency))
+    
+    async def _gather_topic_details(
+        self,
+        topic_names: List[str],
+        df: pd.DataFrame,
+        max_concurrency: int
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        Lanza get_topic_details_async para todos los topics con un semáforo
+        
+        Args:
+            topic_names: Nombres de los topics (sin duplicados)
+            df: DataFrame con todas las keywords
+            max_concurrency: Número máximo de peticiones simultáneas
+        
+        Returns:
+            Diccionario topic -> DataFrame con sus keywords
+        """
+        # La lista de keywords se serializa una sola vez para todos los topics
+        sample_data = self._topic_sample_data(df)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        # El cliente asíncrono se liga al event loop, así que vive solo en esta ejecución
+        async with anthropic.AsyncAnthropic(api_key=self.client.api_key, max_retries=MAX_RETRIES) as async_client:
+            async def bounded(topic_name: str) -> pd.DataFrame:
+                async with semaphore:
+                    return await self.get_topic_details_async(topic_name, df, async_client, sample_data)
+            
+            results = await asyncio.gather(*(bounded(topic_name) for topic_name in topic_names))
+        
+        return dict(zip(topic_names, results))
+    
+    def get_topic_details_batch(
+        self,
+        topic_names: List[str],
+        df: pd.DataFrame,
+        poll_interval: float = 5.0,
+        timeout: float = 3600.0
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        Obtiene las keywords de varios topics con una sola Message Batch
+        
+        En lugar de una llamada por topic, todas las peticiones se envían
+        juntas a la Message Batches API (mitad de coste) y se espera a que
+        termine el lote. Con un único topic se usa la llamada síncrona y, si
+        la API de lotes falla, get_topic_details_many.
+        
+        Args:
+            topic_names: Nombres de los topics
+            df: DataFrame con todas las keywords
+            poll_interval: Segundos entre consultas del estado del lote
+            timeout: Tiempo máximo de espera en segundos
+        
+        Returns:
+            Diccionario topic -> DataFrame con sus keywords (vacío si falló)
+        """
+        if df.empty or not topic_names:
+            return {topic_name: pd.DataFrame() for topic_name in topic_names}
+        
+        unique_topics = list(dict.fromkeys(topic_names))
+        if len(unique_topics) == 1:
+            return {unique_topics[0]: self.get_topic_details(unique_topics[0], df)}
+        
+        # La lista de keywords se serializa una sola vez para todo el lote
+        sample_data = self._topic_sample_data(df)
+        
+        # custom_id solo admite [a-zA-Z0-9_-], así que se usa el índice del topic
+        requests = [
+            {
+                "custom_id": f"topic-{index}",
+                "params": {
+                    "model": self.model,
+                    "max_tokens": 4000,
+                    "temperature": 0.3,
+                    "messages": [
+                        {"role": "user", "content": self._topic_details_prompt(topic_name, sample_data)}
+                    ]
+                }
+            }
+            for index, topic_name in enumerate(unique_topics)
+        ]
+        
+        details = {topic_name: pd.DataFrame() for topic_name in unique_topics}
+        
+        try:
+            batch = self.client.messages.batches.create(requests=requests)
+            
+            deadline = time.monotonic() + timeout
+            while batch.processing_status != "ended":
+                if time.monotonic() > deadline:
+                    self.client.messages.batches.cancel(batch.id)
+                    print(f"Warning: El lote {batch.id} superó el tiempo de espera")
+                    return details
+                time.sleep(poll_interval)
+                batch = self.client.messages.batches.retrieve(batch.id)
+            
+            for entry in self.client.messages.batches.results(batch.id):
+                topic_name = unique_topics[int(entry.custom_id.split('-', 1)[1])]
+                if entry.result.type != "succeeded":
+                    print(f"Warning: Sin resultado para topic '{topic_name}' ({entry.result.type})")
+                    continue
+                
+                response_text = entry.result.message.content[0].text
+                details[topic_name] = self._parse_topic_keywords(response_text, topic_name, df)
+            
+            return details
+            
+        except anthropic.APIError as e:
+            # Sin acceso a la Batches API: llamadas concurrentes como alternativa
+            print(f"Error en API obteniendo detalles de topics en lote: {str(e)}")
+            return self.get_topic_details_many(unique_topics, df)
+        except Exception as e:
+            print(f"Error obteniendo detalles de topics en lote: {str(e)}")
+            return details
+    
     def validate_api_key(self) -> bool:
         """
         Valida que la API key funcione correctamente
         
+        Hace una petición mínima (1 token de salida) y recuerda las keys
+        válidas durante la vida del proceso para no volver a comprobarlas.
+        
         Returns:
             True si la API key es válida, False en caso contrario
         """
+        if self._api_key_hash in AnthropicService._validated_keys:
+            return True
+        
         try:
-            # Hacer una llamada simple de prueba
-            message = self.client.messages.create(
+            # Hacer una llamada mínima de prueba
+            self.client.messages.create(
                 model=self.model,
-                max_tokens=100,
+                max_tokens=1,
                 messages=[
-                    {"role": "user", "content": "Hello"}
+                    {"role": "user", "content": "."}
                 ]
             )
-            return True
         except anthropic.APIError:
             return False
         except Exception:
             return False
+        
+        AnthropicService._validated_keys.add(self._api_key_hash)
+        return True
@@ -2,34 +2,356 @@
 Servicio para generar arquitectura de contenido web basada en análisis de keywords
 """
 
-from openai import OpenAI
-from anthropic import Anthropic
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient as OpenAIHttpxClient
+from anthropic import Anthropic, AsyncAnthropic, DefaultHttpxClient as AnthropicHttpxClient
 import pandas as pd
+import numpy as np
+import asyncio
+import atexit
+import contextlib
+import copy
+import functools
+import hashlib
+import heapq
+import importlib.util
 import json
-from typing import Dict, List, Any, Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Callable, Coroutine, Tuple
+
+from app.utils import fast_json
+from app.utils.helpers import decode_json_block
+from app.utils.json_schema import (
+    SCHEMA_INTEGER,
+    SCHEMA_STRING,
+    SCHEMA_STRINGS,
+    response_format,
+    schema_array,
+    schema_object,
+    supports_structured_outputs
+)
+from app.utils.rate_limiter import RateLimiter, estimate_tokens
+
+# Caché de arquitecturas generadas, por proveedor: huella del prompt y el
+# modelo -> resultado. Regenerar con los mismos topics e instrucciones
+# devuelve el resultado anterior sin volver a llamar a la API
+ARCHITECTURE_CACHE_TTL_SECONDS = 24 * 3600
+_ARCHITECTURE_CACHE_SIZE = 16
+_architecture_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_architecture_cache_lock = threading.Lock()
+
+# Fallos recientes de OpenAI por API key (huella -> (instante, error)): en
+# modo "Ambos" no se vuelve a esperar a OpenAI y sus reintentos mientras el
+# fallo sea reciente, y se genera solo con Claude
+OPENAI_FAILURE_TTL_SECONDS = 60
+_openai_failures: Dict[str, Tuple[float, str]] = {}
+_openai_failures_lock = threading.Lock()
+
+# Caché LRU de prompts: mismos topics, totales e instrucciones producen el
+# mismo prompt, así que no se vuelve a serializar al cambiar de proveedor
+_PROMPT_CACHE_SIZE = 32
+_prompt_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_prompt_cache_lock = threading.Lock()
+
+# Parte estática del prompt de arquitectura (rol, misión y formato de
+# respuesta). Es idéntica en todas las llamadas, así que va en el prompt de
+# sistema: Claude la cachea con cache_control y OpenAI cachea
+# automáticamente los prefijos de más de 1024 tokens
+_ARCHITECTURE_SYSTEM_PROMPT = """Eres un experto en arquitectura de información y SEO. Tu tarea es crear una arquitectura de sitio web optimizada basada en el análisis de keywords. Siempre respondes con JSON válido y completo.
+
+# TU MISIÓN
+Crea una arquitectura de sitio web jerárquica que:
+1. Organice el contenido de forma lógica y SEO-friendly
+2. Establezca una estructura de URL clara
+3. Defina la navegación principal
+4. Identifique páginas pillar y páginas de soporte
+5. Considere la intención del usuario y el customer journey
+
+# FORMATO DE RESPUESTA (CRÍTICO - JSON VÁLIDO)
+Responde ÚNICAMENTE con un objeto JSON con esta forma (`[]` = lista de
+elementos con esos campos, `str[]` = lista de textos, `int` = número entero):
+
+overview: str  # resumen ejecutivo de la arquitectura (2-3 párrafos)
+site_structure:
+  home: {title, description, target_keywords: str[], priority: "critical"}
+  main_sections[]:
+    section_name, url_structure ("/section-name"), description, navigation_label
+    target_topics: str[], estimated_volume: int
+    page_type: "category|hub|landing", priority: "high|medium|low"
+    subsections[]: {name, url ("/section-name/subsection"), description, target_keywords: str[], page_type: "article|guide|comparison"}
+navigation:
+  primary_menu[]: {label, url, dropdown: str[]}
+  footer_sections[]: {title, links: str[]}
+content_strategy:
+  pillar_pages[]: {title, url, target_topics: str[], estimated_word_count: int, supporting_articles: int, priority}
+  content_clusters[]:
+    cluster_name, pillar_page (URL del pillar)
+    cluster_articles[]: {title, url, target_keywords: str[], word_count: int}
+internal_linking:
+  strategy: str  # descripción de la estrategia de linking interno
+  hub_pages: str[]  # URLs
+  linking_opportunities[]: {from ("/page-a"), to ("/page-b"), anchor_text, reason}
+implementation_roadmap[]: {phase: int, duration ("1-2 meses"), focus, pages_to_create: int, priority_pages: str[], estimated_effort ("80 horas")}
+technical_recommendations: str[]
+url_naming_conventions: {pattern ("/categoria/subcategoria/articulo"), examples: str[], rules: str[]}
+
+Los campos sin tipo indicado son textos (str).
+
+CRÍTICO: 
+- Responde SOLO con el JSON, sin texto antes o después
+- Asegúrate de que el JSON es válido y está completo
+- No uses comillas simples, solo comillas dobles
+- No incluyas comentarios en el JSON"""
+
+
+# Mismo formato que el esquema de _ARCHITECTURE_SYSTEM_PROMPT, como JSON
+# Schema estricto para structured outputs de OpenAI: la API garantiza que la
+# respuesta cumple el esquema, sin JSON inválido ni texto alrededor
+_ARCHITECTURE_JSON_SCHEMA = schema_object(
+    overview=SCHEMA_STRING,
+    site_structure=schema_object(
+        home=schema_object(
+            title=SCHEMA_STRING,
+            description=SCHEMA_STRING,
+            target_keywords=SCHEMA_STRINGS,
+            priority=SCHEMA_STRING
+        ),
+        main_sections=schema_array(schema_object(
+            section_name=SCHEMA_STRING,
+            url_structure=SCHEMA_STRING,
+            description=SCHEMA_STRING,
+            navigation_label=SCHEMA_STRING,
+            target_topics=SCHEMA_STRINGS,
+            estimated_volume=SCHEMA_INTEGER,
+            page_type=SCHEMA_STRING,
+            priority=SCHEMA_STRING,
+            subsections=schema_array(schema_object(
+                name=SCHEMA_STRING,
+                url=SCHEMA_STRING,
+                description=SCHEMA_STRING,
+                target_keywords=SCHEMA_STRINGS,
+                page_type=SCHEMA_STRING
+            ))
+        ))
+    ),
+    navigation=schema_object(
+        primary_menu=schema_array(schema_object(
+            label=SCHEMA_STRING,
+            url=SCHEMA_STRING,
+            dropdown=SCHEMA_STRINGS
+        )),
+        footer_sections=schema_array(schema_object(
+            title=SCHEMA_STRING,
+            links=SCHEMA_STRINGS
+        ))
+    ),
+    content_strategy=schema_object(
+        pillar_pages=schema_array(schema_object(
+            title=SCHEMA_STRING,
+            url=SCHEMA_STRING,
+            target_topics=SCHEMA_STRINGS,
+            estimated_word_count=SCHEMA_INTEGER,
+            supporting_articles=SCHEMA_INTEGER,
+            priority=SCHEMA_STRING
+        )),
+        content_clusters=schema_array(schema_object(
+            cluster_name=SCHEMA_STRING,
+            pillar_page=SCHEMA_STRING,
+            cluster_articles=schema_array(schema_object(
+                title=SCHEMA_STRING,
+                url=SCHEMA_STRING,
+                target_keywords=SCHEMA_STRINGS,
+                word_count=SCHEMA_INTEGER
+            ))
+        ))
+    ),
+    internal_linking=schema_object(
+        strategy=SCHEMA_STRING,
+        hub_pages=SCHEMA_STRINGS,
+        linking_opportunities=schema_array(schema_object(
+            **{"from": SCHEMA_STRING},
+            to=SCHEMA_STRING,
+            anchor_text=SCHEMA_STRING,
+            reason=SCHEMA_STRING
+        ))
+    ),
+    implementation_roadmap=schema_array(schema_object(
+        phase=SCHEMA_INTEGER,
+        duration=SCHEMA_STRING,
+        focus=SCHEMA_STRING,
+        pages_to_create=SCHEMA_INTEGER,
+        priority_pages=SCHEMA_STRINGS,
+        estimated_effort=SCHEMA_STRING
+    )),
+    technical_recommendations=SCHEMA_STRINGS,
+    url_naming_conventions=schema_object(
+        pattern=SCHEMA_STRING,
+        examples=SCHEMA_STRINGS,
+        rules=SCHEMA_STRINGS
+    )
+)
+
+# Parte variable del prompt (mensaje de usuario): se rellena con format()
+# en cada llamada en lugar de reconstruir el f-string completo
+_ARCHITECTURE_PROMPT_TEMPLATE = """# CONTEXTO
+- Total keywords analizadas: {n_keywords:,}
+- Topics identificados: {n_topics}
+- Volumen total: {total_volume:,.0f}
+
+# TOPICS PRINCIPALES
+{topics_json}{custom_instructions}"""
+
+_CUSTOM_INSTRUCTIONS_TEMPLATE = "\n\n# INSTRUCCIONES ADICIONALES\n{}"
+
+# Campos de cada topic que se envían en el prompt, con su valor por defecto
+_TOPIC_SUMMARY_DEFAULTS = (
+    ('topic', 'N/A'),
+    ('tier', 0),
+    ('keyword_count', 0),
+    ('volume', 0),
+    ('priority', 'medium'),
+)
+
+
+# Topics enviados en el prompt como máximo (para no exceder tokens)
+_MAX_PROMPT_TOPICS = 50
+
+
+def _topic_volume(topic: Dict[str, Any]) -> float:
+    """Volumen de un topic como número (0 si falta o no es numérico)"""
+    try:
+        return float(topic.get('volume') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _distinct_topics(topics: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Elimina topics repetidos por nombre (sin distinguir mayúsculas)
+    
+    Cuando varios análisis se solapan, el mismo topic aparece varias veces y
+    ocuparía varios de los huecos del prompt. Se conserva la primera
+    aparición; los topics sin nombre no se deduplican.
+    
+    Args:
+        topics: Topics del análisis
+    
+    Returns:
+        Topics distintos, en su orden original
+    """
+    seen = set()
+    distinct = []
+    for topic in topics or []:
+        if not isinstance(topic, dict):
+            continue
+        name = str(topic.get('topic') or '').strip().lower()
+        if name:
+            if name in seen:
+                continue
+            seen.add(name)
+        distinct.append(topic)
+    return distinct
+
+
+def _run_async(coroutine: Coroutine) -> Any:
+    """
+    Ejecuta una corrutina desde código síncrono
+    
+    Si ya hay un event loop activo en este hilo, la corrutina se ejecuta
+    en un hilo auxiliar con su propio loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+# HTTP/2 solo si el extra h2 está instalado (httpx[http2])
+_HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+@functools.lru_cache(maxsize=1)
+def _get_anthropic_http_client() -> AnthropicHttpxClient:
+    """
+    Devuelve el pool de conexiones compartido por los clientes de Claude
+    
+    Las instancias del servicio (una por rerun de Streamlit) reutilizan las
+    conexiones keep-alive en lugar de repetir el handshake TLS.
+    """
+    http_client = AnthropicHttpxClient(http2=_HTTP2_AVAILABLE)
+    atexit.register(http_client.close)
+    return http_client
+
+
+@functools.lru_cache(maxsize=1)
+def _get_openai_http_client() -> OpenAIHttpxClient:
+    """Devuelve el pool de conexiones compartido por los clientes de OpenAI"""
+    http_client = OpenAIHttpxClient(http2=_HTTP2_AVAILABLE)
+    atexit.register(http_client.close)
+    return http_client
+
 
 class ArchitectureService:
     """Servicio para generar arquitecturas de sitios web basadas en keyword analysis"""
     
+    # Reintentos ante rate limits y errores transitorios de las APIs
+    MAX_RETRIES = 5
+    
+    # Límites por proveedor compartidos por todas las instancias del proceso:
+    # se espera en el cliente en vez de provocar 429 en ráfagas de peticiones.
+    # Por defecto, los de la cuenta de producción (Anthropic 4000 RPM / 400k
+    # TPM, OpenAI 10000 RPM / 800k TPM); se pueden sustituir por otro RateLimiter
+    claude_rate_limiter = RateLimiter(rpm=4000, tpm=400000)
+    openai_rate_limiter = RateLimiter(rpm=10000, tpm=800000)
+    
+    # Presupuesto de salida adaptativo: media móvil exponencial de los tokens
+    # generados por topic, con margen, y un mínimo para el esquema completo.
+    # Compartida por todas las instancias (la app crea un servicio por clic)
+    MIN_OUTPUT_TOKENS = 4000
+    OUTPUT_TOKENS_EMA_ALPHA = 0.3
+    OUTPUT_BUDGET_HEADROOM = 1.5
+    output_tokens_per_topic_ema: Optional[float] = None
+    _output_tokens_lock = threading.Lock()
+    
     def __init__(
         self, 
         anthropic_key: Optional[str] = None,
         openai_key: Optional[str] = None,
         claude_model: str = "claude-sonnet-4-5-20250929",
-        openai_model: str = "gpt-4o"
+        openai_model: str = "gpt-4o",
+        cache_enabled: bool = True,
+        max_tokens: int = 16000
     ):
-        self.anthropic_client = Anthropic(api_key=anthropic_key) if anthropic_key else None
-        self.openai_client = OpenAI(api_key=openai_key) if openai_key else None
+        # Los SDK reintentan 408/409/429/5xx y errores de conexión con backoff
+        # exponencial y jitter; el parseo del JSON queda fuera de los reintentos
+        self.anthropic_client = Anthropic(
+            api_key=anthropic_key,
+            max_retries=self.MAX_RETRIES,
+            http_client=_get_anthropic_http_client()
+        ) if anthropic_key else None
+        self.openai_client = OpenAI(
+            api_key=openai_key,
+            max_retries=self.MAX_RETRIES,
+            http_client=_get_openai_http_client()
+        ) if openai_key else None
         self.claude_model = claude_model
         self.openai_model = openai_model
-        self.max_tokens = 16000
+        self.max_tokens = max_tokens
+        self.last_max_tokens: Optional[int] = None
+        self.cache_enabled = cache_enabled
     
     def generate_architecture(
         self,
         analysis_results: Dict[str, Any],
         df: pd.DataFrame,
         provider: str = "Claude",
-        custom_instructions: str = ""
+        custom_instructions: str = "",
+        on_token: Optional[Callable[[str], None]] = None
     ) -> Dict[str, Any]:
         """
         Genera arquitectura de sitio web basada en análisis de keywords
@@ -39,352 +361,775 @@ class ArchitectureService:
             df: DataFrame con las keywords
             provider: "Claude", "OpenAI", o "Ambos"
             custom_instructions: Instrucciones adicionales
+            on_token: Callback opcional que recibe cada fragmento de texto
+                generado, para mostrar el progreso
         
         Returns:
             Diccionario con la arquitectura generada
         """
         
-        # Crear prompt
-        prompt = self._create_architecture_prompt(
-            analysis_results,
-            df,
-            custom_instructions
-        )
+        self._check_provider(provider)
+        prompt, max_tokens, n_topics = self._prepare_generation(analysis_results, df, custom_instructions)
         
         # Generar según proveedor
+        if provider == "Claude":
+            return self._cached_generation(
+                self._generation_cache_key(prompt, 'Claude', self.claude_model),
+                lambda: self._generate_with_claude(prompt, analysis_results, df, on_token, max_tokens, n_topics)
+            )
+        
+        elif provider == "OpenAI":
+            return self._cached_generation(
+                self._generation_cache_key(prompt, 'OpenAI', self.openai_model),
+                lambda: self._generate_with_openai(prompt, on_token, max_tokens, n_topics)
+            )
+        
+        else:
+            return self._generate_with_both(prompt, analysis_results, df, on_token, max_tokens, n_topics)
+    
+    def generate_batch(
+        self,
+        requests: List[Dict[str, Any]],
+        concurrency: int = 8
+    ) -> List[Any]:
+        """
+        Genera varias arquitecturas (variantes de instrucciones o proveedor) en paralelo
+        
+        Args:
+            requests: Lista de diccionarios con los argumentos de
+                generate_architecture: analysis_results, df y opcionalmente
+                provider y custom_instructions
+            concurrency: Máximo de generaciones simultáneas
+        
+        Returns:
+            Una arquitectura por petición, en el mismo orden; si una petición
+            falla su posición contiene la excepción en lugar del resultado
+        """
+        return _run_async(self.generate_batch_async(requests, concurrency))
+    
+    async def generate_batch_async(
+        self,
+        requests: List[Dict[str, Any]],
+        concurrency: int = 8
+    ) -> List[Any]:
+        """Versión asíncrona de generate_batch"""
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        # Un cliente asíncrono por proveedor para todo el lote (ligado a este event loop)
+        async with contextlib.AsyncExitStack() as stack:
+            claude_client = await stack.enter_async_context(
+                AsyncAnthropic(api_key=self.anthropic_client.api_key, max_retries=self.MAX_RETRIES)
+            ) if self.anthropic_client else None
+            openai_client = await stack.enter_async_context(
+                AsyncOpenAI(api_key=self.openai_client.api_key, max_retries=self.MAX_RETRIES)
+            ) if self.openai_client else None
+            
+            async def generate(request: Dict[str, Any]) -> Dict[str, Any]:
+                async with semaphore:
+                    return await self._generate_async(claude_client, openai_client, **request)
+            
+            return await asyncio.gather(
+                *(generate(request) for request in requests),
+                return_exceptions=True
+            )
+    
+    async def _generate_async(
+        self,
+        claude_client: Optional[AsyncAnthropic],
+        openai_client: Optional[AsyncOpenAI],
+        analysis_results: Dict[str, Any],
+        df: pd.DataFrame,
+        provider: str = "Claude",
+        custom_instructions: str = ""
+    ) -> Dict[str, Any]:
+        """Equivalente asíncrono de generate_architecture con clientes ya abiertos"""
+        
+        self._check_provider(provider)
+        prompt, max_tokens, n_topics = self._prepare_generation(analysis_results, df, custom_instructions)
+        
+        if provider == "Claude":
+            return await self._cached_generation_async(
+                self._generation_cache_key(prompt, 'Claude', self.claude_model),
+                lambda: self._generate_with_claude_async(prompt, claude_client, max_tokens=max_tokens, n_topics=n_topics)
+            )
+        
+        if provider == "OpenAI":
+            return await self._cached_generation_async(
+                self._generation_cache_key(prompt, 'OpenAI', self.openai_model),
+                lambda: self._generate_with_openai_async(prompt, openai_client, max_tokens=max_tokens, n_topics=n_topics)
+            )
+        
+        recent_failure = self._recent_openai_failure()
+        if recent_failure:
+            claude_result = await self._cached_generation_async(
+                self._generation_cache_key(prompt, 'Claude', self.claude_model),
+                lambda: self._generate_with_claude_async(prompt, claude_client, max_tokens=max_tokens, n_topics=n_topics)
+            )
+            claude_result['validation_note'] = f"OpenAI no disponible: {recent_failure}"
+            return claude_result
+        
+        try:
+            claude_result, openai_result = await self._gather_both(
+                prompt, claude_client, openai_client, max_tokens=max_tokens, n_topics=n_topics
+            )
+            return self._combine_results(claude_result, openai_result)
+            
+        except Exception as e:
+            raise Exception(f"Error en validación cruzada: {str(e)}")
+    
+    def _check_provider(self, provider: str) -> None:
+        """Valida el proveedor y que sus API keys estén configuradas"""
+        
         if provider == "Claude":
             if not self.anthropic_client:
                 raise ValueError("Claude API key no configurada")
-            return self._generate_with_claude(prompt, analysis_results, df)
         
         elif provider == "OpenAI":
             if not self.openai_client:
                 raise ValueError("OpenAI API key no configurada")
-            return self._generate_with_openai(prompt)
         
         elif provider == "Ambos":
             if not self.anthropic_client or not self.openai_client:
                 raise ValueError("Ambas API keys son necesarias para validación cruzada")
-            return self._generate_with_both(prompt, analysis_results, df)
         
         else:
             raise ValueError(f"Proveedor no válido: {provider}")
     
-    def _create_architecture_prompt(
+    def _prepare_generation(
         self,
         analysis_results: Dict[str, Any],
         df: pd.DataFrame,
         custom_instructions: str = ""
+    ) -> Tuple[str, int, int]:
+        """
+        Prompt y presupuesto de salida de una generación
+        
+        Returns:
+            (prompt, max_tokens, n_topics) con n_topics el número de topics
+            enviados en el prompt
+        """
+        
+        # Totales del dataset, calculados una sola vez sobre el array de volumen
+        volumes = pd.to_numeric(df['volume'], errors='coerce').to_numpy(dtype='float64')
+        total_volume = float(np.nansum(volumes))
+        
+        # Crear prompt (compartido por ambos proveedores en modo "Ambos")
+        prompt = self._create_architecture_prompt(
+            analysis_results,
+            df,
+            custom_instructions,
+            total_volume=total_volume,
+            n_keywords=len(df)
+        )
+        
+        # Presupuesto de salida acorde al número de topics: con pocos topics
+        # la respuesta es corta y no hace falta reservar los 16k tokens
+        n_topics = min(len(_distinct_topics(analysis_results.get('topics', []))), _MAX_PROMPT_TOPICS)
+        max_tokens = self._output_budget(n_topics)
+        self.last_max_tokens = max_tokens
+        
+        return prompt, max_tokens, n_topics
+    
+    def _create_architecture_prompt(
+        self,
+        analysis_results: Dict[str, Any],
+        df: pd.DataFrame,
+        custom_instructions: str = "",
+        total_volume: Optional[float] = None,
+        n_keywords: Optional[int] = None
     ) -> str:
-        """Crea el prompt para generar arquitectura"""
+        """
+        Crea el prompt para generar arquitectura
         
-        # Extraer topics del análisis
-        topics = analysis_results.get('topics', [])
+        Args:
+            analysis_results: Resultados del análisis de keywords
+            df: DataFrame con las keywords
+            custom_instructions: Instrucciones adicionales
+            total_volume: Volumen total ya calculado (se calcula si falta)
+            n_keywords: Número de keywords ya calculado (se calcula si falta)
         
-        # Crear resumen de topics
-        topics_summary = []
-        for topic in topics[:50]:  # Limitar a top 50 para no exceder tokens
-            topics_summary.append({
-                'topic': topic.get('topic', 'N/A'),
-                'tier': topic.get('tier', 0),
-                'keyword_count': topic.get('keyword_count', 0),
-                'volume': topic.get('volume', 0),
-                'priority': topic.get('priority', 'medium')
-            })
+        Returns:
+            Parte variable del prompt (contexto, topics e instrucciones); la
+            parte estática es _ARCHITECTURE_SYSTEM_PROMPT
+        """
+        
+        if total_volume is None:
+            total_volume = float(df['volume'].sum())
+        if n_keywords is None:
+            n_keywords = len(df)
+        
+        # Extraer topics del análisis, sin repetidos
+        topics = _distinct_topics(analysis_results.get('topics', []))
+        
+        # Valores de los topics enviados: los de más volumen (heapq.nlargest
+        # es estable, así que en empates se respeta el orden del análisis)
+        topic_rows = tuple(
+            tuple(topic.get(key, default) for key, default in _TOPIC_SUMMARY_DEFAULTS)
+            for topic in heapq.nlargest(_MAX_PROMPT_TOPICS, topics, key=_topic_volume)
+        )
+        
+        # Reutilizar el prompt si ya se construyó con los mismos datos
+        cache_key = (topic_rows, len(topics), n_keywords, total_volume, custom_instructions)
+        try:
+            with _prompt_cache_lock:
+                cached_prompt = _prompt_cache.get(cache_key)
+                if cached_prompt is not None:
+                    _prompt_cache.move_to_end(cache_key)
+                    return cached_prompt
+        except TypeError:
+            # Algún valor no es hashable (p. ej. una lista): sin caché
+            cache_key = None
+        
+        topic_fields = [key for key, _ in _TOPIC_SUMMARY_DEFAULTS]
+        prompt = _ARCHITECTURE_PROMPT_TEMPLATE.format(
+            n_keywords=n_keywords,
+            n_topics=len(topics),
+            total_volume=total_volume,
+            topics_json=fast_json.dumps([dict(zip(topic_fields, row)) for row in topic_rows]),
+            custom_instructions=_CUSTOM_INSTRUCTIONS_TEMPLATE.format(custom_instructions) if custom_instructions else ""
+        )
+        
+        if cache_key is not None:
+            with _prompt_cache_lock:
+                _prompt_cache[cache_key] = prompt
+                if len(_prompt_cache) > _PROMPT_CACHE_SIZE:
+                    _prompt_cache.popitem(last=False)
         
-        prompt = f"""Eres un experto en arquitectura de información y SEO. Tu tarea es crear una arquitectura de sitio web optimizada basada en el análisis de keywords.
-
-# CONTEXTO
-- Total keywords analizadas: {len(df):,}
-- Topics identificados: {len(topics)}
-- Volumen total: {df['volume'].sum():,.0f}
-
-# TOPICS PRINCIPALES
-{json.dumps(topics_summary, indent=2)}
-
-# TU MISIÓN
-Crea una arquitectura de sitio web jerárquica que:
-1. Organice el contenido de forma lógica y SEO-friendly
-2. Establezca una estructura de URL clara
-3. Defina la navegación principal
-4. Identifique páginas pillar y páginas de soporte
-5. Considere la intención del usuario y el customer journey
-
-{custom_instructions}
-
-# FORMATO DE RESPUESTA (CRÍTICO - JSON VÁLIDO)
-Responde ÚNICAMENTE con un JSON válido con esta estructura:
-
-{{
-    "overview": "Resumen ejecutivo de la arquitectura propuesta (2-3 párrafos)",
-    "site_structure": {{
-        "home": {{
-            "title": "Homepage",
-            "description": "Descripción y propósito",
-            "target_keywords": ["keyword1", "keyword2"],
-            "priority": "critical"
-        }},
-        "main_sections": [
-            {{
-                "section_name": "Nombre de la sección",
-                "url_structure": "/section-name",
-                "description": "Propósito de esta sección",
-                "navigation_label": "Label en menú",
-                "target_topics": ["topic1", "topic2"],
-                "estimated_volume": 100000,
-                "page_type": "category|hub|landing",
-                "priority": "high|medium|low",
-                "subsections": [
-                    {{
-                        "name": "Subsección",
-                        "url": "/section-name/subsection",
-                        "description": "Propósito",
-                        "target_keywords": ["keyword1", "keyword2"],
-                        "page_type": "article|guide|comparison"
-                    }}
-                ]
-            }}
-        ]
-    }},
-    "navigation": {{
-        "primary_menu": [
-            {{
-                "label": "Label del menú",
-                "url": "/url",
-                "dropdown": ["Opción 1", "Opción 2"]
-            }}
-        ],
-        "footer_sections": [
-            {{
-                "title": "Título del grupo",
-                "links": ["Link 1", "Link 2"]
-            }}
-        ]
-    }},
-    "content_strategy": {{
-        "pillar_pages": [
-            {{
-                "title": "Título de página pillar",
-                "url": "/url",
-                "target_topics": ["topic1", "topic2"],
-                "estimated_word_count": 3000,
-                "supporting_articles": 10,
-                "priority": "high"
-            }}
-        ],
-        "content_clusters": [
-            {{
-                "cluster_name": "Nombre del cluster",
-                "pillar_page": "/url-pillar",
-                "cluster_articles": [
-                    {{
-                        "title": "Título del artículo",
-                        "url": "/url",
-                        "target_keywords": ["keyword1"],
-                        "word_count": 1500
-                    }}
-                ]
-            }}
-        ]
-    }},
-    "internal_linking": {{
-        "strategy": "Descripción de la estrategia de linking interno",
-        "hub_pages": ["URL 1", "URL 2"],
-        "linking_opportunities": [
-            {{
-                "from": "/page-a",
-                "to": "/page-b",
-                "anchor_text": "texto del enlace",
-                "reason": "por qué este enlace es importante"
-            }}
-        ]
-    }},
-    "implementation_roadmap": [
-        {{
-            "phase": 1,
-            "duration": "1-2 meses",
-            "focus": "Descripción del foco de esta fase",
-            "pages_to_create": 10,
-            "priority_pages": ["URL 1", "URL 2"],
-            "estimated_effort": "80 horas"
-        }}
-    ],
-    "technical_recommendations": [
-        "Recomendación técnica 1",
-        "Recomendación técnica 2"
-    ],
-    "url_naming_conventions": {{
-        "pattern": "Patrón de URLs (ej: /categoria/subcategoria/articulo)",
-        "examples": ["Ejemplo 1", "Ejemplo 2"],
-        "rules": ["Regla 1", "Regla 2"]
-    }}
-}}
-
-CRÍTICO: 
-- Responde SOLO con el JSON, sin texto antes o después
-- Asegúrate de que el JSON es válido y está completo
-- No uses comillas simples, solo comillas dobles
-- No incluyas comentarios en el JSON"""
-
         return prompt
     
     def _generate_with_claude(
         self, 
         prompt: str,
         analysis_results: Dict[str, Any],
-        df: pd.DataFrame
+        df: pd.DataFrame,
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        n_topics: int = 0
     ) -> Dict[str, Any]:
-        """Genera arquitectura con Claude"""
+        """Genera arquitectura con Claude, recibiendo la respuesta en streaming"""
         
         try:
-            message = self.anthropic_client.messages.create(
-                model=self.claude_model,
-                max_tokens=self.max_tokens,
-                temperature=0.3,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
+            chunks = []
+            self.claude_rate_limiter.acquire(self._estimated_tokens(prompt))
+            with self.anthropic_client.messages.stream(**self._claude_request(prompt, max_tokens)) as stream:
+                for text in stream.text_stream:
+                    chunks.append(text)
+                    if on_token:
+                        on_token(text)
             
-            # Extraer contenido
-            response_text = message.content[0].text
+            response_text = "".join(chunks)
+            self._record_output_tokens(response_text, max_tokens, n_topics)
+            return self._parse_claude_response(response_text)
             
-            # Parsear JSON
-            try:
-                result = json.loads(response_text)
-            except json.JSONDecodeError as e:
-                # Intentar extraer JSON del texto
-                import re
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                else:
-                    raise ValueError(f"No se pudo extraer JSON válido: {str(e)}")
-            
-            # Añadir metadata
-            result['provider'] = 'Claude'
-            result['model'] = self.claude_model
+        except Exception as e:
+            raise Exception(f"Error generando arquitectura con Claude: {str(e)}")
+    
+    async def _generate_with_claude_async(
+        self,
+        prompt: str,
+        client: AsyncAnthropic,
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        n_topics: int = 0
+    ) -> Dict[str, Any]:
+        """Genera arquitectura con Claude usando el cliente asíncrono en streaming"""
+        
+        try:
+            chunks = []
+            await self.claude_rate_limiter.acquire_async(self._estimated_tokens(prompt))
+            async with client.messages.stream(**self._claude_request(prompt, max_tokens)) as stream:
+                async for text in stream.text_stream:
+                    chunks.append(text)
+                    if on_token:
+                        on_token(text)
             
-            return result
+            response_text = "".join(chunks)
+            self._record_output_tokens(response_text, max_tokens, n_topics)
+            return self._parse_claude_response(response_text)
             
         except Exception as e:
             raise Exception(f"Error generando arquitectura con Claude: {str(e)}")
     
-    def _generate_with_openai(self, prompt: str) -> Dict[str, Any]:
-        """Genera arquitectura con OpenAI"""
+    def _output_budget(self, n_topics: int) -> int:
+        """
+        Tokens máximos de salida para una arquitectura con `n_topics` topics
+        
+        Base de MIN_OUTPUT_TOKENS (el esquema completo con pocos topics) más
+        300 por topic enviado (máximo 50), con self.max_tokens como techo.
+        Si ya hay respuestas previas, se limita además a la media móvil de
+        tokens por topic por el número de topics, con margen (nunca por debajo
+        de MIN_OUTPUT_TOKENS).
+        """
+        n_topics = min(n_topics, _MAX_PROMPT_TOPICS)
+        budget = min(self.max_tokens, self.MIN_OUTPUT_TOKENS + 300 * n_topics)
+        
+        per_topic = ArchitectureService.output_tokens_per_topic_ema
+        if per_topic is not None:
+            observed = int(per_topic * max(n_topics, 1) * self.OUTPUT_BUDGET_HEADROOM)
+            budget = min(budget, max(observed, self.MIN_OUTPUT_TOKENS))
+        
+        return budget
+    
+    def _record_output_tokens(self, response_text: str, max_tokens: Optional[int], n_topics: int) -> None:
+        """
+        Actualiza la media móvil de tokens generados por topic con una respuesta
+        
+        Una respuesta que agota (casi) su presupuesto pudo quedar cortada:
+        la media se descarta para que la siguiente llamada use el presupuesto
+        completo por topics. Sin número de topics solo se aplica ese descarte.
+        
+        Args:
+            response_text: Texto completo generado por el modelo
+            max_tokens: Presupuesto de salida con el que se pidió
+            n_topics: Topics enviados en el prompt
+        """
+        output_tokens = estimate_tokens(response_text)
+        per_topic = output_tokens / max(n_topics, 1)
+        alpha = self.OUTPUT_TOKENS_EMA_ALPHA
+        
+        with ArchitectureService._output_tokens_lock:
+            ema = ArchitectureService.output_tokens_per_topic_ema
+            
+            if output_tokens >= 0.95 * (max_tokens or self.max_tokens):
+                ema = None
+            elif not n_topics:
+                return
+            elif ema is None:
+                ema = per_topic
+            else:
+                ema = alpha * per_topic + (1 - alpha) * ema
+            
+            ArchitectureService.output_tokens_per_topic_ema = ema
+    
+    @staticmethod
+    def _estimated_tokens(prompt: str) -> int:
+        """Tokens de entrada estimados de una petición (sistema + datos)"""
+        return estimate_tokens(_ARCHITECTURE_SYSTEM_PROMPT, prompt)
+    
+    def _claude_request(self, prompt: str, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Parámetros de la petición de arquitectura a Claude
+        
+        La parte estática va como prompt de sistema con cache_control: la
+        segunda llamada (reintentos, otro dataset) solo procesa y factura
+        a precio completo los datos del usuario.
+        """
+        
+        return {
+            "model": self.claude_model,
+            "max_tokens": max_tokens or self.max_tokens,
+            "temperature": 0.3,
+            "system": [
+                {"type": "text", "text": _ARCHITECTURE_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+            ],
+            "messages": [
+                {"role": "user", "content": prompt}
+            ]
+        }
+    
+    def _parse_claude_response(self, response_text: str) -> Dict[str, Any]:
+        """Parsea la respuesta de Claude y añade la metadata del proveedor"""
         
+        # Parsear JSON
         try:
-            response = self.openai_client.chat.completions.create(
-                model=self.openai_model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Eres un experto en arquitectura de información y SEO. Siempre respondes con JSON válido y completo."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                max_tokens=self.max_tokens,
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
+            result = fast_json.loads(response_text)
+        except json.JSONDecodeError as e:
+            # Decodificar el objeto JSON que empieza en la primera llave
+            result = decode_json_block(response_text)
+            if result is None:
+                raise ValueError(f"No se pudo extraer JSON válido: {str(e)}")
+        
+        # Añadir metadata
+        result['provider'] = 'Claude'
+        result['model'] = self.claude_model
+        
+        return result
+    
+    def _openai_request(self, prompt: str, max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Parámetros de la petición de arquitectura a OpenAI (en streaming)
+        
+        El mensaje de sistema es el mismo prefijo estático que se envía a
+        Claude; OpenAI cachea automáticamente los prefijos repetidos.
+        """
+        
+        return {
+            "model": self.openai_model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": _ARCHITECTURE_SYSTEM_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            "max_tokens": max_tokens or self.max_tokens,
+            "temperature": 0.3,
+            "response_format": self._openai_response_format(),
+            "stream": True
+        }
+    
+    def _openai_response_format(self) -> Dict[str, Any]:
+        """
+        Formato de respuesta de OpenAI para el modelo configurado
+        
+        Con structured outputs la API garantiza JSON conforme al esquema; los
+        modelos anteriores (gpt-4-turbo) solo admiten json_object.
+        """
+        if not supports_structured_outputs(self.openai_model):
+            return {"type": "json_object"}
+        return response_format("site_architecture", _ARCHITECTURE_JSON_SCHEMA)
+    
+    def _generate_with_openai(
+        self,
+        prompt: str,
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        n_topics: int = 0
+    ) -> Dict[str, Any]:
+        """Genera arquitectura con OpenAI, recibiendo la respuesta en streaming"""
+        
+        try:
+            chunks = []
+            finish_reason = None
             
-            # CRÍTICO: Verificar que hay contenido antes de parsear
-            content = response.choices[0].message.content
+            self.openai_rate_limiter.acquire(self._estimated_tokens(prompt))
+            for chunk in self.openai_client.chat.completions.create(**self._openai_request(prompt, max_tokens)):
+                finish_reason = self._consume_openai_chunk(chunk, chunks, on_token) or finish_reason
             
-            if content is None or content.strip() == "":
-                # Si no hay contenido, puede ser por:
-                # 1. Contenido filtrado por políticas de OpenAI
-                # 2. Límite de tokens excedido
-                # 3. Error en el modelo
-                
-                finish_reason = response.choices[0].finish_reason
-                
-                if finish_reason == "content_filter":
-                    raise ValueError(
-                        "OpenAI filtró el contenido. "
-                        "Intenta simplificar el prompt o usar menos datos."
-                    )
-                elif finish_reason == "length":
-                    raise ValueError(
-                        "Se alcanzó el límite de tokens. "
-                        "Intenta reducir el número de topics o usar un límite menor."
-                    )
-                else:
-                    raise ValueError(
-                        f"OpenAI devolvió respuesta vacía. "
-                        f"Reason: {finish_reason}. "
-                        "Intenta con menos datos o con Claude."
-                    )
+            content = "".join(chunks)
+            self._record_output_tokens(content, max_tokens, n_topics)
+            return self._parse_openai_response(content, finish_reason)
             
-            # Parsear JSON
-            try:
-                result = json.loads(content)
-            except json.JSONDecodeError as e:
-                # Intentar extraer JSON
-                import re
-                json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                else:
-                    raise ValueError(
-                        f"No se pudo parsear JSON de OpenAI: {str(e)}\n"
-                        f"Contenido recibido: {content[:500]}..."
-                    )
+        except Exception as e:
+            raise Exception(f"Error generando arquitectura con OpenAI: {str(e)}")
+    
+    async def _generate_with_openai_async(
+        self,
+        prompt: str,
+        client: AsyncOpenAI,
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        n_topics: int = 0
+    ) -> Dict[str, Any]:
+        """Genera arquitectura con OpenAI usando el cliente asíncrono en streaming"""
+        
+        try:
+            chunks = []
+            finish_reason = None
             
-            # Añadir metadata
-            result['provider'] = 'OpenAI'
-            result['model'] = self.openai_model
+            await self.openai_rate_limiter.acquire_async(self._estimated_tokens(prompt))
+            stream = await client.chat.completions.create(**self._openai_request(prompt, max_tokens))
+            async for chunk in stream:
+                finish_reason = self._consume_openai_chunk(chunk, chunks, on_token) or finish_reason
             
-            return result
+            content = "".join(chunks)
+            self._record_output_tokens(content, max_tokens, n_topics)
+            return self._parse_openai_response(content, finish_reason)
             
         except Exception as e:
             raise Exception(f"Error generando arquitectura con OpenAI: {str(e)}")
     
+    @staticmethod
+    def _consume_openai_chunk(
+        chunk: Any,
+        chunks: List[str],
+        on_token: Optional[Callable[[str], None]] = None
+    ) -> Optional[str]:
+        """
+        Acumula el texto de un chunk del stream de OpenAI
+        
+        Returns:
+            finish_reason del chunk, si lo trae
+        """
+        if not chunk.choices:
+            return None
+        
+        choice = chunk.choices[0]
+        if choice.delta and choice.delta.content:
+            chunks.append(choice.delta.content)
+            if on_token:
+                on_token(choice.delta.content)
+        
+        return choice.finish_reason
+    
+    def _parse_openai_response(self, content: str, finish_reason: Optional[str]) -> Dict[str, Any]:
+        """Parsea la respuesta de OpenAI y añade la metadata del proveedor"""
+        
+        # CRÍTICO: Verificar que hay contenido antes de parsear
+        if content is None or content.strip() == "":
+            # Si no hay contenido, puede ser por:
+            # 1. Contenido filtrado por políticas de OpenAI
+            # 2. Límite de tokens excedido
+            # 3. Error en el modelo
+            
+            if finish_reason == "content_filter":
+                raise ValueError(
+                    "OpenAI filtró el contenido. "
+                    "Intenta simplificar el prompt o usar menos datos."
+                )
+            elif finish_reason == "length":
+                raise ValueError(
+                    "Se alcanzó el límite de tokens. "
+                    "Intenta reducir el número de topics o usar un límite menor."
+                )
+            else:
+                raise ValueError(
+                    f"OpenAI devolvió respuesta vacía. "
+                    f"Reason: {finish_reason}. "
+                    "Intenta con menos datos o con Claude."
+                )
+        
+        # Con structured outputs el contenido es exactamente el JSON del
+        # esquema; solo falla si la respuesta se cortó (finish_reason). Con
+        # json_object puede venir texto alrededor del objeto
+        try:
+            result = fast_json.loads(content)
+        except json.JSONDecodeError as e:
+            result = None
+            if not supports_structured_outputs(self.openai_model):
+                result = decode_json_block(content)
+            if result is None:
+                raise ValueError(
+                    f"No se pudo parsear JSON de OpenAI (finish_reason: {finish_reason}): {str(e)}\n"
+                    f"Contenido recibido: {content[:500]}..."
+                )
+        
+        # Añadir metadata
+        result['provider'] = 'OpenAI'
+        result['model'] = self.openai_model
+        
+        return result
+    
     def _generate_with_both(
         self,
         prompt: str,
         analysis_results: Dict[str, Any],
-        df: pd.DataFrame
+        df: pd.DataFrame,
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        n_topics: int = 0
     ) -> Dict[str, Any]:
-        """Genera arquitectura con ambos proveedores para validación cruzada"""
+        """
+        Genera arquitectura con ambos proveedores para validación cruzada
+        
+        Las dos llamadas se lanzan en paralelo, así que la espera total es la
+        del proveedor más lento en lugar de la suma de ambas. Si OpenAI ha
+        fallado hace poco solo se llama a Claude.
+        """
+        
+        recent_failure = self._recent_openai_failure()
+        if recent_failure:
+            claude_result = self._cached_generation(
+                self._generation_cache_key(prompt, 'Claude', self.claude_model),
+                lambda: self._generate_with_claude(prompt, analysis_results, df, on_token, max_tokens, n_topics)
+            )
+            claude_result['validation_note'] = f"OpenAI no disponible: {recent_failure}"
+            return claude_result
         
         try:
-            # Generar con Claude primero (más confiable)
-            claude_result = self._generate_with_claude(prompt, analysis_results, df)
-            
-            # Generar con OpenAI
-            try:
-                openai_result = self._generate_with_openai(prompt)
-            except Exception as e:
-                # Si OpenAI falla, solo usar Claude pero informar
-                print(f"OpenAI falló, usando solo Claude: {str(e)}")
-                claude_result['validation_note'] = f"OpenAI no disponible: {str(e)}"
-                return claude_result
-            
-            # Combinar resultados
-            combined = {
-                'overview': f"**Análisis de Claude:**\n{claude_result.get('overview', '')}\n\n**Análisis de OpenAI:**\n{openai_result.get('overview', '')}",
-                'site_structure': claude_result.get('site_structure', {}),
-                'site_structure_openai': openai_result.get('site_structure', {}),
-                'navigation': claude_result.get('navigation', {}),
-                'content_strategy': claude_result.get('content_strategy', {}),
-                'internal_linking': claude_result.get('internal_linking', {}),
-                'implementation_roadmap': claude_result.get('implementation_roadmap', []),
-                'technical_recommendations': claude_result.get('technical_recommendations', []),
-                'url_naming_conventions': claude_result.get('url_naming_conventions', {}),
-                'provider': 'Ambos',
-                'models': f"Claude: {self.claude_model} | OpenAI: {self.openai_model}",
-                'validation': self._compare_architectures(claude_result, openai_result)
-            }
-            
-            return combined
+            claude_result, openai_result = _run_async(self._generate_with_both_async(prompt, on_token, max_tokens, n_topics))
+            return self._combine_results(claude_result, openai_result)
             
         except Exception as e:
             raise Exception(f"Error en validación cruzada: {str(e)}")
     
+    def _combine_results(self, claude_result: Any, openai_result: Any) -> Dict[str, Any]:
+        """
+        Combina los resultados de ambos proveedores (o sus excepciones)
+        
+        Si Claude falló se relanza su error; si solo falló OpenAI se devuelve
+        el resultado de Claude con una nota.
+        """
+        
+        if isinstance(claude_result, BaseException):
+            raise claude_result
+        
+        self._record_openai_result(openai_result)
+        
+        if isinstance(openai_result, BaseException):
+            # Si OpenAI falla, solo usar Claude pero informar
+            print(f"OpenAI falló, usando solo Claude: {str(openai_result)}")
+            claude_result['validation_note'] = f"OpenAI no disponible: {str(openai_result)}"
+            return claude_result
+        
+        # Combinar resultados
+        combined = {
+            'overview': f"**Análisis de Claude:**\n{claude_result.get('overview', '')}\n\n**Análisis de OpenAI:**\n{openai_result.get('overview', '')}",
+            'site_structure': claude_result.get('site_structure', {}),
+            'site_structure_openai': openai_result.get('site_structure', {}),
+            'navigation': claude_result.get('navigation', {}),
+            'content_strategy': claude_result.get('content_strategy', {}),
+            'internal_linking': claude_result.get('internal_linking', {}),
+            'implementation_roadmap': claude_result.get('implementation_roadmap', []),
+            'technical_recommendations': claude_result.get('technical_recommendations', []),
+            'url_naming_conventions': claude_result.get('url_naming_conventions', {}),
+            'provider': 'Ambos',
+            'models': f"Claude: {self.claude_model} | OpenAI: {self.openai_model}",
+            'validation': self._compare_architectures(claude_result, openai_result)
+        }
+        
+        return combined
+    
+    def _openai_failure_key(self) -> str:
+        """Huella de la API key de OpenAI (no se guarda la key en memoria compartida)"""
+        return hashlib.sha256(self.openai_client.api_key.encode('utf-8')).hexdigest()
+    
+    def _recent_openai_failure(self) -> Optional[str]:
+        """Error del último fallo de OpenAI con esta key, si es reciente"""
+        
+        with _openai_failures_lock:
+            failure = _openai_failures.get(self._openai_failure_key())
+        
+        if failure and time.monotonic() - failure[0] < OPENAI_FAILURE_TTL_SECONDS:
+            return failure[1]
+        return None
+    
+    def _record_openai_result(self, result: Any) -> None:
+        """Registra el fallo de OpenAI (o lo olvida si la llamada funcionó)"""
+        
+        key = self._openai_failure_key()
+        with _openai_failures_lock:
+            if isinstance(result, BaseException):
+                _openai_failures[key] = (time.monotonic(), str(result))
+            else:
+                _openai_failures.pop(key, None)
+    
+    async def _generate_with_both_async(
+        self,
+        prompt: str,
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        n_topics: int = 0
+    ) -> List[Any]:
+        """
+        Lanza Claude y OpenAI a la vez
+        
+        Returns:
+            [resultado_claude, resultado_openai]; cada elemento es la
+            excepción correspondiente si esa llamada falló
+        """
+        
+        # Los clientes asíncronos se ligan al event loop: viven solo en esta ejecución
+        async with AsyncAnthropic(api_key=self.anthropic_client.api_key, max_retries=self.MAX_RETRIES) as claude_client, \
+                AsyncOpenAI(api_key=self.openai_client.api_key, max_retries=self.MAX_RETRIES) as openai_client:
+            return await self._gather_both(prompt, claude_client, openai_client, on_token, max_tokens, n_topics)
+    
+    async def _gather_both(
+        self,
+        prompt: str,
+        claude_client: AsyncAnthropic,
+        openai_client: AsyncOpenAI,
+        on_token: Optional[Callable[[str], None]] = None,
+        max_tokens: Optional[int] = None,
+        n_topics: int = 0
+    ) -> List[Any]:
+        """Lanza Claude y OpenAI a la vez con los clientes asíncronos dados"""
+        
+        # Cada proveedor se cachea por separado: un fallo de uno no invalida al otro
+        claude_key = self._generation_cache_key(prompt, 'Claude', self.claude_model)
+        openai_key = self._generation_cache_key(prompt, 'OpenAI', self.openai_model)
+        
+        return await asyncio.gather(
+            self._cached_generation_async(
+                claude_key,
+                lambda: self._generate_with_claude_async(prompt, claude_client, on_token, max_tokens, n_topics)
+            ),
+            self._cached_generation_async(
+                openai_key,
+                lambda: self._generate_with_openai_async(prompt, openai_client, on_token, max_tokens, n_topics)
+            ),
+            return_exceptions=True
+        )
+    
+    @staticmethod
+    def _generation_cache_key(prompt: str, provider: str, model: str) -> str:
+        """Huella sha256 del proveedor, el modelo y el prompt"""
+        
+        digest = hashlib.sha256()
+        for part in (provider, model, prompt):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\x00')
+        return digest.hexdigest()
+    
+    def _get_cached_generation(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Devuelve una copia de la arquitectura cacheada si no ha expirado"""
+        
+        if not self.cache_enabled:
+            return None
+        
+        with _architecture_cache_lock:
+            cached = _architecture_cache.get(cache_key)
+            if cached is None:
+                return None
+            if time.monotonic() - cached[0] > ARCHITECTURE_CACHE_TTL_SECONDS:
+                del _architecture_cache[cache_key]
+                return None
+            _architecture_cache.move_to_end(cache_key)
+            result = cached[1]
+        
+        # Copia para que los cambios del llamante no alteren la caché
+        return copy.deepcopy(result)
+    
+    def _store_generation(self, cache_key: str, result: Dict[str, Any]) -> None:
+        """Guarda una copia de la arquitectura generada en la caché LRU"""
+        
+        if not self.cache_enabled:
+            return
+        
+        entry = (time.monotonic(), copy.deepcopy(result))
+        with _architecture_cache_lock:
+            _architecture_cache[cache_key] = entry
+            _architecture_cache.move_to_end(cache_key)
+            if len(_architecture_cache) > _ARCHITECTURE_CACHE_SIZE:
+                _architecture_cache.popitem(last=False)
+    
+    def _cached_generation(
+        self,
+        cache_key: str,
+        generate: Callable[[], Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """Devuelve la arquitectura cacheada o la genera y la guarda"""
+        
+        cached = self._get_cached_generation(cache_key)
+        if cached is not None:
+            return cached
+        
+        result = generate()
+        self._store_generation(cache_key, result)
+        return result
+    
+    async def _cached_generation_async(
+        self,
+        cache_key: str,
+        generate: Callable[[], Coroutine]
+    ) -> Dict[str, Any]:
+        """Versión asíncrona de _cached_generation"""
+        
+        cached = self._get_cached_generation(cache_key)
+        if cached is not None:
+            return cached
+        
+        result = await generate()
+        self._store_generation(cache_key, result)
+        return result
+    
+    @staticmethod
+    def clear_cache() -> int:
+        """
+        Vacía la caché de arquitecturas generadas
+        
+        Returns:
+            Número de entradas eliminadas
+        """
+        with _architecture_cache_lock:
+            count = len(_architecture_cache)
+            _architecture_cache.clear()
+        return count
+    
     def _compare_architectures(
         self,
         claude_result: Dict[str, Any],
@@ -398,16 +1143,49 @@ CRÍTICO:
             'recommendations': []
         }
         
+        claude_main = claude_result.get('site_structure', {}).get('main_sections', [])
+        openai_main = openai_result.get('site_structure', {}).get('main_sections', [])
+        
+        # Similitud de Jaccard entre los nombres de sección y entre las URLs:
+        # dos propuestas con el mismo número de secciones pueden ser distintas
+        section_similarity = self._jaccard(
+            self._section_values(claude_main, 'section_name'),
+            self._section_values(openai_main, 'section_name')
+        )
+        url_similarity = self._jaccard(
+            self._section_values(claude_main, 'url_structure'),
+            self._section_values(openai_main, 'url_structure')
+        )
+        comparison['section_similarity'] = section_similarity
+        comparison['url_similarity'] = url_similarity
+        
+        if section_similarity is not None:
+            if section_similarity <= 0.4:
+                comparison['agreement'] = 'low'
+            elif section_similarity <= 0.7:
+                comparison['agreement'] = 'medium'
+            
+            if comparison['agreement'] != 'high':
+                comparison['differences'].append(
+                    f"Solo el {section_similarity:.0%} de las secciones principales coincide"
+                )
+        
+        if url_similarity is not None and url_similarity <= 0.4:
+            comparison['differences'].append(
+                f"Solo el {url_similarity:.0%} de las URLs de sección coincide"
+            )
+        
         # Comparar número de secciones principales
-        claude_sections = len(claude_result.get('site_structure', {}).get('main_sections', []))
-        openai_sections = len(openai_result.get('site_structure', {}).get('main_sections', []))
+        claude_sections = len(claude_main)
+        openai_sections = len(openai_main)
         
         if abs(claude_sections - openai_sections) > 3:
             comparison['differences'].append(
                 f"Claude sugiere {claude_sections} secciones, "
                 f"OpenAI sugiere {openai_sections}"
             )
-            comparison['agreement'] = 'medium'
+            if comparison['agreement'] == 'high':
+                comparison['agreement'] = 'medium'
         
         # Comparar fases de implementación
         claude_phases = len(claude_result.get('implementation_roadmap', []))
@@ -433,46 +1211,75 @@ CRÍTICO:
         
         return comparison
     
+    @staticmethod
+    def _section_values(sections: List[Dict[str, Any]], field: str) -> set:
+        """Valores normalizados (minúsculas, sin espacios extremos) de un campo de las secciones"""
+        return {
+            str(section[field]).lower().strip()
+            for section in sections
+            if isinstance(section, dict) and section.get(field)
+        }
+    
+    @staticmethod
+    def _jaccard(first: set, second: set) -> Optional[float]:
+        """Similitud de Jaccard entre dos conjuntos (None si ambos están vacíos)"""
+        union = first | second
+        if not union:
+            return None
+        return len(first & second) / len(union)
+    
     def export_to_document(self, architecture: Dict[str, Any]) -> str:
         """Exporta la arquitectura a un documento markdown"""
         
-        doc = f"""# Arquitectura de Sitio Web
+        site_structure = architecture.get('site_structure', {})
+        
+        # Las partes se acumulan en una lista y se unen al final (lineal en
+        # el tamaño del documento, en lugar de concatenar con +=)
+        parts = [f"""# Arquitectura de Sitio Web
 
 {architecture.get('overview', '')}
 
 ## Estructura del Sitio
 
 ### Homepage
-{json.dumps(architecture.get('site_structure', {}).get('home', {}), indent=2)}
+{fast_json.dumps(site_structure.get('home', {}), indent=True)}
 
 ### Secciones Principales
-"""
+"""]
         
-        for section in architecture.get('site_structure', {}).get('main_sections', []):
-            doc += f"\n#### {section.get('section_name', 'N/A')}\n"
-            doc += f"- **URL:** {section.get('url_structure', 'N/A')}\n"
-            doc += f"- **Tipo:** {section.get('page_type', 'N/A')}\n"
-            doc += f"- **Prioridad:** {section.get('priority', 'N/A')}\n"
-            doc += f"- **Descripción:** {section.get('description', 'N/A')}\n"
+        # Un único bloque por sección y por fase en lugar de un append por línea
+        for section in site_structure.get('main_sections', []):
+            parts.append(
+                f"\n#### {section.get('section_name', 'N/A')}\n"
+                f"- **URL:** {section.get('url_structure', 'N/A')}\n"
+                f"- **Tipo:** {section.get('page_type', 'N/A')}\n"
+                f"- **Prioridad:** {section.get('priority', 'N/A')}\n"
+                f"- **Descripción:** {section.get('description', 'N/A')}\n"
+            )
             
-            if section.get('subsections'):
-                doc += "\n**Subsecciones:**\n"
-                for subsection in section['subsections']:
-                    doc += f"- {subsection.get('name', 'N/A')} ({subsection.get('url', 'N/A')})\n"
+            subsections = section.get('subsections')
+            if subsections:
+                parts.append("\n**Subsecciones:**\n")
+                parts.extend(
+                    f"- {subsection.get('name', 'N/A')} ({subsection.get('url', 'N/A')})\n"
+                    for subsection in subsections
+                )
         
-        doc += "\n## Navegación\n\n"
-        doc += json.dumps(architecture.get('navigation', {}), indent=2)
-        
-        doc += "\n\n## Estrategia de Contenido\n\n"
-        doc += json.dumps(architecture.get('content_strategy', {}), indent=2)
-        
-        doc += "\n\n## Roadmap de Implementación\n\n"
+        parts.append(
+            "\n## Navegación\n\n"
+            f"{fast_json.dumps(architecture.get('navigation', {}), indent=True)}"
+            "\n\n## Estrategia de Contenido\n\n"
+            f"{fast_json.dumps(architecture.get('content_strategy', {}), indent=True)}"
+            "\n\n## Roadmap de Implementación\n\n"
+        )
         
-        for phase in architecture.get('implementation_roadmap', []):
-            doc += f"\n### Fase {phase.get('phase', 0)}\n"
-            doc += f"- **Duración:** {phase.get('duration', 'N/A')}\n"
-            doc += f"- **Foco:** {phase.get('focus', 'N/A')}\n"
-            doc += f"- **Páginas a crear:** {phase.get('pages_to_create', 0)}\n"
-            doc += f"- **Esfuerzo estimado:** {phase.get('estimated_effort', 'N/A')}\n"
+        parts.extend(
+            f"\n### Fase {phase.get('phase', 0)}\n"
+            f"- **Duración:** {phase.get('duration', 'N/A')}\n"
+            f"- **Foco:** {phase.get('focus', 'N/A')}\n"
+            f"- **Páginas a crear:** {phase.get('pages_to_create', 0)}\n"
+            f"- **Esfuerzo estimado:** {phase.get('estimated_effort', 'N/A')}\n"
+            for phase in architecture.get('implementation_roadmap', [])
+        )
         
-        return doc
+        return "".join(parts)
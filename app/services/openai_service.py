@@ -3,26 +3,382 @@ Servicio para integración con OpenAI API
 Alternativa o complemento a Claude para análisis de keywords
 """
 
+import numpy as np
 import pandas as pd
+import asyncio
+import atexit
+import copy
+import functools
+import hashlib
+import heapq
+import importlib.util
 import json
-from typing import Dict, List, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Any, Callable, Optional, Tuple
+
+from app.utils import fast_json
+from app.utils.cache_manager import SemanticCache
+from app.utils.helpers import (
+    IncrementalArrayParser,
+    cached_top_volume_positions,
+    collapse_keyword_variants,
+    dataframe_fingerprint,
+    dataframe_memo,
+    decode_json_block,
+    extract_json_value,
+    extract_partial_array,
+    filter_by_keyword_index,
+    get_safe_columns,
+    keyword_index,
+    summarize_keyword_stats,
+    top_volume_csv,
+    top_volume_records
+)
+from app.utils.json_schema import (
+    SCHEMA_INTEGER,
+    SCHEMA_STRING,
+    SCHEMA_STRINGS,
+    response_format,
+    schema_array,
+    schema_enum,
+    schema_object,
+    supports_structured_outputs
+)
+from app.utils.rate_limiter import estimate_tokens
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, OpenAI, DefaultHttpxClient
 except ImportError:
     OpenAI = None
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    from config import CACHE_CONFIG
+except ImportError:
+    CACHE_CONFIG = {}
+
+
+# Reintentos del SDK ante 408/409/429/5xx y errores de conexión, con backoff
+# exponencial y jitter: un error transitorio no tira una llamada de 20 s
+MAX_RETRIES = 5
+
+# HTTP/2 solo si el paquete opcional h2 está instalado (pip install httpx[http2])
+_HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+@functools.lru_cache(maxsize=1)
+def _get_http_client():
+    """
+    Devuelve el cliente HTTP del proceso, compartido por todos los clientes
+    
+    Un único pool de conexiones keep-alive (HTTP/2 si está disponible) para
+    todas las API keys, en lugar del pool propio de cada cliente de OpenAI.
+    """
+    http_client = DefaultHttpxClient(http2=_HTTP2_AVAILABLE)
+    atexit.register(http_client.close)
+    return http_client
+
+
+@functools.lru_cache(maxsize=4)
+def _get_openai_client(api_key: str) -> "OpenAI":
+    """
+    Devuelve un cliente de OpenAI compartido por API key
+    
+    Reutilizar el cliente evita repetir el handshake TLS cada vez que se crea
+    un OpenAIService en un rerun de Streamlit.
+    """
+    return OpenAI(api_key=api_key, max_retries=MAX_RETRIES, http_client=_get_http_client())
+
+
+# Ventana de contexto (tokens) por prefijo de modelo, del más específico al
+# más general; los modelos desconocidos usan la de gpt-4o
+_CONTEXT_WINDOWS = (
+    ('gpt-4o', 128000),
+    ('gpt-4.1', 1047576),
+    ('gpt-4-turbo', 128000),
+    ('gpt-4', 8192),
+    ('gpt-3.5-turbo', 16385),
+)
+_DEFAULT_CONTEXT_WINDOW = 128000
+
+# Tokens reservados para el formato de los mensajes del chat
+_PROMPT_TOKENS_MARGIN = 512
+
+# Keywords máximas y mínimas del prompt de universo: si no cabe en el
+# contexto se recorta la tabla, pero no por debajo del mínimo
+_PROMPT_KEYWORDS = 1000
+_MIN_PROMPT_KEYWORDS = 50
+
+
+def _context_window(model: str) -> int:
+    """Ventana de contexto del modelo en tokens"""
+    for prefix, window in _CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return window
+    return _DEFAULT_CONTEXT_WINDOW
+
+
+@functools.lru_cache(maxsize=4)
+def _get_encoding(model: str):
+    """
+    Devuelve el tokenizador de tiktoken del modelo, o None si no está disponible
+    
+    La primera carga de cada codificación puede necesitar descargarla; si
+    falla se cuenta con la estimación de ~4 caracteres por token.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+    except Exception:
+        return None
+
+
+@functools.lru_cache(maxsize=16)
+def _count_text_tokens(model: str, text: str) -> int:
+    """
+    Cuenta los tokens de un texto para el modelo indicado
+    
+    Memoizado: el prompt se cuenta al construirlo y otra vez antes de
+    enviarlo, y el hash del string ya está calculado.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_prompt_tokens(messages: List[Dict[str, str]], model: str) -> int:
+    """
+    Cuenta los tokens de entrada de unos mensajes de chat
+    
+    Usa tiktoken si está instalado y, si no, la estimación de ~4 caracteres
+    por token del limitador de peticiones.
+    
+    Args:
+        messages: Mensajes del chat
+        model: Modelo de OpenAI al que se enviarán
+    
+    Returns:
+        Número de tokens del contenido de los mensajes
+    """
+    return sum(_count_text_tokens(model, message['content']) for message in messages)
+
+
+# Caché de respuestas: huella del modelo y los mensajes (que ya incluyen
+# stats, keywords y opciones) -> resultado enriquecido. Re-analizar el mismo
+# dataset con las mismas opciones no vuelve a llamar a la API
+RESPONSE_CACHE_TTL_SECONDS = 24 * 3600
+_RESPONSE_CACHE_SIZE = 32
+_response_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+# Caché breve de keywords por topic: (huella del DataFrame, modelo, topic)
+# -> keywords. Una llamada para varios topics deja en caché todos ellos, así
+# que get_topic_details de un topic ya pedido no repite la llamada
+TOPIC_DETAILS_CACHE_TTL_SECONDS = 600
+_TOPIC_DETAILS_CACHE_SIZE = 256
+_topic_details_cache: "OrderedDict[tuple, Tuple[float, List[str]]]" = OrderedDict()
+_topic_details_cache_lock = threading.Lock()
+
+
+# Instrucciones específicas por tipo de análisis (constantes: no se
+# reconstruyen en cada prompt)
+_DEFAULT_ANALYSIS_TYPE = "Temática (Topics)"
+_ANALYSIS_INSTRUCTIONS: Dict[str, str] = {
+    "Temática (Topics)": """
+Agrupa keywords por temas semánticos coherentes. Cada topic debe representar 
+un área temática clara. Busca patrones de co-ocurrencia y relevancia semántica.""",
+    
+    "Intención de búsqueda": """
+Clasifica keywords según la intención del usuario:
+- Informacional: Busca aprender (cómo, qué es, guía)
+- Navegacional: Busca un sitio específico (login, descargar, marca)
+- Comercial: Investiga antes de comprar (mejor, review, comparar)
+- Transaccional: Listo para actuar (comprar, precio, gratis)
+
+Dentro de cada intención, agrupa por sub-temas.""",
+    
+    "Funnel de conversión": """
+Clasifica keywords según la etapa del funnel:
+- TOFU (Top): Awareness - descubrimiento del problema
+- MOFU (Middle): Consideration - evaluación de soluciones  
+- BOFU (Bottom): Decision - listo para decidir
+
+Asigna tiers considerando el valor estratégico de cada etapa."""
+}
+
+_UNIVERSE_SYSTEM_MESSAGE = """Eres un experto en SEO y análisis estratégico de keywords. 
+Tu especialidad es identificar patrones, oportunidades y crear estrategias data-driven.
+Siempre respondes con JSON válido y análisis profundos."""
+
+# Secciones opcionales del esquema de respuesta en el prompt
+_UNIVERSE_GAPS_SECTION = """,
+    "gaps": [
+        {
+            "topic": "Nombre del gap/oportunidad",
+            "volume": 50000,
+            "keyword_count": 25,
+            "description": "Por qué es una oportunidad",
+            "difficulty": "low|medium|high"
+        }
+    ]"""
+
+_UNIVERSE_TRENDS_SECTION = """,
+    "trends": [
+        {
+            "trend": "Nombre de la tendencia",
+            "keywords": ["keyword1", "keyword2"],
+            "total_volume": 50000,
+            "insight": "Por qué es relevante"
+        }
+    ]"""
+
+# Topics de Claude que se envían a la validación cruzada: solo los de más
+# volumen y solo los campos que sirven para comparar clasificaciones
+_COMPARE_TOPICS_LIMIT = 20
+_COMPARE_TOPIC_FIELDS = ('topic', 'tier', 'priority', 'volume', 'keyword_count')
+
+
+def _topics_for_review(topics: List[Dict[str, Any]], limit: int = _COMPARE_TOPICS_LIMIT) -> List[Dict[str, Any]]:
+    """
+    Selecciona los topics de mayor volumen con sus campos esenciales
+    
+    Args:
+        topics: Topics del análisis a revisar
+        limit: Número máximo de topics
+    
+    Returns:
+        Lista de topics reducidos, ordenados por volumen descendente
+    """
+    def volume(topic: Dict[str, Any]) -> float:
+        try:
+            return float(topic.get('volume') or 0)
+        except (TypeError, ValueError):
+            return 0.0
+    
+    valid_topics = [topic for topic in topics or [] if isinstance(topic, dict)]
+    # heapq.nlargest es estable: en empates se respeta el orden del modelo
+    return [
+        {field: topic[field] for field in _COMPARE_TOPIC_FIELDS if field in topic}
+        for topic in heapq.nlargest(limit, valid_topics, key=volume)
+    ]
+
+
+# Caché semántica: similitud coseno mínima para reutilizar un análisis
+# (CACHE_SEMANTIC_TAU en config.py) y número máximo de análisis guardados
+SEMANTIC_CACHE_TAU = CACHE_CONFIG.get('semantic_tau', 0.87)
+SEMANTIC_CACHE_SIZE = 500
+# Keywords de mayor volumen que identifican el dataset en la consulta semántica
+_SEMANTIC_SIGNATURE_KEYWORDS = 50
+
+# Esquema del keyword universe (mismo formato que pide create_universe_prompt)
+_UNIVERSE_TOPIC_SCHEMA = schema_object(
+    topic=SCHEMA_STRING,
+    tier=SCHEMA_INTEGER,
+    keyword_count=SCHEMA_INTEGER,
+    volume=SCHEMA_INTEGER,
+    traffic=SCHEMA_INTEGER,
+    priority=schema_enum('high', 'medium', 'low'),
+    description=SCHEMA_STRING,
+    example_keywords=SCHEMA_STRINGS
+)
+_UNIVERSE_GAP_SCHEMA = schema_object(
+    topic=SCHEMA_STRING,
+    volume=SCHEMA_INTEGER,
+    keyword_count=SCHEMA_INTEGER,
+    description=SCHEMA_STRING,
+    difficulty=schema_enum('low', 'medium', 'high')
+)
+_UNIVERSE_TREND_SCHEMA = schema_object(
+    trend=SCHEMA_STRING,
+    keywords=SCHEMA_STRINGS,
+    total_volume=SCHEMA_INTEGER,
+    insight=SCHEMA_STRING
+)
+
+
+@functools.lru_cache(maxsize=4)
+def _universe_response_format(include_gaps: bool, include_trends: bool) -> Dict[str, Any]:
+    """
+    response_format estricto del keyword universe según las secciones pedidas
+    
+    Args:
+        include_gaps: Si la respuesta incluye la sección gaps
+        include_trends: Si la respuesta incluye la sección trends
+    
+    Returns:
+        Parámetro response_format para chat.completions
+    """
+    sections = {
+        'summary': SCHEMA_STRING,
+        'topics': schema_array(_UNIVERSE_TOPIC_SCHEMA)
+    }
+    if include_gaps:
+        sections['gaps'] = schema_array(_UNIVERSE_GAP_SCHEMA)
+    if include_trends:
+        sections['trends'] = schema_array(_UNIVERSE_TREND_SCHEMA)
+    
+    return response_format("keyword_universe", schema_object(**sections))
+
+
+def _with_topic_callback(
+    on_chunk: Optional[Callable[[str], None]],
+    on_topic: Optional[Callable[[Dict[str, Any]], None]]
+) -> Optional[Callable[[str], None]]:
+    """
+    Combina on_chunk con la entrega incremental de topics
+    
+    Cada fragmento del stream alimenta un IncrementalArrayParser sobre la
+    clave "topics", de modo que on_topic recibe cada topic en cuanto se
+    cierra su objeto en lugar de al terminar la respuesta.
+    """
+    if on_topic is None:
+        return on_chunk
+    
+    parser = IncrementalArrayParser('topics')
+    
+    def handle_chunk(text: str) -> None:
+        if on_chunk:
+            on_chunk(text)
+        for topic in parser.feed(text):
+            if isinstance(topic, dict):
+                on_topic(topic)
+    
+    return handle_chunk
+
 
 class OpenAIService:
     """Servicio para interactuar con la API de OpenAI"""
     
+    # Caché semántica compartida por todas las instancias: peticiones con las
+    # mismas opciones e instrucciones/keywords muy parecidas reutilizan el
+    # resultado (requiere sentence-transformers; si no, queda desactivada)
+    semantic_cache = SemanticCache(tau=SEMANTIC_CACHE_TAU, max_entries=SEMANTIC_CACHE_SIZE)
+    
     def __init__(self, api_key: str, model: str = "gpt-4o"):
         if OpenAI is None:
             raise ImportError("La librería 'openai' es requerida. Instala con: pip install openai")
         
-        self.client = OpenAI(api_key=api_key)
+        if not api_key:
+            raise ValueError("API key de OpenAI es requerida")
+        
+        self.client = _get_openai_client(api_key)
         self.model = model
         self.max_tokens = 16000 if model in ["gpt-4o", "gpt-4-turbo"] else 4096
+        # Tokens de entrada que caben junto con la respuesta en el contexto
+        self.prompt_token_budget = _context_window(model) - self.max_tokens - _PROMPT_TOKENS_MARGIN
+        self.last_prompt_tokens: Optional[int] = None
+        self.last_usage = None
+        self.last_finish_reason = None
     
     def create_universe_prompt(
         self,
@@ -37,49 +393,23 @@ class OpenAIService:
         """Crea los mensajes para OpenAI en formato chat"""
         
         # Preparar datos
-        top_keywords = df.nlargest(1000, 'volume')[['keyword', 'volume', 'traffic']].to_dict('records')
-        
-        stats = {
-            'total_keywords': len(df),
-            'total_volume': int(df['volume'].sum()),
-            'avg_volume': int(df['volume'].mean()),
-            'unique_keywords': df['keyword'].nunique()
-        }
-        
-        # Determinar tipo de análisis
-        analysis_instructions = self._get_analysis_instructions(analysis_type)
-        
-        # Secciones opcionales
-        gaps_section = ""
-        if include_gaps:
-            gaps_section = """,
-    "gaps": [
-        {
-            "topic": "Nombre del gap/oportunidad",
-            "volume": 50000,
-            "keyword_count": 25,
-            "description": "Por qué es una oportunidad",
-            "difficulty": "low|medium|high"
-        }
-    ]"""
+        columns = get_safe_columns(df, ['keyword', 'volume', 'traffic'])
         
-        trends_section = ""
-        if include_trends:
-            trends_section = """,
-    "trends": [
-        {
-            "trend": "Nombre de la tendencia",
-            "keywords": ["keyword1", "keyword2"],
-            "total_volume": 50000,
-            "insight": "Por qué es relevante"
-        }
-    ]"""
+        # sum, mean y nunique en una sola agregación, memorizado por DataFrame
+        stats = dataframe_memo(df, 'keyword_stats', lambda: summarize_keyword_stats(df))
         
-        system_message = """Eres un experto en SEO y análisis estratégico de keywords. 
-Tu especialidad es identificar patrones, oportunidades y crear estrategias data-driven.
-Siempre respondes con JSON válido y análisis profundos."""
+        # Primero la parte estática (tarea y formato, que solo dependen de las
+        # opciones) y al final los datos: OpenAI cachea automáticamente el
+        # prefijo común de más de 1024 tokens entre análisis
+        task_prompt = self._build_task_prompt(
+            analysis_type,
+            num_tiers,
+            include_semantic,
+            include_trends,
+            include_gaps
+        )
         
-        user_message = f"""Analiza las siguientes keywords y crea un "Keyword Universe" completo.
+        prompt_header = f"""{task_prompt}
 
 # CONTEXTO
 - Total keywords: {stats['total_keywords']:,}
@@ -87,6 +417,73 @@ Siempre respondes con JSON válido y análisis profundos."""
 - Volumen promedio: {stats['avg_volume']:,}
 - Keywords únicas: {stats['unique_keywords']:,}
 
+{custom_instructions}
+
+# KEYWORDS A ANALIZAR (CSV)
+"""
+        
+        # Top 1000 por volumen con selección parcial (argpartition), sin
+        # ordenar el DataFrame completo ni pasar por to_dict('records'), como
+        # tabla CSV: menos tokens que repetir los campos en cada registro JSON.
+        # Memorizado por DataFrame: re-analizar con otras opciones no vuelve a
+        # recorrer el dataset completo.
+        # Si el prompt no cabe en el contexto del modelo junto con la
+        # respuesta, se recorta la tabla en proporción al exceso en lugar de
+        # esperar a que la API lo rechace
+        num_keywords = _PROMPT_KEYWORDS
+        while True:
+            keywords_table = dataframe_memo(
+                df,
+                ('prompt_keywords', tuple(columns), num_keywords),
+                lambda: top_volume_csv(collapse_keyword_variants(df), num_keywords, columns)
+            )
+            messages = [
+                {"role": "system", "content": _UNIVERSE_SYSTEM_MESSAGE},
+                {"role": "user", "content": prompt_header + keywords_table}
+            ]
+            
+            self.last_prompt_tokens = count_prompt_tokens(messages, self.model)
+            if self.last_prompt_tokens <= self.prompt_token_budget or num_keywords <= _MIN_PROMPT_KEYWORDS:
+                return messages
+            
+            num_keywords = max(
+                _MIN_PROMPT_KEYWORDS,
+                int(num_keywords * 0.9 * self.prompt_token_budget / self.last_prompt_tokens)
+            )
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _build_task_prompt(
+        analysis_type: str,
+        num_tiers: int,
+        include_semantic: bool,
+        include_trends: bool,
+        include_gaps: bool
+    ) -> str:
+        """
+        Construye el bloque de tarea y formato del prompt de universo
+        
+        Solo depende de las opciones del análisis (no de los datos), así que
+        se memoiza: las combinaciones posibles son pocas.
+        
+        Args:
+            analysis_type: Tipo de análisis a realizar
+            num_tiers: Número de niveles de prioridad
+            include_semantic: Si incluir análisis semántico
+            include_trends: Si incluir detección de tendencias
+            include_gaps: Si incluir detección de gaps
+        
+        Returns:
+            Texto desde la tarea hasta el esquema JSON de la respuesta
+        """
+        analysis_instructions = _ANALYSIS_INSTRUCTIONS.get(
+            analysis_type, _ANALYSIS_INSTRUCTIONS[_DEFAULT_ANALYSIS_TYPE]
+        )
+        gaps_section = _UNIVERSE_GAPS_SECTION if include_gaps else ""
+        trends_section = _UNIVERSE_TRENDS_SECTION if include_trends else ""
+        
+        return f"""Analiza las keywords que aparecen al final y crea un "Keyword Universe" completo.
+
 # TIPO DE ANÁLISIS
 {analysis_type}
 
@@ -97,8 +494,6 @@ Crea un análisis con {num_tiers} tiers (niveles) de prioridad:
 - Tier 1: Alto volumen y máxima prioridad estratégica
 - Tier {num_tiers}: Menor volumen pero oportunidades específicas
 
-{custom_instructions}
-
 {"IMPORTANTE: Realiza análisis semántico profundo para entender la intención real detrás de cada keyword." if include_semantic else ""}
 {"IMPORTANTE: Identifica tendencias emergentes y keywords en crecimiento." if include_trends else ""}
 {"IMPORTANTE: Detecta gaps de contenido - topics con alto volumen pero poca cobertura competitiva." if include_gaps else ""}
@@ -122,46 +517,676 @@ Responde ÚNICAMENTE con un JSON válido con esta estructura:
     ]{gaps_section}{trends_section}
 }}
 
-# KEYWORDS A ANALIZAR
-{json.dumps(top_keywords[:1000], indent=2)}
-
 CRÍTICO: Responde SOLO con el JSON válido, sin texto adicional antes o después."""
-
-        return [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_message}
-        ]
     
-    def _get_analysis_instructions(self, analysis_type: str) -> str:
-        """Retorna instrucciones específicas según el tipo de análisis"""
+    def analyze_keywords(
+        self,
+        messages: List[Dict[str, str]],
+        df: pd.DataFrame,
+        on_progress: Optional[Callable[[int], None]] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        use_cache: bool = True,
+        on_topic: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **analysis_params
+    ) -> Dict[str, Any]:
+        """
+        Envía el prompt a OpenAI y procesa la respuesta
         
-        instructions = {
-            "Temática (Topics)": """
-Agrupa keywords por temas semánticos coherentes. Cada topic debe representar 
-un área temática clara. Busca patrones de co-ocurrencia y relevancia semántica.""",
+        La respuesta se recibe en streaming para poder informar del progreso
+        mientras se genera el JSON. El uso de tokens queda en self.last_usage.
+        Si los mismos mensajes ya se analizaron con este modelo dentro del
+        TTL, se devuelve el resultado cacheado sin llamar a la API.
+        
+        Args:
+            messages: Mensajes de create_universe_prompt
+            df: DataFrame original con las keywords
+            on_progress: Callback opcional que recibe los caracteres recibidos
+            on_chunk: Callback opcional que recibe cada fragmento de texto
+            use_cache: Si reutilizar respuestas cacheadas para los mismos mensajes
+            on_topic: Callback opcional que recibe cada topic en cuanto llega
+                completo, sin esperar al final de la respuesta
+            **analysis_params: Opciones del análisis; ya van incluidas en los
+                mensajes, aquí solo determinan las secciones del esquema de
+                respuesta (include_gaps, include_trends)
+        
+        Returns:
+            Diccionario con los resultados del análisis
+        """
+        cache_key, semantic_query, cached_result = self._lookup_analysis(messages, df, use_cache, analysis_params)
+        if cached_result is not None:
+            return cached_result
+        
+        try:
+            self._check_prompt_size(messages)
+            response_text, finish_reason = self._stream_completion_text(
+                messages,
+                on_progress,
+                _with_topic_callback(on_chunk, on_topic),
+                response_format=self._universe_response_format(analysis_params)
+            )
             
-            "Intención de búsqueda": """
-Clasifica keywords según la intención del usuario:
-- Informacional: Busca aprender (cómo, qué es, guía)
-- Navegacional: Busca un sitio específico (login, descargar, marca)
-- Comercial: Investiga antes de comprar (mejor, review, comparar)
-- Transaccional: Listo para actuar (comprar, precio, gratis)
-
-Dentro de cada intención, agrupa por sub-temas.""",
+            return self._finish_analysis(response_text, finish_reason, df, cache_key, semantic_query)
             
-            "Funnel de conversión": """
-Clasifica keywords según la etapa del funnel:
-- TOFU (Top): Awareness - descubrimiento del problema
-- MOFU (Middle): Consideration - evaluación de soluciones  
-- BOFU (Bottom): Decision - listo para decidir
-
-Asigna tiers considerando el valor estratégico de cada etapa."""
+        except Exception as e:
+            raise Exception(f"Error al analizar con OpenAI: {str(e)}")
+    
+    async def analyze_keywords_async(
+        self,
+        messages: List[Dict[str, str]],
+        df: pd.DataFrame,
+        client: "AsyncOpenAI",
+        on_progress: Optional[Callable[[int], None]] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        use_cache: bool = True,
+        on_topic: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **analysis_params
+    ) -> Dict[str, Any]:
+        """
+        Versión asíncrona de analyze_keywords con un cliente ya abierto
+        
+        Args:
+            messages: Mensajes de create_universe_prompt
+            df: DataFrame original con las keywords
+            client: Cliente AsyncOpenAI (ligado al event loop en curso)
+            on_progress: Callback opcional que recibe los caracteres recibidos
+            on_chunk: Callback opcional que recibe cada fragmento de texto
+            use_cache: Si reutilizar respuestas cacheadas para los mismos mensajes
+            on_topic: Callback opcional que recibe cada topic en cuanto llega
+                completo, sin esperar al final de la respuesta
+            **analysis_params: Opciones del análisis (ver analyze_keywords)
+        
+        Returns:
+            Diccionario con los resultados del análisis
+        """
+        cache_key, semantic_query, cached_result = self._lookup_analysis(messages, df, use_cache, analysis_params)
+        if cached_result is not None:
+            return cached_result
+        
+        try:
+            self._check_prompt_size(messages)
+            response_text, finish_reason = await self._stream_completion_text_async(
+                client,
+                messages,
+                on_progress,
+                _with_topic_callback(on_chunk, on_topic),
+                response_format=self._universe_response_format(analysis_params)
+            )
+            
+            return self._finish_analysis(response_text, finish_reason, df, cache_key, semantic_query)
+            
+        except Exception as e:
+            raise Exception(f"Error al analizar con OpenAI: {str(e)}")
+    
+    def analyze_many(self, requests: List[Dict[str, Any]], concurrency: int = 8) -> List[Any]:
+        """
+        Lanza varios análisis en paralelo (p. ej. varios tipos de análisis)
+        
+        Args:
+            requests: Lista de diccionarios con los argumentos de
+                analyze_keywords: messages, df y opcionalmente use_cache y
+                las opciones del análisis
+            concurrency: Máximo de peticiones simultáneas
+        
+        Returns:
+            Un resultado por petición, en el mismo orden; si una petición
+            falla su posición contiene la excepción en lugar del resultado
+        """
+        return asyncio.run(self._gather_analyses(requests, concurrency))
+    
+    async def _gather_analyses(self, requests: List[Dict[str, Any]], concurrency: int) -> List[Any]:
+        """
+        Lanza analyze_keywords_async para todas las peticiones con un semáforo
+        
+        Args:
+            requests: Argumentos de cada análisis
+            concurrency: Máximo de peticiones simultáneas
+        
+        Returns:
+            Resultados (o excepciones) en el orden de las peticiones
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        # El cliente asíncrono se liga al event loop, así que vive solo en esta ejecución
+        async with self._async_client() as async_client:
+            async def bounded(request: Dict[str, Any]) -> Dict[str, Any]:
+                async with semaphore:
+                    return await self.analyze_keywords_async(client=async_client, **request)
+            
+            return await asyncio.gather(
+                *(bounded(request) for request in requests),
+                return_exceptions=True
+            )
+    
+    def analyze_and_compare(
+        self,
+        messages: List[Dict[str, str]],
+        df: pd.DataFrame,
+        claude_result: Dict[str, Any],
+        use_cache: bool = True,
+        **analysis_params
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Analiza con OpenAI y valida el análisis de Claude a la vez
+        
+        La validación solo depende del resultado de Claude, así que las dos
+        llamadas se lanzan en paralelo en lugar de una tras otra.
+        
+        Args:
+            messages: Mensajes de create_universe_prompt
+            df: DataFrame original con las keywords
+            claude_result: Resultado del análisis de Claude
+            use_cache: Si reutilizar respuestas cacheadas para los mismos mensajes
+            **analysis_params: Opciones del análisis (ver analyze_keywords)
+        
+        Returns:
+            (resultado del análisis de OpenAI, comparación con Claude)
+        """
+        return asyncio.run(self._analyze_and_compare_async(
+            messages, df, claude_result, use_cache, analysis_params
+        ))
+    
+    async def _analyze_and_compare_async(
+        self,
+        messages: List[Dict[str, str]],
+        df: pd.DataFrame,
+        claude_result: Dict[str, Any],
+        use_cache: bool,
+        analysis_params: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Ejecuta analyze_keywords_async y compare_with_claude_async con un mismo cliente"""
+        async with self._async_client() as async_client:
+            result, comparison = await asyncio.gather(
+                self.analyze_keywords_async(messages, df, async_client, use_cache=use_cache, **analysis_params),
+                self.compare_with_claude_async(claude_result, df, async_client)
+            )
+        
+        return result, comparison
+    
+    def _async_client(self) -> "AsyncOpenAI":
+        """Cliente asíncrono con la misma API key (usar con async with)"""
+        return AsyncOpenAI(api_key=self.client.api_key, max_retries=MAX_RETRIES)
+    
+    def _lookup_analysis(
+        self,
+        messages: List[Dict[str, str]],
+        df: pd.DataFrame,
+        use_cache: bool,
+        analysis_params: Dict[str, Any]
+    ) -> Tuple[str, Optional[Tuple[str, str]], Optional[Dict[str, Any]]]:
+        """
+        Busca un análisis en las cachés exacta y semántica
+        
+        Returns:
+            (clave exacta, consulta semántica o None, resultado cacheado o None)
+        """
+        cache_key = self._response_cache_key(messages)
+        if not use_cache:
+            return cache_key, None, None
+        
+        cached_result = self._get_cached_response(cache_key)
+        if cached_result is not None:
+            return cache_key, None, cached_result
+        
+        # Sin coincidencia exacta: buscar un análisis casi idéntico
+        if not self.semantic_cache.available:
+            return cache_key, None, None
+        
+        semantic_query = self._semantic_query(df, analysis_params)
+        return cache_key, semantic_query, self.semantic_cache.get(*semantic_query)
+    
+    def _check_prompt_size(self, messages: List[Dict[str, str]]) -> None:
+        """
+        Comprueba que los mensajes caben en el contexto antes de enviarlos
+        
+        Raises:
+            ValueError: Si los tokens de entrada superan el presupuesto del modelo
+        """
+        prompt_tokens = count_prompt_tokens(messages, self.model)
+        if prompt_tokens > self.prompt_token_budget:
+            raise ValueError(
+                f"El prompt ocupa {prompt_tokens:,} tokens y {self.model} solo admite "
+                f"{self.prompt_token_budget:,} de entrada con {self.max_tokens:,} de respuesta"
+            )
+    
+    def _finish_analysis(
+        self,
+        response_text: str,
+        finish_reason: Optional[str],
+        df: pd.DataFrame,
+        cache_key: str,
+        semantic_query: Optional[Tuple[str, str]]
+    ) -> Dict[str, Any]:
+        """
+        Parsea, enriquece y cachea la respuesta de un análisis
+        
+        Args:
+            response_text: Texto completo de la respuesta
+            finish_reason: Motivo de parada de la respuesta
+            df: DataFrame original con las keywords
+            cache_key: Clave de la caché exacta
+            semantic_query: Consulta de la caché semántica, si se usó
+        
+        Returns:
+            Diccionario con los resultados del análisis
+        """
+        if not response_text.strip():
+            raise ValueError(f"OpenAI devolvió una respuesta vacía (finish_reason: {finish_reason})")
+        
+        # Parsear JSON
+        try:
+            result = fast_json.loads(response_text)
+        except json.JSONDecodeError:
+            # Decodificar el objeto JSON que empieza en la primera llave
+            result = decode_json_block(response_text)
+            # Un JSON cortado por max_tokens conserva los topics completos
+            if result is None and finish_reason == "length":
+                result = self._salvage_truncated_response(response_text)
+            if result is None:
+                raise ValueError("No se pudo extraer JSON válido de la respuesta")
+        
+        # Enriquecer resultados
+        result = self._enrich_results(result, df)
+        
+        # Una respuesta cortada por el límite de tokens no se reutiliza
+        if finish_reason != "length":
+            self._store_cached_response(cache_key, result)
+            if semantic_query is not None:
+                self.semantic_cache.set(*semantic_query, result)
+        
+        return result
+    
+    def _salvage_truncated_response(self, response_text: str) -> Optional[Dict[str, Any]]:
+        """
+        Reconstruye un resultado parcial a partir de una respuesta truncada
+        
+        Args:
+            response_text: Texto de la respuesta de OpenAI
+        
+        Returns:
+            Diccionario con los topics completos y truncated=True, o None si
+            no se pudo recuperar ningún topic
+        """
+        topics = extract_partial_array(response_text, 'topics')
+        if not topics:
+            return None
+        
+        result = {'topics': topics, 'truncated': True}
+        
+        summary = extract_json_value(response_text, 'summary')
+        if isinstance(summary, str):
+            result['summary'] = summary
+        
+        print(f"Warning: Respuesta de OpenAI truncada; se recuperaron {len(topics)} topics completos")
+        return result
+    
+    def _universe_response_format(self, analysis_params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Formato de respuesta del análisis para el modelo configurado
+        
+        Con structured outputs la API garantiza JSON conforme al esquema; los
+        modelos anteriores solo garantizan un objeto JSON (json_object).
+        """
+        if not supports_structured_outputs(self.model):
+            return {"type": "json_object"}
+        
+        return _universe_response_format(
+            bool(analysis_params.get('include_gaps', True)),
+            bool(analysis_params.get('include_trends', True))
+        )
+    
+    def _semantic_query(self, df: pd.DataFrame, analysis_params: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        Consulta de la caché semántica para un análisis
+        
+        Las opciones que cambian el formato o la tarea forman el espacio de
+        nombres (deben coincidir exactamente); las instrucciones adicionales y
+        las keywords de mayor volumen (ordenadas alfabéticamente, para que el
+        orden del fichero no importe) forman el texto que se compara.
+        
+        Args:
+            df: DataFrame con las keywords
+            analysis_params: Opciones del análisis
+        
+        Returns:
+            (espacio de nombres, texto de la consulta)
+        """
+        namespace = "|".join(str(value) for value in (
+            self.model,
+            analysis_params.get('analysis_type', _DEFAULT_ANALYSIS_TYPE),
+            analysis_params.get('num_tiers', 3),
+            bool(analysis_params.get('include_semantic', True)),
+            bool(analysis_params.get('include_trends', True)),
+            bool(analysis_params.get('include_gaps', True))
+        ))
+        
+        positions = cached_top_volume_positions(df, _SEMANTIC_SIGNATURE_KEYWORDS)
+        keywords = sorted(str(keyword) for keyword in df['keyword'].to_numpy()[positions])
+        text = f"{analysis_params.get('custom_instructions', '')}|{','.join(keywords)}"
+        
+        return namespace, text
+    
+    def _response_cache_key(self, messages: List[Dict[str, str]]) -> str:
+        """
+        Calcula la huella de una petición para la caché de respuestas
+        
+        Args:
+            messages: Mensajes del chat
+        
+        Returns:
+            Digest blake2b del modelo y los mensajes
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model.encode('utf-8'))
+        for message in messages:
+            digest.update(b'\x00')
+            digest.update(message['role'].encode('utf-8'))
+            digest.update(b'\x00')
+            digest.update(message['content'].encode('utf-8'))
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _get_cached_response(cache_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Devuelve una copia de la respuesta cacheada si no ha expirado
+        
+        Args:
+            cache_key: Huella calculada con _response_cache_key
+        
+        Returns:
+            Copia del resultado cacheado o None
+        """
+        with _response_cache_lock:
+            cached = _response_cache.get(cache_key)
+            if cached is None:
+                return None
+            if time.monotonic() - cached[0] > RESPONSE_CACHE_TTL_SECONDS:
+                del _response_cache[cache_key]
+                return None
+            _response_cache.move_to_end(cache_key)
+            result = cached[1]
+        
+        # Copia para que los cambios del llamante no alteren la caché
+        return copy.deepcopy(result)
+    
+    @staticmethod
+    def _store_cached_response(cache_key: str, result: Dict[str, Any]) -> None:
+        """
+        Guarda una copia de la respuesta en la caché LRU
+        
+        Args:
+            cache_key: Huella calculada con _response_cache_key
+            result: Resultado enriquecido
+        """
+        entry = (time.monotonic(), copy.deepcopy(result))
+        with _response_cache_lock:
+            _response_cache[cache_key] = entry
+            _response_cache.move_to_end(cache_key)
+            if len(_response_cache) > _RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+    
+    @classmethod
+    def clear_response_cache(cls) -> int:
+        """
+        Vacía la caché de respuestas de OpenAI (exacta y semántica)
+        
+        Returns:
+            Número de entradas eliminadas
+        """
+        with _response_cache_lock:
+            count = len(_response_cache)
+            _response_cache.clear()
+        return count + cls.semantic_cache.clear()
+    
+    def _completion_request(
+        self,
+        messages: List[Dict[str, str]],
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Parámetros de la petición de análisis en streaming"""
+        return {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": 0.3,
+            "response_format": response_format or {"type": "json_object"},
+            "stream": True,
+            "stream_options": {"include_usage": True}
         }
+    
+    def _read_chunk(self, chunk: Any) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Lee un chunk del stream y guarda el uso de tokens si lo trae
         
-        return instructions.get(analysis_type, instructions["Temática (Topics)"])
+        Returns:
+            (texto del chunk, finish_reason del chunk)
+        """
+        # El último chunk solo trae el uso de tokens, sin choices
+        if getattr(chunk, 'usage', None):
+            self.last_usage = chunk.usage
+        if not chunk.choices:
+            return None, None
+        
+        choice = chunk.choices[0]
+        text = choice.delta.content if choice.delta else None
+        return text, choice.finish_reason
     
-    def analyze_keywords(self, messages: List[Dict[str, str]], df: pd.DataFrame) -> Dict[str, Any]:
-        """Envía el prompt a OpenAI y procesa la respuesta"""
+    def _finish_stream(self, chunks: List[str], finish_reason: Optional[str]) -> Tuple[str, Optional[str]]:
+        """Registra el motivo de parada y une el texto recibido"""
+        self.last_finish_reason = finish_reason
+        if finish_reason == "length":
+            print(f"Warning: La respuesta de OpenAI alcanzó el límite de {self.max_tokens} tokens")
+        
+        return "".join(chunks), finish_reason
+    
+    def _stream_completion_text(
+        self,
+        messages: List[Dict[str, str]],
+        on_progress: Optional[Callable[[int], None]] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Envía los mensajes en modo streaming y acumula el texto de la respuesta
+        
+        Args:
+            messages: Mensajes del chat
+            on_progress: Callback opcional que recibe los caracteres recibidos
+            on_chunk: Callback opcional que recibe cada fragmento de texto
+            response_format: Formato de respuesta (json_object por defecto)
+        
+        Returns:
+            (texto completo de la respuesta, finish_reason)
+        """
+        chunks = []
+        received = 0
+        finish_reason = None
+        self.last_usage = None
+        
+        for chunk in self.client.chat.completions.create(**self._completion_request(messages, response_format)):
+            text, chunk_finish_reason = self._read_chunk(chunk)
+            finish_reason = chunk_finish_reason or finish_reason
+            if text:
+                chunks.append(text)
+                if on_chunk:
+                    on_chunk(text)
+                if on_progress:
+                    received += len(text)
+                    on_progress(received)
+        
+        return self._finish_stream(chunks, finish_reason)
+    
+    async def _stream_completion_text_async(
+        self,
+        client: "AsyncOpenAI",
+        messages: List[Dict[str, str]],
+        on_progress: Optional[Callable[[int], None]] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, Optional[str]]:
+        """Versión asíncrona de _stream_completion_text con el cliente indicado"""
+        chunks = []
+        received = 0
+        finish_reason = None
+        self.last_usage = None
+        
+        stream = await client.chat.completions.create(**self._completion_request(messages, response_format))
+        async for chunk in stream:
+            text, chunk_finish_reason = self._read_chunk(chunk)
+            finish_reason = chunk_finish_reason or finish_reason
+            if text:
+                chunks.append(text)
+                if on_chunk:
+                    on_chunk(text)
+                if on_progress:
+                    received += len(text)
+                    on_progress(received)
+        
+        return self._finish_stream(chunks, finish_reason)
+    
+    def _enrich_results(self, result: Dict, df: pd.DataFrame) -> Dict:
+        """
+        Enriquece los resultados con datos adicionales
+        
+        Los campos numéricos se normalizan de forma vectorizada sobre todos
+        los topics a la vez y después se escriben de vuelta en cada dict.
+        
+        Args:
+            result: Resultados crudos de OpenAI
+            df: DataFrame original con las keywords
+        
+        Returns:
+            Resultados enriquecidos
+        """
+        topics = [topic for topic in result.get('topics') or [] if isinstance(topic, dict)]
+        if not topics:
+            return result
+        
+        topics_df = pd.DataFrame(topics)
+        
+        def numeric_column(column: str, default: int) -> pd.Series:
+            if column not in topics_df.columns:
+                return pd.Series(default, index=topics_df.index, dtype='float64')
+            return pd.to_numeric(topics_df[column], errors='coerce').fillna(default)
+        
+        # Asegurar tipos correctos
+        keyword_count = numeric_column('keyword_count', 0).astype('int64').to_numpy()
+        volume = numeric_column('volume', 0).astype('int64').to_numpy()
+        traffic = numeric_column('traffic', 0).astype('int64').to_numpy()
+        tier = numeric_column('tier', 1).astype('int64').to_numpy()
+        
+        # Volumen medio por keyword (0 si no hay keywords)
+        avg_volume = np.divide(
+            volume,
+            keyword_count,
+            out=np.zeros(len(topics)),
+            where=keyword_count > 0
+        )
+        
+        for topic, kc, vol, tf, tr, avg in zip(
+            topics,
+            keyword_count.tolist(),
+            volume.tolist(),
+            traffic.tolist(),
+            tier.tolist(),
+            avg_volume.tolist()
+        ):
+            topic['keyword_count'] = kc
+            topic['volume'] = vol
+            topic['traffic'] = tf
+            topic['tier'] = tr
+            topic['avg_volume_per_keyword'] = avg
+        
+        return result
+    
+    def get_topic_details(self, topic_name: str, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Obtiene las keywords específicas de un topic usando OpenAI
+        
+        Args:
+            topic_name: Nombre del topic
+            df: DataFrame con todas las keywords
+        
+        Returns:
+            DataFrame filtrado con las keywords del topic
+        """
+        return self.get_topics_details([topic_name], df)[topic_name]
+    
+    def get_topics_details(self, topic_names: List[str], df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+        """
+        Obtiene las keywords de varios topics en una sola llamada a OpenAI
+        
+        La lista de keywords se envía una vez para todos los topics en lugar
+        de repetirla en una llamada por topic.
+        
+        Args:
+            topic_names: Nombres de los topics
+            df: DataFrame con todas las keywords
+        
+        Returns:
+            Diccionario topic -> DataFrame filtrado con sus keywords (vacío si
+            no se pudieron obtener)
+        """
+        if df.empty or not topic_names:
+            return {topic_name: pd.DataFrame() for topic_name in topic_names}
+        
+        fingerprint = dataframe_fingerprint(df)
+        keywords_by_topic = {}
+        pending = []
+        for topic_name in dict.fromkeys(topic_names):
+            cached = self._get_cached_topic_keywords((fingerprint, self.model, topic_name))
+            if cached is not None:
+                keywords_by_topic[topic_name] = cached
+            else:
+                pending.append(topic_name)
+        
+        if pending:
+            fetched = self._request_topics_keywords(pending, df)
+            for topic_name, keywords in fetched.items():
+                self._store_topic_keywords((fingerprint, self.model, topic_name), keywords)
+            keywords_by_topic.update(fetched)
+        
+        # Un único índice hash de keywords, memorizado por DataFrame, para
+        # filtrar todos los topics sin recorrer la columna en cada llamada
+        index = keyword_index(df)
+        return {
+            topic_name: filter_by_keyword_index(df, index, keywords_by_topic[topic_name])
+            if keywords_by_topic.get(topic_name) else pd.DataFrame()
+            for topic_name in topic_names
+        }
+    
+    def _request_topics_keywords(self, topic_names: List[str], df: pd.DataFrame) -> Dict[str, List[str]]:
+        """
+        Pide a OpenAI las keywords de cada topic
+        
+        Args:
+            topic_names: Topics sin resultado en caché
+            df: DataFrame con todas las keywords
+        
+        Returns:
+            Diccionario topic -> keywords para los topics que devolvió el modelo
+        """
+        # Limitar a 500 keywords para evitar exceder límites de tokens
+        sample_keywords = df['keyword'].to_numpy()[cached_top_volume_positions(df, 500)].tolist()
+        
+        messages = [
+            {
+                "role": "system",
+                "content": "Eres un experto en SEO que clasifica keywords por topic. Siempre respondes con JSON válido."
+            },
+            {
+                "role": "user",
+                "content": f"""Para cada uno de estos topics, selecciona de la lista las keywords que pertenecen a él.
+
+Keywords:
+{fast_json.dumps(sample_keywords)}
+
+Topics:
+{fast_json.dumps(topic_names)}
+
+Responde SOLO con un JSON cuyas claves sean exactamente los topics:
+{{"topic 1": ["keyword1", "keyword2"], "topic 2": ["keyword3"]}}"""
+            }
+        ]
         
         try:
             response = self.client.chat.completions.create(
@@ -171,50 +1196,53 @@ Asigna tiers considerando el valor estratégico de cada etapa."""
                 temperature=0.3,
                 response_format={"type": "json_object"}
             )
-            
-            # Extraer contenido
-            response_text = response.choices[0].message.content
-            
-            # Parsear JSON
-            try:
-                result = json.loads(response_text)
-            except json.JSONDecodeError:
-                # Intentar extraer JSON del texto
-                import re
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                else:
-                    raise ValueError("No se pudo extraer JSON válido de la respuesta")
-            
-            # Enriquecer resultados
-            result = self._enrich_results(result, df)
-            
-            return result
-            
+            result = fast_json.loads(response.choices[0].message.content)
         except Exception as e:
-            raise Exception(f"Error al analizar con OpenAI: {str(e)}")
+            print(f"Error obteniendo detalles de los topics {topic_names}: {str(e)}")
+            return {}
+        
+        return {
+            topic_name: keywords
+            for topic_name, keywords in result.items()
+            if topic_name in topic_names and isinstance(keywords, list)
+        }
     
-    def _enrich_results(self, result: Dict, df: pd.DataFrame) -> Dict:
-        """Enriquece los resultados con datos adicionales"""
-        
-        if 'topics' in result:
-            for topic in result['topics']:
-                # Asegurar tipos correctos
-                topic['keyword_count'] = int(topic.get('keyword_count', 0))
-                topic['volume'] = int(topic.get('volume', 0))
-                topic['traffic'] = int(topic.get('traffic', 0))
-                
-                # Calcular métricas adicionales
-                if topic['keyword_count'] > 0:
-                    topic['avg_volume_per_keyword'] = topic['volume'] / topic['keyword_count']
-                else:
-                    topic['avg_volume_per_keyword'] = 0
-                
-                # Asegurar que tier sea int
-                topic['tier'] = int(topic.get('tier', 1))
+    @staticmethod
+    def _get_cached_topic_keywords(cache_key: tuple) -> Optional[List[str]]:
+        """Devuelve las keywords cacheadas de un topic si no han expirado"""
         
-        return result
+        with _topic_details_cache_lock:
+            cached = _topic_details_cache.get(cache_key)
+            if cached is None:
+                return None
+            if time.monotonic() - cached[0] > TOPIC_DETAILS_CACHE_TTL_SECONDS:
+                del _topic_details_cache[cache_key]
+                return None
+            _topic_details_cache.move_to_end(cache_key)
+            return cached[1]
+    
+    @staticmethod
+    def _store_topic_keywords(cache_key: tuple, keywords: List[str]) -> None:
+        """Guarda las keywords de un topic en la caché LRU"""
+        
+        with _topic_details_cache_lock:
+            _topic_details_cache[cache_key] = (time.monotonic(), list(keywords))
+            _topic_details_cache.move_to_end(cache_key)
+            if len(_topic_details_cache) > _TOPIC_DETAILS_CACHE_SIZE:
+                _topic_details_cache.popitem(last=False)
+    
+    @staticmethod
+    def clear_topic_details_cache() -> int:
+        """
+        Vacía la caché de keywords por topic
+        
+        Returns:
+            Número de entradas eliminadas
+        """
+        with _topic_details_cache_lock:
+            count = len(_topic_details_cache)
+            _topic_details_cache.clear()
+        return count
     
     def compare_with_claude(
         self, 
@@ -231,6 +1259,35 @@ Asigna tiers considerando el valor estratégico de cada etapa."""
         Returns:
             Análisis comparativo y recomendaciones
         """
+        try:
+            response = self.client.chat.completions.create(
+                **self._comparison_request(claude_result, df)
+            )
+            
+            return fast_json.loads(response.choices[0].message.content)
+            
+        except Exception as e:
+            return self._comparison_error(e)
+    
+    async def compare_with_claude_async(
+        self,
+        claude_result: Dict[str, Any],
+        df: pd.DataFrame,
+        client: "AsyncOpenAI"
+    ) -> Dict[str, Any]:
+        """Versión asíncrona de compare_with_claude con un cliente ya abierto"""
+        try:
+            response = await client.chat.completions.create(
+                **self._comparison_request(claude_result, df)
+            )
+            
+            return fast_json.loads(response.choices[0].message.content)
+            
+        except Exception as e:
+            return self._comparison_error(e)
+    
+    def _comparison_request(self, claude_result: Dict[str, Any], df: pd.DataFrame) -> Dict[str, Any]:
+        """Parámetros de la petición de validación cruzada"""
         
         messages = [
             {
@@ -247,10 +1304,10 @@ Tu rol es identificar fortalezas, debilidades y oportunidades perdidas en análi
 3. **Mejoras sugeridas**: ¿Cómo mejorar la clasificación o priorización?
 
 ANÁLISIS A REVISAR:
-{json.dumps(claude_result.get('topics', [])[:20], indent=2)}
+{fast_json.dumps(_topics_for_review(claude_result.get('topics', [])))}
 
 KEYWORDS DISPONIBLES (muestra):
-{json.dumps(df.nlargest(200, 'volume')[['keyword', 'volume']].to_dict('records'), indent=2)}
+{fast_json.dumps(top_volume_records(df, 200, ['keyword', 'volume'], cached=True))}
 
 Responde en JSON:
 {{
@@ -263,22 +1320,21 @@ Responde en JSON:
             }
         ]
         
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=2000,
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            return json.loads(response.choices[0].message.content)
-            
-        except Exception as e:
-            print(f"Error en comparación: {str(e)}")
-            return {
-                "validation": "No se pudo completar la validación cruzada",
-                "missing_topics": [],
-                "improvements": [],
-                "error": str(e)
-            }
+        return {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": 2000,
+            "temperature": 0.3,
+            "response_format": {"type": "json_object"}
+        }
+    
+    @staticmethod
+    def _comparison_error(error: Exception) -> Dict[str, Any]:
+        """Resultado de una validación cruzada que no se pudo completar"""
+        print(f"Error en comparación: {str(error)}")
+        return {
+            "validation": "No se pudo completar la validación cruzada",
+            "missing_topics": [],
+            "improvements": [],
+            "error": str(error)
+        }
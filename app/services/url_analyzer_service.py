@@ -7,20 +7,68 @@ import requests
 import pandas as pd
 from typing import List, Dict, Optional, Tuple
 from urllib.parse import urlparse, urljoin
-import time
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
+import hashlib
 import re
+import threading
+import time
+from collections import OrderedDict
+
+from app.utils.helpers import downcast_numeric
+from app.utils.rate_limiter import RateLimiter
+
+# Caché LRU en memoria de análisis por URL, compartido entre instancias.
+# Clave: (url, use_semrush, scrape_content, hash de la API key)
+URL_CACHE_TTL_SECONDS = 3600
+_URL_CACHE_SIZE = 1024
+_url_analysis_cache: "OrderedDict[tuple, Tuple[float, Dict]]" = OrderedDict()
+_url_analysis_cache_lock = threading.Lock()
 
 
 class URLAnalyzerService:
     """Servicio para analizar URLs y directorios de un sitio"""
     
+    # Semrush admite 10 peticiones por segundo (sin límite de tokens); el
+    # limitador se comparte entre instancias e hilos del proceso
+    semrush_rate_limiter = RateLimiter(rpm=10, tpm=0, window_seconds=1.0)
+    
     def __init__(self, semrush_api_key: Optional[str] = None):
         self.semrush_api_key = semrush_api_key
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
+        # Se cachea por hash de la key (nunca la key en claro) para que
+        # rotarla invalide los resultados anteriores
+        self._semrush_key_hash = (
+            hashlib.sha256(semrush_api_key.encode()).hexdigest()[:16]
+            if semrush_api_key else ""
+        )
+        # requests.Session no es segura entre hilos: una por hilo del pool
+        self._local = threading.local()
+    
+    @property
+    def session(self) -> requests.Session:
+        """Sesión HTTP del hilo actual (conexiones reutilizadas dentro del hilo)"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            })
+            self._local.session = session
+        return session
+    
+    def _semrush_get(self, params: Dict, timeout: int = 30) -> requests.Response:
+        """
+        Petición a la API de Semrush respetando su límite de peticiones
+        
+        Args:
+            params: Parámetros de la consulta (incluida la key)
+            timeout: Segundos máximos de espera
+        
+        Returns:
+            Respuesta HTTP
+        """
+        self.semrush_rate_limiter.acquire()
+        return self.session.get("https://api.semrush.com/", params=params, timeout=timeout)
     
     def analyze_url_with_semrush(
         self, 
@@ -50,11 +98,7 @@ class URLAnalyzerService:
                 'export_columns': 'Ph,Po,Nq,Cp,Co,Tr,Tc,Ur'
             }
             
-            response = requests.get(
-                "https://api.semrush.com/",
-                params=params,
-                timeout=30
-            )
+            response = self._semrush_get(params)
             response.raise_for_status()
             
             lines = response.text.strip().split('\n')
@@ -128,11 +172,7 @@ class URLAnalyzerService:
                 'display_filter': f'+|Ur|Co|{directory}'
             }
             
-            response = requests.get(
-                "https://api.semrush.com/",
-                params=params,
-                timeout=30
-            )
+            response = self._semrush_get(params)
             response.raise_for_status()
             
             lines = response.text.strip().split('\n')
@@ -294,59 +334,147 @@ class URLAnalyzerService:
                 'error': str(e)
             }
     
+    def _analyze_single_url(
+        self,
+        url: str,
+        use_semrush: bool = True,
+        scrape_content: bool = True
+    ) -> Dict:
+        """
+        Analiza una URL (keywords de Semrush y/o contenido de la página)
+        
+        Returns:
+            Dict con las métricas de la URL
+        """
+        cache_key = (url, use_semrush, scrape_content, self._semrush_key_hash)
+        now = time.monotonic()
+        
+        with _url_analysis_cache_lock:
+            cached = _url_analysis_cache.get(cache_key)
+            if cached is not None:
+                if now - cached[0] < URL_CACHE_TTL_SECONDS:
+                    _url_analysis_cache.move_to_end(cache_key)
+                    return dict(cached[1])
+                del _url_analysis_cache[cache_key]
+        
+        result = self._fetch_url_analysis(url, use_semrush, scrape_content)
+        
+        # No cachear resultados con errores para reintentarlos en la próxima ejecución
+        if not any(key.startswith('error') for key in result):
+            self._store_url_analysis(cache_key, result)
+        
+        return result
+    
+    @staticmethod
+    def _store_url_analysis(cache_key: tuple, result: Dict) -> None:
+        """
+        Guarda un análisis en la caché LRU
+        
+        Antes de insertar se descartan las entradas caducadas; si aun así se
+        supera _URL_CACHE_SIZE se expulsan las menos usadas recientemente.
+        
+        Args:
+            cache_key: (url, use_semrush, scrape_content, hash de la API key)
+            result: Análisis de la URL
+        """
+        now = time.monotonic()
+        with _url_analysis_cache_lock:
+            expired = [
+                key for key, (stored_at, _) in _url_analysis_cache.items()
+                if now - stored_at >= URL_CACHE_TTL_SECONDS
+            ]
+            for key in expired:
+                del _url_analysis_cache[key]
+            
+            _url_analysis_cache[cache_key] = (now, dict(result))
+            _url_analysis_cache.move_to_end(cache_key)
+            while len(_url_analysis_cache) > _URL_CACHE_SIZE:
+                _url_analysis_cache.popitem(last=False)
+    
+    def _fetch_url_analysis(
+        self,
+        url: str,
+        use_semrush: bool,
+        scrape_content: bool
+    ) -> Dict:
+        """Obtiene el análisis de una URL sin pasar por la caché"""
+        result = {'url': url}
+        
+        # Obtener keywords con Semrush
+        if use_semrush and self.semrush_api_key:
+            try:
+                keywords_df = self.analyze_url_with_semrush(url)
+                
+                result['total_keywords'] = len(keywords_df)
+                result['total_volume'] = keywords_df['volume'].sum()
+                result['total_traffic'] = keywords_df['traffic'].sum()
+                result['avg_position'] = keywords_df['position'].mean()
+                result['top_keywords'] = ', '.join(keywords_df.nlargest(5, 'volume')['keyword'].tolist())
+                
+            except Exception as e:
+                result['total_keywords'] = 0
+                result['error_semrush'] = str(e)
+        
+        # Scrape contenido
+        if scrape_content:
+            try:
+                content = self.scrape_page_content(url)
+                result.update(content)
+            except Exception as e:
+                result['error_scrape'] = str(e)
+        
+        return result
+    
+    @staticmethod
+    def clear_url_cache() -> int:
+        """
+        Vacía la caché de análisis por URL
+        
+        Returns:
+            Número de entradas eliminadas
+        """
+        with _url_analysis_cache_lock:
+            count = len(_url_analysis_cache)
+            _url_analysis_cache.clear()
+        return count
+    
     def analyze_multiple_urls(
         self,
         urls: List[str],
         use_semrush: bool = True,
-        scrape_content: bool = True
+        scrape_content: bool = True,
+        max_workers: int = 5
     ) -> pd.DataFrame:
         """
-        Analiza múltiples URLs
+        Analiza múltiples URLs en paralelo
+        
+        Las peticiones son I/O (Semrush + scraping), así que se reparten en
+        un pool de hilos acotado en vez de ir una a una. Cada hilo usa su
+        propia sesión HTTP y las llamadas a Semrush pasan por el limitador
+        compartido. Las URLs ya analizadas en la última hora se sirven desde
+        caché.
         
         Args:
             urls: Lista de URLs a analizar
             use_semrush: Si usar Semrush para obtener keywords
             scrape_content: Si extraer contenido de las páginas
+            max_workers: Máximo de URLs analizadas a la vez (rate limiting)
         
         Returns:
-            DataFrame con análisis completo
+            DataFrame con análisis completo (en el mismo orden que urls)
         """
-        results = []
+        if not urls:
+            return pd.DataFrame()
         
-        for i, url in enumerate(urls):
+        def analyze(indexed_url):
+            i, url = indexed_url
             print(f"Analizando {i+1}/{len(urls)}: {url}")
-            
-            result = {'url': url}
-            
-            # Obtener keywords con Semrush
-            if use_semrush and self.semrush_api_key:
-                try:
-                    keywords_df = self.analyze_url_with_semrush(url)
-                    
-                    result['total_keywords'] = len(keywords_df)
-                    result['total_volume'] = keywords_df['volume'].sum()
-                    result['total_traffic'] = keywords_df['traffic'].sum()
-                    result['avg_position'] = keywords_df['position'].mean()
-                    result['top_keywords'] = ', '.join(keywords_df.nlargest(5, 'volume')['keyword'].tolist())
-                    
-                except Exception as e:
-                    result['total_keywords'] = 0
-                    result['error_semrush'] = str(e)
-            
-            # Scrape contenido
-            if scrape_content:
-                try:
-                    content = self.scrape_page_content(url)
-                    result.update(content)
-                except Exception as e:
-                    result['error_scrape'] = str(e)
-            
-            results.append(result)
-            
-            # Rate limiting
-            time.sleep(1)
+            return self._analyze_single_url(url, use_semrush, scrape_content)
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls)))) as executor:
+            results = list(executor.map(analyze, enumerate(urls)))
         
-        return pd.DataFrame(results)
+        return downcast_numeric(pd.DataFrame(results))
     
     def detect_cannibalization(
         self,
@@ -376,7 +504,7 @@ class URLAnalyzerService:
             'export_columns': 'Ph,Ur'
         }
         
-        response = requests.get("https://api.semrush.com/", params=params)
+        response = self._semrush_get(params)
         lines = response.text.strip().split('\n')
         
         if len(lines) < 2:
@@ -413,9 +541,11 @@ class URLAnalyzerService:
                         'common_keywords': ', '.join(list(common)[:10])
                     })
         
-        return pd.DataFrame(cannibalization).sort_values(
-            'common_keywords_count', 
-            ascending=False
+        return downcast_numeric(
+            pd.DataFrame(cannibalization).sort_values(
+                'common_keywords_count', 
+                ascending=False
+            )
         )
     
     def compare_directories(
@@ -456,4 +586,4 @@ class URLAnalyzerService:
                 print(f"Error con {directory}: {str(e)}")
                 continue
         
-        return pd.DataFrame(results)
+        return downcast_numeric(pd.DataFrame(results))
@@ -13,6 +13,8 @@ from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
 import pandas as pd
 
+from app.utils import fast_json
+
 
 class AnalysisCache:
     """Gestiona caché de análisis para evitar gastos innecesarios de API"""
@@ -106,8 +108,7 @@ class AnalysisCache:
         
         # Leer caché
         try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                cached_data = json.load(f)
+            cached_data = fast_json.loads(cache_file.read_bytes())
             
             print(f"✅ Resultado encontrado en caché (guardado hace {file_age})")
             return cached_data
@@ -149,8 +150,7 @@ class AnalysisCache:
         
         # Guardar
         try:
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cached_data, f, indent=2, ensure_ascii=False)
+            cache_file.write_text(fast_json.dumps(cached_data, indent=True), encoding='utf-8')
             
             print(f"💾 Resultado guardado en caché: {cache_key}")
             
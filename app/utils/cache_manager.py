@@ -2,13 +2,25 @@
 Gestor de caché para análisis de keywords
 """
 
+import copy
 import json
 import os
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Callable, Dict, List, Optional, Any
 import hashlib
 
+import numpy as np
+
+from app.utils import fast_json
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
 
 class CacheManager:
     """Gestiona el caché de análisis de keywords"""
@@ -47,8 +59,7 @@ class CacheManager:
             return None
         
         try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                cached_data = json.load(f)
+            cached_data = fast_json.loads(cache_file.read_bytes())
             
             # Verificar si expiró
             cached_time = datetime.fromisoformat(cached_data['timestamp'])
@@ -83,8 +94,7 @@ class CacheManager:
                 'data': data
             }
             
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, indent=2, ensure_ascii=False)
+            cache_file.write_text(fast_json.dumps(cache_data, indent=True), encoding='utf-8')
             
             return True
             
@@ -107,8 +117,7 @@ class CacheManager:
         try:
             for cache_file in self.cache_dir.glob("*.json"):
                 try:
-                    with open(cache_file, 'r', encoding='utf-8') as f:
-                        cached_data = json.load(f)
+                    cached_data = fast_json.loads(cache_file.read_bytes())
                     
                     # Verificar si expiró
                     cached_time = datetime.fromisoformat(cached_data['timestamp'])
@@ -204,8 +213,7 @@ class CacheManager:
         try:
             for cache_file in self.cache_dir.glob("*.json"):
                 try:
-                    with open(cache_file, 'r', encoding='utf-8') as f:
-                        cached_data = json.load(f)
+                    cached_data = fast_json.loads(cache_file.read_bytes())
                     
                     cached_time = datetime.fromisoformat(cached_data['timestamp'])
                     if datetime.now() - cached_time > self.ttl:
@@ -238,8 +246,7 @@ class CacheManager:
             
             for cache_file in cache_files:
                 try:
-                    with open(cache_file, 'r', encoding='utf-8') as f:
-                        cached_data = json.load(f)
+                    cached_data = fast_json.loads(cache_file.read_bytes())
                     
                     cached_time = datetime.fromisoformat(cached_data['timestamp'])
                     if datetime.now() - cached_time > self.ttl:
@@ -316,3 +323,194 @@ def get_cache_manager(cache_dir: str = "data/cache", ttl_hours: int = 24) -> Cac
         _cache_manager_instance = CacheManager(cache_dir, ttl_hours)
     
     return _cache_manager_instance
+
+
+class SemanticCache:
+    """
+    Caché en memoria por similitud semántica entre peticiones
+    
+    Cada entrada guarda el embedding normalizado de un texto de consulta y su
+    resultado. Una consulta nueva devuelve el resultado de la entrada más
+    parecida (similitud coseno >= tau) dentro de su mismo espacio de nombres,
+    con un único producto matriz-vector sobre todos los embeddings.
+    """
+    
+    DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+    
+    # Embeddings recientes por texto: la consulta de get se repite en el set
+    # posterior y en cada re-análisis del mismo dataset
+    EMBEDDING_MEMO_SIZE = 64
+    
+    def __init__(
+        self,
+        tau: float = 0.87,
+        max_entries: int = 500,
+        embed: Optional[Callable[[str], np.ndarray]] = None
+    ):
+        """
+        Inicializa la caché semántica
+        
+        Args:
+            tau: Similitud coseno mínima para considerar un acierto
+            max_entries: Entradas máximas (se expulsa la usada hace más tiempo)
+            embed: Función texto -> vector; por defecto all-MiniLM-L6-v2 de
+                sentence-transformers, cargado en el primer uso
+        """
+        self.tau = tau
+        self.max_entries = max_entries
+        self._embed = embed
+        self._model = None
+        self._failed = False
+        self._lock = threading.Lock()
+        # Matriz de embeddings preasignada (max_entries filas) y, por entrada,
+        # el id entero de su espacio de nombres y el último uso
+        self._embeddings: Optional[np.ndarray] = None
+        self._entry_namespaces = np.zeros(max_entries, dtype=np.int32)
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._namespace_ids: Dict[str, int] = {}
+        self._results: List[Dict[str, Any]] = []
+        self._clock = 0
+        self._embedding_memo: "OrderedDict[str, np.ndarray]" = OrderedDict()
+    
+    @property
+    def available(self) -> bool:
+        """Si hay una función de embedding (propia o sentence-transformers)"""
+        return not self._failed and (self._embed is not None or SentenceTransformer is not None)
+    
+    def _embedding(self, text: str) -> Optional[np.ndarray]:
+        """
+        Embedding normalizado (norma 1) de un texto
+        
+        Returns:
+            Vector normalizado, o None si no se pudo calcular (la caché
+            queda desactivada en lugar de romper el análisis)
+        """
+        with self._lock:
+            memoized = self._embedding_memo.get(text)
+            if memoized is not None:
+                self._embedding_memo.move_to_end(text)
+                return memoized
+        
+        try:
+            if self._embed is not None:
+                vector = self._embed(text)
+            else:
+                if self._model is None:
+                    self._model = SentenceTransformer(self.DEFAULT_MODEL)
+                vector = self._model.encode(text)
+        except Exception as e:
+            print(f"Caché semántica desactivada: {e}")
+            self._failed = True
+            return None
+        
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(vector))
+        if norm:
+            vector = vector / norm
+        vector.flags.writeable = False
+        
+        with self._lock:
+            self._embedding_memo[text] = vector
+            if len(self._embedding_memo) > self.EMBEDDING_MEMO_SIZE:
+                self._embedding_memo.popitem(last=False)
+        
+        return vector
+    
+    def get(self, namespace: str, text: str) -> Optional[Dict[str, Any]]:
+        """
+        Busca el resultado de la consulta más parecida
+        
+        Args:
+            namespace: Parámetros que deben coincidir exactamente (modelo,
+                tipo de análisis...)
+            text: Texto de la consulta, comparado por similitud
+        
+        Returns:
+            Copia del resultado cacheado o None si no hay ninguno por encima de tau
+        """
+        if not self.available:
+            return None
+        
+        with self._lock:
+            if not self._results or namespace not in self._namespace_ids:
+                return None
+        
+        embedding = self._embedding(text)
+        if embedding is None:
+            return None
+        
+        with self._lock:
+            size = len(self._results)
+            namespace_id = self._namespace_ids.get(namespace)
+            if not size or namespace_id is None:
+                return None
+            
+            similarities = self._embeddings[:size] @ embedding
+            similarities[self._entry_namespaces[:size] != namespace_id] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.tau:
+                return None
+            
+            self._clock += 1
+            self._last_used[best] = self._clock
+            result = self._results[best]
+        
+        # Copia para que los cambios del llamante no alteren la caché
+        return copy.deepcopy(result)
+    
+    def set(self, namespace: str, text: str, result: Dict[str, Any]) -> None:
+        """
+        Guarda un resultado asociado al embedding de la consulta
+        
+        Args:
+            namespace: Parámetros que deben coincidir exactamente
+            text: Texto de la consulta
+            result: Resultado a reutilizar
+        """
+        if not self.available:
+            return
+        
+        embedding = self._embedding(text)
+        if embedding is None:
+            return
+        entry = copy.deepcopy(result)
+        
+        with self._lock:
+            self._clock += 1
+            namespace_id = self._namespace_ids.setdefault(namespace, len(self._namespace_ids))
+            
+            # Se escribe en la fila libre o, si está llena, en la usada hace
+            # más tiempo, sin volver a copiar la matriz en cada inserción
+            if self._embeddings is None:
+                self._embeddings = np.empty((self.max_entries, embedding.size), dtype=np.float32)
+            
+            if len(self._results) < self.max_entries:
+                slot = len(self._results)
+                self._results.append(entry)
+            else:
+                slot = int(np.argmin(self._last_used))
+                self._results[slot] = entry
+            
+            self._embeddings[slot] = embedding
+            self._entry_namespaces[slot] = namespace_id
+            self._last_used[slot] = self._clock
+    
+    def clear(self) -> int:
+        """
+        Vacía la caché
+        
+        Returns:
+            Número de entradas eliminadas
+        """
+        with self._lock:
+            removed = len(self._results)
+            self._embeddings = None
+            self._entry_namespaces[:] = 0
+            self._last_used[:] = 0
+            self._namespace_ids = {}
+            self._results = []
+            self._embedding_memo.clear()
+        return removed
+    
+    def __len__(self) -> int:
+        return len(self._results)
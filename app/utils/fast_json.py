@@ -0,0 +1,60 @@
+"""
+Serialización JSON rápida para prompts y respuestas de los LLM
+
+Usa orjson (extensión en C) si está instalado y, si no, la librería
+estándar json con un resultado equivalente.
+"""
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    Parsea un documento JSON
+    
+    Args:
+        data: Texto o bytes JSON
+    
+    Returns:
+        Objeto Python equivalente
+    
+    Raises:
+        json.JSONDecodeError: Si el JSON no es válido (orjson.JSONDecodeError
+            hereda de esta clase, así que se captura igual)
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False) -> str:
+    """
+    Serializa un objeto a JSON sin escapar caracteres no ASCII
+    
+    Args:
+        obj: Objeto a serializar
+        indent: Si indentar con 2 espacios (por defecto JSON compacto)
+    
+    Returns:
+        String JSON
+    """
+    if orjson is not None:
+        try:
+            # OPT_NON_STR_KEYS acepta claves int/float como hace json.dumps
+            option = orjson.OPT_NON_STR_KEYS
+            if indent:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, option=option).decode('utf-8')
+        except TypeError:
+            # Tipos que orjson no soporta: usar la librería estándar
+            pass
+    
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
@@ -1,8 +1,37 @@
 import pandas as pd
+import numpy as np
+import csv
+import hashlib
 import io
-from typing import Dict, Any, List
+import re
+import threading
+import weakref
+from typing import Callable, Dict, Any, Hashable, List, Optional
 from datetime import datetime
 import json
+from app.utils import fast_json
+
+# Tokens relevantes al buscar un objeto JSON en texto libre: un string
+# completo (se salta entero), una llave, o una comilla sin cerrar
+_JSON_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]|"', re.DOTALL)
+
+# Separadores entre elementos de un array JSON
+_JSON_ARRAY_SEPARATOR_RE = re.compile(r'[\s,]*')
+
+_JSON_DECODER = json.JSONDecoder()
+
+# Resultados derivados de cada DataFrame vivo (id -> {clave: valor}), para no
+# repetir selecciones y agregaciones entre prompt, comparación y detalles
+_dataframe_memos: Dict[int, Dict[Hashable, Any]] = {}
+_dataframe_memos_lock = threading.Lock()
+
+# Filas de mayor volumen que se memorizan por DataFrame; selecciones menores
+# se sirven como prefijo
+_MEMO_TOP_N = 1000
+
+# Normalización de keywords: marcas diacríticas tras NFKD y espacios repetidos
+_COMBINING_MARKS_RE = re.compile(r'[\u0300-\u036f]')
+_WHITESPACE_RE = re.compile(r'\s+')
 
 def export_to_excel(keyword_universe: Dict[str, Any], include_visuals: bool = True) -> bytes:
     """
@@ -291,10 +320,7 @@ def _estimate_effort(topic: pd.Series) -> str:
 def export_to_json(keyword_universe: Dict[str, Any], pretty: bool = True) -> str:
     """Exporta el keyword universe a JSON"""
     
-    if pretty:
-        return json.dumps(keyword_universe, indent=2, ensure_ascii=False)
-    else:
-        return json.dumps(keyword_universe, ensure_ascii=False)
+    return fast_json.dumps(keyword_universe, indent=pretty)
 
 
 def validate_dataframe(df: pd.DataFrame) -> Dict[str, Any]:
@@ -417,3 +443,557 @@ def safe_preview_dataframe(df: pd.DataFrame, n: int = 20) -> pd.DataFrame:
         available_columns = df.columns.tolist()
     
     return df[available_columns].head(n)
+
+
+def top_volume_positions(df: pd.DataFrame, n: int) -> np.ndarray:
+    """
+    Devuelve las posiciones de las n filas con mayor volumen, de mayor a menor
+    
+    Usa np.argpartition (O(N)) para hallar el volumen de corte y solo ordena
+    las n posiciones seleccionadas, en vez de ordenar el DataFrame completo.
+    En empates (los volúmenes de Semrush van por tramos) devuelve las mismas
+    filas y en el mismo orden que nlargest(n, 'volume', keep='first').
+    
+    Args:
+        df: DataFrame con columna 'volume'
+        n: Número de filas a seleccionar
+    
+    Returns:
+        Array de posiciones (para iloc o para indexar arrays de columnas)
+    """
+    n = min(n, len(df))
+    if n <= 0:
+        return np.arange(0)
+    
+    volumes = pd.to_numeric(df['volume'], errors='coerce').to_numpy(dtype=float)
+    volumes = np.where(np.isnan(volumes), -np.inf, volumes)
+    
+    if n < len(volumes):
+        # argpartition elige filas arbitrarias entre los empates del corte:
+        # se toman todas las que lo superan y las primeras iguales al corte
+        threshold = volumes[np.argpartition(-volumes, n - 1)[n - 1]]
+        above = np.flatnonzero(volumes > threshold)
+        tied = np.flatnonzero(volumes == threshold)[:n - len(above)]
+        top_idx = np.concatenate((above, tied))
+    else:
+        top_idx = np.arange(len(volumes))
+    
+    # Orden estable: en empates se respeta el orden original (como nlargest)
+    return top_idx[np.lexsort((top_idx, -volumes[top_idx]))]
+
+
+def dataframe_memo(df: pd.DataFrame, key: Hashable, compute: Callable[[], Any]) -> Any:
+    """
+    Memoriza un resultado derivado de un DataFrame mientras este siga vivo
+    
+    Las entradas se asocian al id del DataFrame y se eliminan cuando se
+    libera. Igual que el índice de keywords del servicio de Claude, un cambio
+    en el número de filas o en las columnas invalida lo memorizado; los
+    DataFrames se tratan como inmutables una vez cargados.
+    
+    Args:
+        df: DataFrame del que se deriva el resultado
+        key: Identificador del resultado (p. ej. 'keyword_stats')
+        compute: Función sin argumentos que calcula el resultado
+    
+    Returns:
+        Resultado memorizado o recién calculado
+    """
+    df_id = id(df)
+    stamp = (len(df), tuple(df.columns))
+    
+    with _dataframe_memos_lock:
+        memo = _dataframe_memos.get(df_id)
+        if memo is not None and memo.get('__stamp__') == stamp and key in memo:
+            return memo[key]
+    
+    value = compute()
+    
+    with _dataframe_memos_lock:
+        memo = _dataframe_memos.get(df_id)
+        if memo is None:
+            weakref.finalize(df, _dataframe_memos.pop, df_id, None)
+        if memo is None or memo.get('__stamp__') != stamp:
+            memo = _dataframe_memos[df_id] = {'__stamp__': stamp}
+        memo[key] = value
+    
+    return value
+
+
+def cached_top_volume_positions(df: pd.DataFrame, n: int) -> np.ndarray:
+    """
+    top_volume_positions memorizado por DataFrame
+    
+    Se calcula una vez el top 1000 y las selecciones menores (top 200 de la
+    comparación, top 500 de los detalles por topic) son prefijos suyos.
+    
+    Args:
+        df: DataFrame con columna 'volume'
+        n: Número de filas a seleccionar
+    
+    Returns:
+        Array de posiciones, de mayor a menor volumen
+    """
+    if n > _MEMO_TOP_N:
+        return top_volume_positions(df, n)
+    
+    return dataframe_memo(
+        df, 'top_volume_positions', lambda: top_volume_positions(df, _MEMO_TOP_N)
+    )[:n]
+
+
+def collapse_keyword_variants(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Agrupa las variantes de una misma keyword (mayúsculas, acentos, espacios)
+    
+    Cada grupo se representa con su variante de mayor volumen y suma el
+    volumen (y el tráfico si existe) de todas. Así la lista que se envía al
+    LLM no gasta tokens en casi duplicados y cubre más keywords distintas.
+    
+    Args:
+        df: DataFrame con columnas 'keyword' y 'volume'
+    
+    Returns:
+        DataFrame con una fila por keyword normalizada (el mismo df si no
+        hay variantes)
+    """
+    normalized = (
+        df['keyword'].astype(str)
+        .str.normalize('NFKD')
+        .str.replace(_COMBINING_MARKS_RE, '', regex=True)
+        .str.replace(_WHITESPACE_RE, ' ', regex=True)
+        .str.strip()
+        .str.lower()
+        .to_numpy()
+    )
+    
+    if len(pd.unique(normalized)) == len(df):
+        return df
+    
+    numeric_columns = [column for column in ('volume', 'traffic') if column in df.columns]
+    numeric = df[numeric_columns].apply(pd.to_numeric, errors='coerce').fillna(0).reset_index(drop=True)
+    groups = numeric.groupby(normalized, sort=False)
+    
+    # Representante: la variante con más volumen (posición en df)
+    representatives = groups['volume'].idxmax().to_numpy()
+    totals = groups.sum()
+    
+    collapsed = pd.DataFrame({'keyword': df['keyword'].to_numpy()[representatives]})
+    for column in numeric_columns:
+        collapsed[column] = totals[column].to_numpy()
+    return collapsed
+
+
+def top_volume_records(
+    df: pd.DataFrame,
+    n: int,
+    columns: List[str],
+    cached: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Devuelve las n filas de mayor volumen como lista de diccionarios
+    
+    Indexa directamente el array de cada columna con top_volume_positions en
+    lugar de ordenar el DataFrame y pasar por to_dict('records').
+    
+    Args:
+        df: DataFrame con columna 'volume'
+        n: Número de filas a seleccionar
+        columns: Columnas a incluir en cada registro
+        cached: Si reutilizar la selección memorizada para este DataFrame
+            (solo para DataFrames que se conservan, no para temporales)
+    
+    Returns:
+        Lista de registros ordenados de mayor a menor volumen
+    """
+    if cached:
+        top_positions = cached_top_volume_positions(df, n)
+    else:
+        top_positions = top_volume_positions(df, n)
+    return [
+        dict(zip(columns, row))
+        for row in zip(*(df[column].to_numpy()[top_positions].tolist() for column in columns))
+    ]
+
+
+def top_volume_csv(df: pd.DataFrame, n: int, columns: List[str]) -> str:
+    """
+    Devuelve las n filas de mayor volumen como tabla CSV con cabecera
+    
+    Para la lista de keywords de los prompts: sin repetir los nombres de
+    campo en cada fila, el CSV ocupa bastantes menos tokens que el JSON
+    compacto. Las keywords con comas o comillas se entrecomillan.
+    
+    Args:
+        df: DataFrame con columna 'volume'
+        n: Número de filas a seleccionar
+        columns: Columnas de la tabla, en orden
+    
+    Returns:
+        Texto CSV (cabecera + filas de mayor a menor volumen)
+    """
+    top_positions = top_volume_positions(df, n)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    writer.writerows(zip(*(df[column].to_numpy()[top_positions].tolist() for column in columns)))
+    return buffer.getvalue().rstrip('\n')
+
+
+def _content_digest(df: pd.DataFrame) -> str:
+    """
+    Digest del contenido de las columnas de un DataFrame
+    
+    Las columnas numéricas se hashean directamente desde su buffer y las de
+    texto como un único string unido por un separador, sin hashear fila a
+    fila como hash_pandas_object.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for column in df.columns:
+        values = df[column].to_numpy()
+        digest.update(f"{column}\x1e{values.dtype}\x1e".encode('utf-8'))
+        if values.dtype.kind in 'biufcmM':
+            digest.update(np.ascontiguousarray(values).tobytes())
+        else:
+            digest.update('\x1f'.join(map(str, values)).encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+def _numeric_checksum(df: pd.DataFrame) -> tuple:
+    """Suma de cada columna numérica (sin NaN): comprobación barata de ediciones in situ"""
+    return tuple(
+        float(np.nansum(df[column].to_numpy(dtype='float64')))
+        for column in df.columns
+        if df[column].dtype.kind in 'biuf'
+    )
+
+
+def dataframe_fingerprint(df: pd.DataFrame) -> tuple:
+    """
+    Genera una huella hashable de un DataFrame para usarla como clave de caché
+    
+    El digest del contenido se memoriza por DataFrame con dataframe_memo, así
+    que las cachés de prompts y de detalles por topic lo calculan una sola
+    vez. En cada consulta se comprueba la suma de las columnas numéricas: si
+    el DataFrame se editó in situ (p. ej. un volumen) el digest se recalcula.
+    Una edición que no cambie esas sumas (texto de una keyword, intercambio
+    de valores) no se detecta: los DataFrames usados como clave deben tratarse
+    como inmutables, o pasarse una copia tras modificarlos.
+    
+    Args:
+        df: DataFrame a identificar
+    
+    Returns:
+        Tupla (filas, columnas, hash del contenido) usable como clave de caché
+    """
+    checksum = _numeric_checksum(df)
+    content_hash = dataframe_memo(df, ('fingerprint', checksum), lambda: _content_digest(df))
+    return (len(df), tuple(df.columns), content_hash)
+
+
+def extract_json_block(text: str) -> Optional[str]:
+    """
+    Extrae el primer objeto JSON balanceado ({...}) de un texto
+    
+    Recorre el texto una sola vez con una regex precompilada que salta los
+    strings completos (incluidas comillas escapadas) y solo se detiene en
+    las llaves, contando su profundidad.
+    
+    Args:
+        text: Texto que puede contener JSON rodeado de otro contenido
+    
+    Returns:
+        Substring con el objeto JSON, o None si no hay un objeto completo
+    """
+    start = text.find('{')
+    if start == -1:
+        return None
+    
+    depth = 0
+    
+    for match in _JSON_TOKEN_RE.finditer(text, start):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:match.end()]
+        elif token == '"':
+            # String sin cerrar: el objeto está truncado
+            return None
+    
+    return None
+
+
+def decode_json_block(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Decodifica el objeto JSON que empieza en la primera llave de un texto
+    
+    A diferencia de extract_json_block + loads, el texto se recorre una sola
+    vez: el decodificador (compartido por el módulo) se detiene al cerrar el
+    objeto e ignora lo que venga detrás.
+    
+    Args:
+        text: Texto que puede contener JSON rodeado de otro contenido
+    
+    Returns:
+        Diccionario decodificado, o None si no hay un objeto JSON válido
+    """
+    start = text.find('{')
+    if start == -1:
+        return None
+    
+    try:
+        value, _ = _JSON_DECODER.raw_decode(text, start)
+    except ValueError:
+        return None
+    
+    return value if isinstance(value, dict) else None
+
+
+def extract_json_value(text: str, key: str) -> Any:
+    """
+    Extrae el valor completo de la primera aparición de "key": en un texto JSON
+    
+    Sirve para recuperar campos de una respuesta truncada que no se puede
+    parsear entera.
+    
+    Args:
+        text: Texto JSON, posiblemente incompleto
+        key: Nombre de la clave
+    
+    Returns:
+        Valor decodificado, o None si la clave no existe o su valor está cortado
+    """
+    match = re.search(r'"%s"\s*:\s*' % re.escape(key), text)
+    if not match:
+        return None
+    
+    try:
+        value, _ = _JSON_DECODER.raw_decode(text, match.end())
+    except json.JSONDecodeError:
+        return None
+    return value
+
+
+class IncrementalArrayParser:
+    """
+    Extrae los elementos completos del array "key": [...] a medida que llega el texto
+    
+    Pensado para respuestas en streaming: los fragmentos se acumulan en una
+    lista y solo se unen cuando llega uno que puede cerrar un elemento
+    (`}`, `]` o `"`). El texto de los elementos ya entregados se descarta,
+    así que cada intento decodifica únicamente el elemento pendiente.
+    """
+    
+    def __init__(self, key: str):
+        """
+        Args:
+            key: Nombre de la clave cuyo valor es un array
+        """
+        self._key_re = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self._chunks: List[str] = []
+        self._text = ''
+        self._position: Optional[int] = None
+        self.done = False
+    
+    @property
+    def found(self) -> bool:
+        """Si ya apareció el inicio del array"""
+        return self._position is not None
+    
+    def feed(self, chunk: str) -> List[Any]:
+        """
+        Añade un fragmento de texto
+        
+        Args:
+            chunk: Siguiente fragmento de la respuesta
+        
+        Returns:
+            Elementos que quedaron completos con este fragmento
+        """
+        if self.done:
+            return []
+        
+        self._chunks.append(chunk)
+        
+        # Sin un carácter de cierre no puede completarse nada (ni el inicio del array)
+        triggers = '[' if self._position is None else '}]"'
+        if not any(char in chunk for char in triggers):
+            return []
+        
+        self._text += ''.join(self._chunks)
+        self._chunks.clear()
+        
+        if self._position is None:
+            match = self._key_re.search(self._text)
+            if not match:
+                return []
+            self._position = match.end()
+        
+        items = []
+        while True:
+            position = _JSON_ARRAY_SEPARATOR_RE.match(self._text, self._position).end()
+            if position >= len(self._text):
+                break
+            if self._text[position] == ']':
+                self.done = True
+                break
+            try:
+                item, end = _JSON_DECODER.raw_decode(self._text, position)
+            except json.JSONDecodeError:
+                break
+            # Un número solo está completo cuando le sigue un separador o el cierre
+            if not isinstance(item, (dict, list, str)) and (
+                end >= len(self._text) or self._text[end] not in ' \t\n\r,]'
+            ):
+                break
+            items.append(item)
+            self._position = end
+        
+        # Conservar solo el elemento pendiente
+        self._text = self._text[self._position:]
+        self._position = 0
+        
+        return items
+
+
+def extract_partial_array(text: str, key: str) -> Optional[List[Any]]:
+    """
+    Recupera los elementos completos del array "key": [...] de un JSON truncado
+    
+    Decodifica los elementos uno a uno y se detiene en el primero que esté
+    incompleto, de modo que un array cortado por max_tokens conserva todo
+    lo que llegó entero.
+    
+    Args:
+        text: Texto JSON, posiblemente incompleto
+        key: Nombre de la clave cuyo valor es un array
+    
+    Returns:
+        Lista con los elementos completos, o None si no se encuentra el array
+    """
+    parser = IncrementalArrayParser(key)
+    items = parser.feed(text)
+    return items if parser.found else None
+
+
+def summarize_keyword_stats(df: pd.DataFrame, include_traffic: bool = False) -> Dict[str, int]:
+    """
+    Calcula las estadísticas de volumen (y tráfico) con una sola llamada a agg
+    
+    Ignora los NaN igual que pandas (Series.sum/Series.mean); una media
+    sin valores válidos se devuelve como 0.
+    
+    Args:
+        df: DataFrame con columnas 'keyword' y 'volume' (y 'traffic')
+        include_traffic: Si incluir total y promedio de tráfico
+    
+    Returns:
+        Diccionario con total_keywords, total_volume, avg_volume,
+        unique_keywords y, opcionalmente, total_traffic y avg_traffic
+    """
+    spec = {'volume': ['sum', 'mean'], 'keyword': ['nunique']}
+    if include_traffic:
+        spec['traffic'] = ['sum', 'mean']
+    
+    agg = df.agg(spec)
+    
+    def as_int(column: str, func: str) -> int:
+        value = agg.at[func, column]
+        return 0 if pd.isna(value) else int(value)
+    
+    stats = {
+        'total_keywords': df.shape[0],
+        'total_volume': as_int('volume', 'sum'),
+        'avg_volume': as_int('volume', 'mean'),
+        'unique_keywords': as_int('keyword', 'nunique')
+    }
+    
+    if include_traffic:
+        stats['total_traffic'] = as_int('traffic', 'sum')
+        stats['avg_traffic'] = as_int('traffic', 'mean')
+    
+    return stats
+
+
+def keyword_index(df: pd.DataFrame) -> pd.Index:
+    """
+    Índice hash de la columna 'keyword', memorizado por DataFrame
+    
+    Se construye una vez por dataset y lo comparten todos los servicios y
+    llamadas de detalle por topic.
+    
+    Args:
+        df: DataFrame con columna 'keyword'
+    
+    Returns:
+        pd.Index(df['keyword'].to_numpy()) para filter_by_keyword_index
+    """
+    return dataframe_memo(df, 'keyword_index', lambda: pd.Index(df['keyword'].to_numpy()))
+
+
+def filter_by_keyword_index(df: pd.DataFrame, keyword_index: pd.Index, keywords: List[str]) -> pd.DataFrame:
+    """
+    Filtra las filas de df cuyas keywords están en la lista, usando un índice
+    ya construido sobre la columna 'keyword'
+    
+    Construir el pd.Index (su tabla hash) una vez y reutilizarlo para varios
+    filtrados hace que cada uno solo busque las keywords pedidas en vez de
+    recorrer toda la columna.
+    
+    Args:
+        df: DataFrame con columna 'keyword'
+        keyword_index: pd.Index(df['keyword'].to_numpy())
+        keywords: Keywords a conservar
+    
+    Returns:
+        Filas coincidentes en el orden original de df (como isin)
+    """
+    wanted = pd.unique(np.asarray(keywords, dtype=object))
+    positions = keyword_index.get_indexer_for(wanted)
+    return df.iloc[np.sort(positions[positions >= 0])]
+
+
+def dataframe_to_csv_bytes(df: pd.DataFrame, chunksize: int = 10_000) -> bytes:
+    """
+    Serializa un DataFrame a CSV (UTF-8) escribiendo por bloques en un buffer
+    
+    Args:
+        df: DataFrame a exportar
+        chunksize: Filas escritas por bloque
+    
+    Returns:
+        Contenido CSV en bytes, listo para st.download_button
+    """
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, chunksize=chunksize, encoding='utf-8')
+    return buffer.getvalue()
+
+
+def downcast_numeric(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduce las columnas numéricas al tipo más pequeño que conserva sus valores
+    
+    int64 -> int8/16/32 y float64 -> float32 cuando es posible. Reduce memoria
+    y el coste de serializar la tabla (st.dataframe, CSV).
+    
+    Args:
+        df: DataFrame a optimizar
+    
+    Returns:
+        Nuevo DataFrame con tipos reducidos
+    """
+    if df.empty:
+        return df
+    
+    df = df.copy()
+    
+    for col in df.select_dtypes(include=['integer']).columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    
+    for col in df.select_dtypes(include=['floating']).columns:
+        df[col] = pd.to_numeric(df[col], downcast='float')
+    
+    return df
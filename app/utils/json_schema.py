@@ -0,0 +1,64 @@
+"""
+Constructores de JSON Schema para structured outputs de OpenAI
+
+En modo estricto la API garantiza que la respuesta cumple el esquema: sin
+JSON inválido ni texto alrededor que haya que rescatar al parsear.
+"""
+
+from typing import Any, Dict
+
+
+# Modelos de OpenAI con structured outputs (json_schema estricto); el resto
+# solo admite json_object
+STRUCTURED_OUTPUT_MODEL_PREFIXES = ('gpt-4o', 'gpt-4.1', 'gpt-5')
+
+
+def supports_structured_outputs(model: str) -> bool:
+    """Si el modelo de OpenAI acepta response_format de tipo json_schema"""
+    return model.startswith(STRUCTURED_OUTPUT_MODEL_PREFIXES)
+
+
+def schema_object(**properties: Dict[str, Any]) -> Dict[str, Any]:
+    """Objeto de JSON Schema en modo estricto (todos los campos obligatorios)"""
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+def schema_array(items: Dict[str, Any]) -> Dict[str, Any]:
+    """Array de JSON Schema con el tipo de elemento indicado"""
+    return {"type": "array", "items": items}
+
+
+def schema_enum(*values: str) -> Dict[str, Any]:
+    """String de JSON Schema restringido a unos valores"""
+    return {"type": "string", "enum": list(values)}
+
+
+def response_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Parámetro response_format de chat.completions con un esquema estricto
+
+    Args:
+        name: Nombre del esquema (letras, números, _ o -)
+        schema: JSON Schema de la respuesta
+
+    Returns:
+        Diccionario para el argumento response_format
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": schema
+        }
+    }
+
+
+SCHEMA_STRING = {"type": "string"}
+SCHEMA_INTEGER = {"type": "integer"}
+SCHEMA_STRINGS = schema_array(SCHEMA_STRING)
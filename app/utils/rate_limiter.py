@@ -0,0 +1,95 @@
+"""
+Limitador de peticiones por ventana deslizante para las APIs de los LLM
+
+Controla a la vez peticiones por minuto (RPM) y tokens por minuto (TPM)
+para esperar en el cliente en lugar de recibir un 429 después de que la
+API ya haya empezado a procesar el prompt.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+def estimate_tokens(*texts: str) -> int:
+    """
+    Estima los tokens de uno o varios textos (~4 caracteres por token)
+
+    Args:
+        texts: Textos que se enviarán a la API
+
+    Returns:
+        Número aproximado de tokens
+    """
+    return sum(len(text) for text in texts if text) // 4 + 1
+
+
+class RateLimiter:
+    """Ventana deslizante de peticiones y tokens, segura entre hilos"""
+    
+    def __init__(self, rpm: int, tpm: int, window_seconds: float = 60.0):
+        """
+        Inicializa el limitador
+
+        Args:
+            rpm: Peticiones máximas por ventana
+            tpm: Tokens máximos por ventana
+            window_seconds: Duración de la ventana en segundos
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window_seconds = window_seconds
+        self._events = deque()
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+    
+    def _reserve(self, tokens: int) -> float:
+        """
+        Intenta reservar una petición de `tokens` tokens
+
+        Returns:
+            0 si se reservó; si no, segundos a esperar antes de reintentar
+        """
+        with self._lock:
+            now = time.monotonic()
+            
+            # Descartar las peticiones que ya salieron de la ventana
+            while self._events and now - self._events[0][0] >= self.window_seconds:
+                _, expired_tokens = self._events.popleft()
+                self._tokens_in_window -= expired_tokens
+            
+            # Una petición mayor que el límite de tokens pasa si la ventana está vacía
+            fits_tokens = self._tokens_in_window + tokens <= self.tpm or not self._events
+            if len(self._events) < self.rpm and fits_tokens:
+                self._events.append((now, tokens))
+                self._tokens_in_window += tokens
+                return 0.0
+            
+            return max(self._events[0][0] + self.window_seconds - now, 0.001)
+    
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        Bloquea hasta que la petición cabe en la ventana
+
+        Args:
+            tokens: Tokens estimados de la petición
+        """
+        while True:
+            wait = self._reserve(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+    
+    async def acquire_async(self, tokens: int = 0) -> None:
+        """
+        Versión asíncrona de acquire (no bloquea el event loop)
+
+        Args:
+            tokens: Tokens estimados de la petición
+        """
+        while True:
+            wait = self._reserve(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
@@ -90,7 +90,9 @@ CACHE_CONFIG = {
     "cache_dir": os.getenv("CACHE_DIR", "cache"),
     "default_ttl_hours": int(os.getenv("CACHE_TTL_HOURS", "24")),
     "max_size_mb": int(os.getenv("CACHE_MAX_SIZE_MB", "500")),
-    "auto_cleanup_days": int(os.getenv("CACHE_AUTO_CLEANUP_DAYS", "30"))
+    "auto_cleanup_days": int(os.getenv("CACHE_AUTO_CLEANUP_DAYS", "30")),
+    # Caché semántica de OpenAI: similitud coseno mínima para reutilizar un análisis
+    "semantic_tau": float(os.getenv("CACHE_SEMANTIC_TAU", "0.87"))
 }
 
 # Estimaciones de coste por modelo (costes actualizados octubre 2025)
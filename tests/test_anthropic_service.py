@@ -0,0 +1,646 @@
+"""
+Tests unitarios para AnthropicService (sin llamadas reales a la API)
+"""
+
+import asyncio
+import gc
+import io
+import json
+
+import pytest
+import pandas as pd
+
+from app.services import anthropic_service
+from app.services.anthropic_service import AnthropicService
+from app.utils import helpers
+from app.utils.helpers import (
+    cached_top_volume_positions,
+    dataframe_fingerprint,
+    dataframe_memo,
+    top_volume_positions,
+    top_volume_csv,
+    top_volume_records,
+    collapse_keyword_variants,
+    decode_json_block,
+    extract_json_block,
+    filter_by_keyword_index,
+    keyword_index,
+    extract_json_value,
+    extract_partial_array,
+    IncrementalArrayParser
+)
+
+
+@pytest.fixture
+def sample_df():
+    """DataFrame de ejemplo para tests"""
+    return pd.DataFrame({
+        'keyword': ['seo tools', 'keyword research', 'seo audit', 'backlink checker', 'rank tracker'],
+        'volume': [10000, 8000, 5000, 8000, 2000],
+        'traffic': [3000, 2400, 1500, 900, 600]
+    })
+
+
+def prompt_text(blocks):
+    """Concatena el texto de los bloques de un prompt"""
+    return "".join(block['text'] for block in blocks)
+
+
+@pytest.fixture
+def service():
+    """Instancia de AnthropicService con una key ficticia"""
+    AnthropicService.clear_response_cache()
+    yield AnthropicService(api_key="sk-ant-test")
+    AnthropicService.clear_response_cache()
+
+
+class TestCreateUniversePrompt:
+
+    def test_prompt_is_memoized(self, service, sample_df):
+        """El mismo DataFrame y opciones devuelven el prompt cacheado"""
+        first = service.create_universe_prompt(sample_df, num_tiers=3)
+        second = service.create_universe_prompt(sample_df.copy(), num_tiers=3)
+
+        assert first is second
+
+    def test_prompt_changes_with_options(self, service, sample_df):
+        """Opciones distintas generan prompts distintos"""
+        three_tiers = service.create_universe_prompt(sample_df, num_tiers=3)
+        four_tiers = service.create_universe_prompt(sample_df, num_tiers=4)
+
+        assert three_tiers != four_tiers
+
+    def test_prompt_changes_with_data(self, service, sample_df):
+        """Cambiar los datos invalida el prompt cacheado"""
+        original = service.create_universe_prompt(sample_df)
+
+        modified = sample_df.copy()
+        modified.loc[0, 'volume'] = 12345
+        updated = service.create_universe_prompt(modified)
+
+        assert original != updated
+        assert '12345' in prompt_text(updated)
+
+    def test_data_block_is_cacheable_and_shared(self, service, sample_df):
+        """El bloque de datos lleva cache_control y no depende de las opciones"""
+        topics = service.create_universe_prompt(sample_df, analysis_type="Temática (Topics)")
+        funnel = service.create_universe_prompt(sample_df, analysis_type="Funnel de conversión", num_tiers=5)
+
+        assert topics[0]['cache_control'] == {'type': 'ephemeral'}
+        assert topics[0]['text'] == funnel[0]['text']
+        assert topics[1]['text'] != funnel[1]['text']
+
+    def test_keywords_match_nlargest_records(self, service, sample_df):
+        """La tabla CSV de keywords coincide con nlargest + to_dict('records')"""
+        prompt = service.create_universe_prompt(sample_df)
+        keywords_csv = prompt[0]['text'].split('POR VOLUMEN, CSV)\n', 1)[1]
+
+        expected = sample_df.nlargest(len(sample_df), 'volume').to_dict('records')
+        assert pd.read_csv(io.StringIO(keywords_csv)).to_dict('records') == expected
+
+    def test_keywords_match_nlargest_with_ties_at_cut(self, service):
+        """Con volúmenes por tramos y empates en el corte de 1000 se envían las filas de nlargest"""
+        df = pd.DataFrame({
+            'keyword': [f'keyword {i}' for i in range(3000)],
+            'volume': [(i * 7919 % 13) * 10 for i in range(3000)],
+            'traffic': [i % 50 for i in range(3000)]
+        })
+        prompt = service.create_universe_prompt(df)
+        keywords_csv = prompt[0]['text'].split('POR VOLUMEN, CSV)\n', 1)[1]
+
+        expected = collapse_keyword_variants(df).nlargest(1000, 'volume').to_dict('records')
+        assert pd.read_csv(io.StringIO(keywords_csv)).to_dict('records') == expected
+
+    def test_task_block_is_memoized(self, service, sample_df):
+        """El bloque de tarea se reutiliza entre datasets distintos"""
+        other = sample_df.assign(volume=sample_df['volume'] + 1)
+
+        first = service.create_universe_prompt(sample_df, num_tiers=4)
+        second = service.create_universe_prompt(other, num_tiers=4)
+
+        assert first[0]['text'] != second[0]['text']
+        assert first[1]['text'] is second[1]['text']
+        assert '5. Realiza análisis semántico' in first[1]['text']
+
+    def test_stats_ignore_missing_volume(self, service, sample_df):
+        """Las estadísticas ignoran NaN igual que pandas"""
+        df = sample_df.copy()
+        df['volume'] = df['volume'].astype(float)
+        df.loc[4, 'volume'] = float('nan')
+
+        prompt = prompt_text(service.create_universe_prompt(df))
+
+        assert f"Volumen total de búsqueda: {int(df['volume'].sum()):,}" in prompt
+        assert f"Volumen promedio: {int(df['volume'].mean()):,}" in prompt
+
+
+class TestTopByVolume:
+
+    def test_positions_match_nlargest_with_ties(self):
+        """Entre empates en el corte se eligen las primeras filas, como nlargest"""
+        df = pd.DataFrame({'volume': [10, 30, 20, 30, 20, 20, 10, 20]})
+
+        for n in range(1, len(df) + 1):
+            expected = df.nlargest(n, 'volume').index.tolist()
+            assert df.index[top_volume_positions(df, n)].tolist() == expected
+
+    def test_records_match_nlargest_to_dict(self, sample_df):
+        """Los registros coinciden con nlargest + to_dict('records')"""
+        expected = sample_df.nlargest(3, 'volume')[['keyword', 'volume']].to_dict('records')
+
+        assert top_volume_records(sample_df, 3, ['keyword', 'volume']) == expected
+
+    def test_csv_table_quotes_commas(self):
+        """La tabla CSV va ordenada por volumen y entrecomilla las keywords con comas"""
+        df = pd.DataFrame({'keyword': ['seo', 'seo, sem'], 'volume': [10, 20]})
+
+        assert top_volume_csv(df, 5, ['keyword', 'volume']) == 'keyword,volume\n"seo, sem",20\nseo,10'
+
+    def test_collapse_keyword_variants(self):
+        """Las variantes de mayúsculas, acentos y espacios se agrupan sumando volumen"""
+        df = pd.DataFrame({
+            'keyword': ['Diseño web', 'diseno  web', 'seo'],
+            'volume': [10, 30, 5],
+            'traffic': [1, 2, 3]
+        }, index=[5, 5, 7])
+
+        collapsed = collapse_keyword_variants(df)
+
+        assert collapsed['keyword'].tolist() == ['diseno  web', 'seo']
+        assert collapsed['volume'].tolist() == [40, 5]
+        assert collapsed['traffic'].tolist() == [3, 3]
+
+    def test_collapse_without_variants_returns_same_frame(self, sample_df):
+        """Sin variantes se devuelve el mismo DataFrame"""
+        assert collapse_keyword_variants(sample_df) is sample_df
+
+
+class TestDataframeMemo:
+
+    def test_computes_once_per_dataframe(self, sample_df):
+        """El resultado se calcula una vez por DataFrame y se invalida si cambian las filas"""
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        assert dataframe_memo(sample_df, 'test_key', compute) == 1
+        assert dataframe_memo(sample_df, 'test_key', compute) == 1
+        assert dataframe_memo(sample_df.copy(), 'test_key', compute) == 2
+
+        grown = pd.concat([sample_df, sample_df.head(1)])
+        dataframe_memo(grown, 'test_key', compute)
+        grown.loc[len(grown)] = ['extra', 1, 1]
+        assert dataframe_memo(grown, 'test_key', compute) == 4
+
+    def test_entries_released_with_dataframe(self, sample_df):
+        """Al liberar el DataFrame se elimina lo memorizado"""
+        df = sample_df.copy()
+        df_id = id(df)
+        dataframe_memo(df, 'test_key', lambda: 'valor')
+        assert df_id in helpers._dataframe_memos
+
+        del df
+        gc.collect()
+
+        assert df_id not in helpers._dataframe_memos
+
+    def test_cached_positions_are_prefix_of_top(self, sample_df):
+        """Las selecciones menores coinciden con el top calculado directamente"""
+        for n in (1, 3, 5):
+            assert cached_top_volume_positions(sample_df, n).tolist() == top_volume_positions(sample_df, n).tolist()
+
+    def test_fingerprint_follows_content(self, sample_df, monkeypatch):
+        """La huella coincide entre copias, cambia con los datos y se calcula una vez"""
+        modified = sample_df.copy()
+        modified.loc[0, 'keyword'] = 'otra keyword'
+
+        assert dataframe_fingerprint(sample_df.copy()) == dataframe_fingerprint(sample_df)
+        assert dataframe_fingerprint(modified) != dataframe_fingerprint(sample_df)
+
+        monkeypatch.setattr(helpers, '_content_digest', lambda df: pytest.fail("no memorizada"))
+        dataframe_fingerprint(sample_df)
+
+    def test_fingerprint_detects_in_place_volume_edit(self, sample_df):
+        """Editar un volumen del mismo DataFrame invalida la huella memorizada"""
+        before = dataframe_fingerprint(sample_df)
+        sample_df.loc[0, 'volume'] = 999
+
+        assert dataframe_fingerprint(sample_df) != before
+        assert dataframe_fingerprint(sample_df) == dataframe_fingerprint(sample_df.copy())
+
+
+class TestExtractJsonBlock:
+
+    def test_extracts_object_surrounded_by_text(self):
+        """Ignora el texto antes y después del objeto"""
+        text = 'Aquí tienes el análisis:\n{"topics": [{"topic": "seo"}]}\nEspero que sirva.'
+
+        assert extract_json_block(text) == '{"topics": [{"topic": "seo"}]}'
+
+    def test_ignores_braces_inside_strings(self):
+        """Las llaves dentro de strings no alteran el balance"""
+        text = 'x {"summary": "usa {llaves} y \\"comillas\\" }", "topics": []} y {"otro": 1}'
+
+        assert extract_json_block(text) == '{"summary": "usa {llaves} y \\"comillas\\" }", "topics": []}'
+
+    def test_returns_none_for_truncated_json(self):
+        """Un objeto sin cerrar no se considera JSON válido"""
+        assert extract_json_block('{"topics": [{"topic": "seo"}') is None
+        assert extract_json_block('sin json') is None
+
+    def test_returns_none_for_unterminated_string(self):
+        """Las llaves tras una comilla sin cerrar no cierran el objeto"""
+        assert extract_json_block('{"summary": "cortado { }') is None
+
+
+class TestDecodeJsonBlock:
+
+    def test_decodes_object_and_ignores_trailing_text(self):
+        """Decodifica desde la primera llave y descarta lo que sigue"""
+        text = 'Resultado: {"summary": "usa {llaves}", "topics": []} Nota: {no es JSON}'
+
+        assert decode_json_block(text) == {'summary': 'usa {llaves}', 'topics': []}
+
+    def test_returns_none_without_valid_object(self):
+        """Sin objeto o con JSON truncado devuelve None"""
+        assert decode_json_block('sin json') is None
+        assert decode_json_block('{"topics": [{"topic": "seo"}') is None
+        assert decode_json_block('texto {no es JSON}') is None
+
+
+class TestEnrichResults:
+
+    def test_normalizes_numeric_fields(self, service, sample_df):
+        """Convierte strings y floats a int y calcula métricas derivadas"""
+        result = {'topics': [
+            {'topic': 'SEO', 'tier': '1', 'keyword_count': '4', 'volume': 1000.7, 'traffic': None},
+            {'topic': 'Links', 'tier': 3, 'keyword_count': 0, 'volume': 500, 'traffic': 120,
+             'priority': 'medium', 'example_keywords': 'no es lista'}
+        ]}
+
+        topics = service._enrich_results(result, sample_df)['topics']
+
+        assert topics[0]['volume'] == 1000
+        assert topics[0]['keyword_count'] == 4
+        assert topics[0]['traffic'] == 300
+        assert topics[0]['avg_volume_per_keyword'] == 250.0
+        assert topics[0]['priority'] == 'high'
+        assert topics[0]['example_keywords'] == []
+
+        assert topics[1]['traffic'] == 120
+        assert topics[1]['avg_volume_per_keyword'] == 0
+        assert topics[1]['priority'] == 'medium'
+        assert topics[1]['example_keywords'] == []
+
+    def test_does_not_add_missing_keys(self, service, sample_df):
+        """Los campos no numéricos ausentes no se rellenan con NaN"""
+        result = {'topics': [{'topic': 'SEO', 'volume': 100, 'description': 'x'}, {'topic': 'Links'}]}
+
+        topics = service._enrich_results(result, sample_df)['topics']
+
+        assert 'description' not in topics[1]
+        assert isinstance(topics[1]['volume'], int)
+
+
+class FakeStream:
+    """Simula el context manager devuelto por client.messages.stream"""
+
+    def __init__(self, chunks, usage=None, stop_reason="end_turn"):
+        self.text_stream = iter(chunks)
+        self.usage = usage
+        self.stop_reason = stop_reason
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+    
+    def get_final_message(self):
+        return type('Message', (), {'usage': self.usage, 'stop_reason': self.stop_reason})()
+
+
+class TestAnalyzeKeywords:
+
+    def test_streams_and_parses_response(self, service, sample_df, monkeypatch):
+        """Acumula los chunks del stream y reporta el progreso"""
+        chunks = ['{"summary": "ok", ', '"topics": [{"topic": "SEO", ', '"volume": 100}]}']
+        monkeypatch.setattr(service.client.messages, 'stream', lambda **kwargs: FakeStream(chunks))
+
+        progress = []
+        result = service.analyze_keywords('prompt', sample_df, on_progress=progress.append)
+
+        assert result['topics'][0]['topic'] == 'SEO'
+        assert progress[-1] == sum(len(chunk) for chunk in chunks)
+
+    def test_drops_unknown_top_level_keys(self, service, sample_df, monkeypatch):
+        """Solo se conservan summary, topics, gaps y trends"""
+        chunks = ['{"summary": "ok", "topics": [], "trends": [], "debug": {"tokens": 123}}']
+        monkeypatch.setattr(service.client.messages, 'stream', lambda **kwargs: FakeStream(chunks))
+
+        result = service.analyze_keywords('prompt', sample_df)
+
+        assert set(result) == {'summary', 'topics', 'trends'}
+
+    def test_forwards_chunks_and_records_usage(self, service, sample_df, monkeypatch):
+        """on_chunk recibe cada fragmento y el uso de tokens queda registrado"""
+        chunks = ['{"topics": ', '[]}']
+        usage = {'input_tokens': 10, 'output_tokens': 3}
+        monkeypatch.setattr(service.client.messages, 'stream', lambda **kwargs: FakeStream(chunks, usage))
+
+        received = []
+        service.analyze_keywords('prompt', sample_df, on_chunk=received.append)
+
+        assert received == chunks
+        assert service.last_usage == usage
+
+
+    def test_salvages_truncated_response(self, service, sample_df, monkeypatch):
+        """Una respuesta cortada conserva los topics completos y no se cachea"""
+        chunks = ['{"summary": "Resumen", "topics": [{"topic": "SEO", "volume": 100}, ',
+                  '{"topic": "Links", "volume": 50}, {"topic": "Cort']
+        calls = []
+
+        def fake_stream(**kwargs):
+            calls.append(kwargs)
+            return FakeStream(chunks, stop_reason="max_tokens")
+
+        monkeypatch.setattr(service.client.messages, 'stream', fake_stream)
+
+        result = service.analyze_keywords('prompt', sample_df)
+        service.analyze_keywords('prompt', sample_df)
+
+        assert [topic['topic'] for topic in result['topics']] == ['SEO', 'Links']
+        assert result['summary'] == 'Resumen'
+        assert result['truncated'] is True
+        assert service.last_stop_reason == 'max_tokens'
+        assert len(calls) == 2
+
+
+class TestResponseCache:
+
+    def test_same_prompt_skips_api_call(self, service, sample_df, monkeypatch):
+        """Un prompt repetido se sirve desde la caché como copia independiente"""
+        calls = []
+
+        def fake_stream(**kwargs):
+            calls.append(kwargs)
+            return FakeStream(['{"summary": "ok", "topics": [{"topic": "SEO", "volume": 100}]}'])
+
+        monkeypatch.setattr(service.client.messages, 'stream', fake_stream)
+
+        first = service.analyze_keywords('prompt', sample_df, analysis_type="Temática (Topics)")
+        first['provider'] = 'Claude'
+        second = service.analyze_keywords('prompt', sample_df, analysis_type="Temática (Topics)")
+
+        assert len(calls) == 1
+        assert 'provider' not in second
+        assert second['topics'] == first['topics']
+
+    def test_use_cache_false_calls_api(self, service, sample_df, monkeypatch):
+        """Con use_cache=False siempre se llama a Claude"""
+        calls = []
+
+        def fake_stream(**kwargs):
+            calls.append(kwargs)
+            return FakeStream(['{"topics": []}'])
+
+        monkeypatch.setattr(service.client.messages, 'stream', fake_stream)
+
+        service.analyze_keywords('prompt', sample_df)
+        service.analyze_keywords('prompt', sample_df, use_cache=False)
+
+        assert len(calls) == 2
+
+
+class TestExtractPartialArray:
+
+    def test_stops_at_first_incomplete_item(self):
+        """Solo se devuelven los elementos que llegaron completos"""
+        text = '{"topics": [{"topic": "a"}, {"topic": "b", "tags": ["x"]}, {"topic": "c'
+
+        assert extract_partial_array(text, 'topics') == [{'topic': 'a'}, {'topic': 'b', 'tags': ['x']}]
+
+    def test_incremental_parser_emits_items_as_they_close(self):
+        """Cada elemento se entrega con el fragmento que lo cierra; los números esperan a su separador"""
+        parser = IncrementalArrayParser('topics')
+
+        assert parser.feed('{"topics": [{"topic": "a"') == []
+        assert parser.feed(', "n": 1') == []
+        assert parser.feed('}, 12') == [{'topic': 'a', 'n': 1}]
+        assert parser.feed('.') == []
+        assert parser.feed('5, "b"') == [12.5, 'b']
+        assert parser.feed(']}') == []
+        assert parser.done
+
+    def test_missing_key_returns_none(self):
+        """Sin la clave buscada no hay nada que recuperar"""
+        assert extract_partial_array('{"summary": "x"', 'topics') is None
+        assert extract_json_value('{"summary": "cortad', 'summary') is None
+
+
+class TestKeywordIndex:
+
+    def test_keyword_index_matches_isin(self, sample_df):
+        """El filtrado con índice reutilizado coincide con isin, también con categorías y repetidas"""
+        wanted = ['rank tracker', 'seo audit', 'seo audit', 'no existe']
+        df = pd.concat([sample_df, sample_df.head(3)], ignore_index=True)
+        categorical = df.astype({'keyword': 'category'})
+
+        expected = df[df['keyword'].isin(wanted)]
+
+        assert filter_by_keyword_index(df, pd.Index(df['keyword'].to_numpy()), wanted).equals(expected)
+        assert filter_by_keyword_index(
+            categorical, pd.Index(categorical['keyword'].to_numpy()), wanted
+        ).index.tolist() == expected.index.tolist()
+
+    def test_keyword_index_is_shared_per_dataframe(self, sample_df):
+        """El índice de keywords se construye una vez por DataFrame"""
+        index = keyword_index(sample_df)
+
+        assert keyword_index(sample_df) is index
+        assert keyword_index(sample_df.copy()) is not index
+        assert index.tolist() == sample_df['keyword'].tolist()
+
+
+class TestGetTopicDetails:
+
+    def test_sends_only_keyword_list(self, service, sample_df, monkeypatch):
+        """El prompt contiene solo la lista de keywords, sin volúmenes"""
+        sent = {}
+
+        def fake_stream(**kwargs):
+            sent['prompt'] = prompt_text(kwargs['messages'][0]['content'])
+            sent['system'] = kwargs.get('system')
+            return FakeStream(['{"keywords": ["seo tools", ', '"seo audit"]}'])
+
+        monkeypatch.setattr(service.client.messages, 'stream', fake_stream)
+
+        result = service.get_topic_details('SEO', sample_df)
+
+        assert sorted(result['keyword']) == ['seo audit', 'seo tools']
+        assert '"seo tools"' in sent['prompt']
+        assert '"volume"' not in sent['prompt']
+        assert sent['system'] is None
+
+
+class TestClientReuse:
+
+    def test_same_key_shares_client(self):
+        """Instancias con la misma API key comparten el cliente HTTP"""
+        first = AnthropicService(api_key="sk-ant-shared")
+        second = AnthropicService(api_key="sk-ant-shared")
+        other = AnthropicService(api_key="sk-ant-other")
+
+        assert first.client is second.client
+        assert first.client is not other.client
+
+    def test_keys_share_http_pool(self):
+        """Clientes de distintas API keys usan el mismo pool de conexiones"""
+        first = AnthropicService(api_key="sk-ant-pool-a")
+        second = AnthropicService(api_key="sk-ant-pool-b")
+
+        assert first.client._client is second.client._client
+
+
+class FakeBatches:
+    """Simula client.messages.batches con un lote que termina al segundo sondeo"""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.requests = None
+        self.retrieved = 0
+
+    def create(self, requests):
+        self.requests = requests
+        return type('Batch', (), {'id': 'batch-1', 'processing_status': 'in_progress'})()
+
+    def retrieve(self, batch_id):
+        self.retrieved += 1
+        return type('Batch', (), {'id': batch_id, 'processing_status': 'ended'})()
+
+    def results(self, batch_id):
+        for request, text in zip(self.requests, self.texts):
+            message = type('Message', (), {'content': [type('Block', (), {'text': text})()]})()
+            result = type('Result', (), {'type': 'succeeded' if text else 'errored', 'message': message})()
+            yield type('Entry', (), {'custom_id': request['custom_id'], 'result': result})()
+
+
+class TestGetTopicDetailsBatch:
+
+    def test_submits_one_batch_and_maps_results(self, service, sample_df, monkeypatch):
+        """Un único lote para todos los topics, con resultados por nombre"""
+        batches = FakeBatches(['{"keywords": ["seo tools", "seo audit"]}', ''])
+        monkeypatch.setattr(service.client.messages, 'batches', batches)
+
+        result = service.get_topic_details_batch(['SEO básico', 'Links'], sample_df, poll_interval=0)
+
+        assert len(batches.requests) == 2
+        assert batches.retrieved == 1
+        assert sorted(result['SEO básico']['keyword']) == ['seo audit', 'seo tools']
+        assert result['Links'].empty
+
+    def test_single_topic_uses_sync_call(self, service, sample_df, monkeypatch):
+        """Con un solo topic no se crea un lote"""
+        monkeypatch.setattr(service, 'get_topic_details', lambda topic, df: df.head(1))
+
+        result = service.get_topic_details_batch(['SEO'], sample_df)
+
+        assert list(result) == ['SEO']
+        assert len(result['SEO']) == 1
+
+
+class TestValidateApiKey:
+
+    def test_probe_is_minimal_and_cached(self, monkeypatch):
+        """Se hace una sola petición de 1 token por API key"""
+        service = AnthropicService(api_key="sk-ant-validate")
+        AnthropicService._validated_keys.discard(service._api_key_hash)
+        calls = []
+        monkeypatch.setattr(service.client.messages, 'create', lambda **kwargs: calls.append(kwargs))
+
+        assert service.validate_api_key()
+        assert AnthropicService(api_key="sk-ant-validate").validate_api_key()
+
+        assert len(calls) == 1
+        assert calls[0]['max_tokens'] == 1
+
+    def test_invalid_key_is_not_cached(self, monkeypatch):
+        """Una key rechazada se vuelve a comprobar en la siguiente llamada"""
+        service = AnthropicService(api_key="sk-ant-invalid")
+        calls = []
+
+        def failing_create(**kwargs):
+            calls.append(kwargs)
+            raise RuntimeError("401")
+
+        monkeypatch.setattr(service.client.messages, 'create', failing_create)
+
+        assert not service.validate_api_key()
+        assert not service.validate_api_key()
+        assert len(calls) == 2
+
+
+class TestFilterTopicKeywords:
+
+    def test_matches_isin_with_duplicates(self, service, sample_df):
+        """Devuelve las mismas filas que isin, incluidas keywords repetidas"""
+        df = pd.concat([sample_df, sample_df.iloc[[2]]], ignore_index=True)
+        wanted = ['seo audit', 'rank tracker', 'seo audit', 'no existe']
+
+        expected = df[df['keyword'].isin(wanted)]
+
+        assert service._filter_topic_keywords(df, wanted).equals(expected)
+
+    def test_index_rebuilt_for_new_dataframe(self, service, sample_df):
+        """El índice se reconstruye al cambiar de DataFrame"""
+        service._filter_topic_keywords(sample_df, ['seo tools'])
+        other = sample_df.assign(keyword=sample_df['keyword'] + ' 2024')
+
+        result = service._filter_topic_keywords(other, ['seo tools 2024'])
+
+        assert result['keyword'].tolist() == ['seo tools 2024']
+
+
+class FakeAsyncAnthropic:
+    """Simula anthropic.AsyncAnthropic registrando la concurrencia máxima"""
+
+    active = 0
+    peak = 0
+
+    def __init__(self, **kwargs):
+        self.messages = self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def create(self, **kwargs):
+        FakeAsyncAnthropic.active += 1
+        FakeAsyncAnthropic.peak = max(FakeAsyncAnthropic.peak, FakeAsyncAnthropic.active)
+        await asyncio.sleep(0.01)
+        FakeAsyncAnthropic.active -= 1
+
+        topic = kwargs['messages'][0]['content'][1]['text']
+        keywords = ['seo tools'] if '"SEO"' in topic else ['rank tracker']
+        return type('Message', (), {'content': [type('Block', (), {'text': json.dumps({'keywords': keywords})})()]})()
+
+
+class TestGetTopicDetailsMany:
+
+    def test_runs_concurrently_with_limit(self, service, sample_df, monkeypatch):
+        """Las peticiones se solapan sin superar max_concurrency"""
+        monkeypatch.setattr(anthropic_service.anthropic, 'AsyncAnthropic', FakeAsyncAnthropic)
+        FakeAsyncAnthropic.peak = 0
+
+        topics = ['SEO', 'Rank', 'Links', 'Audit']
+        result = service.get_topic_details_many(topics, sample_df, max_concurrency=2)
+
+        assert list(result) == topics
+        assert result['SEO']['keyword'].tolist() == ['seo tools']
+        assert result['Links']['keyword'].tolist() == ['rank tracker']
+        assert FakeAsyncAnthropic.peak == 2
@@ -0,0 +1,587 @@
+"""
+Tests unitarios para ArchitectureService (sin llamadas reales a las APIs)
+"""
+
+import asyncio
+import json
+import re
+import time
+
+import pytest
+import pandas as pd
+
+from app.services import architecture_service
+from app.services.architecture_service import ArchitectureService
+from app.utils.rate_limiter import RateLimiter
+
+
+@pytest.fixture
+def sample_df():
+    """DataFrame de ejemplo para tests"""
+    return pd.DataFrame({
+        'keyword': ['seo tools', 'keyword research', 'seo audit'],
+        'volume': [10000, 8000, 5000]
+    })
+
+
+@pytest.fixture
+def analysis_results():
+    """Resultado de análisis de keywords de ejemplo"""
+    return {'topics': [
+        {'topic': 'SEO', 'tier': 1, 'keyword_count': 2, 'volume': 15000, 'priority': 'high'},
+        {'topic': 'Research', 'tier': 2, 'keyword_count': 1, 'volume': 8000}
+    ]}
+
+
+@pytest.fixture
+def service():
+    """Instancia con keys ficticias de ambos proveedores"""
+    ArchitectureService.clear_cache()
+    architecture_service._openai_failures.clear()
+    ArchitectureService.output_tokens_per_topic_ema = None
+    service = ArchitectureService(anthropic_key="sk-ant-test", openai_key="sk-test")
+    # Limitadores propios para que los tests no compartan la ventana de la clase
+    service.claude_rate_limiter = RateLimiter(rpm=1000, tpm=10 ** 9)
+    service.openai_rate_limiter = RateLimiter(rpm=1000, tpm=10 ** 9)
+    yield service
+    ArchitectureService.clear_cache()
+    ArchitectureService.output_tokens_per_topic_ema = None
+
+
+ARCHITECTURE = {
+    'overview': 'Resumen',
+    'site_structure': {'main_sections': [{'section_name': 'SEO'}]},
+    'implementation_roadmap': [{'phase': 1}]
+}
+
+
+def fake_chunk(content=None, finish_reason=None):
+    """Chunk del stream de chat.completions de OpenAI"""
+    delta = type('Delta', (), {'content': content})()
+    choice = type('Choice', (), {'delta': delta, 'finish_reason': finish_reason})()
+    return type('Chunk', (), {'choices': [choice]})()
+
+
+def split_text(text, parts=3):
+    """Divide un texto en fragmentos como llegarían en streaming"""
+    size = len(text) // parts + 1
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class FakeAsyncStream:
+    """Simula el context manager asíncrono de AsyncAnthropic.messages.stream"""
+    
+    def __init__(self, chunks):
+        self.chunks = chunks
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *args):
+        return False
+    
+    @property
+    async def text_stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+class FakeAsyncClient:
+    """Cliente asíncrono que registra cuándo empieza y termina cada llamada"""
+    
+    calls = []
+    fail = set()
+    
+    def __init__(self, **kwargs):
+        self.messages = self
+        self.chat = self
+        self.completions = self
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *args):
+        return False
+    
+    async def _call(self, provider):
+        start = time.monotonic()
+        await asyncio.sleep(0.05)
+        FakeAsyncClient.calls.append((provider, start, time.monotonic()))
+        
+        if provider in FakeAsyncClient.fail:
+            raise RuntimeError(f"{provider} caído")
+    
+    def stream(self, **kwargs):
+        client = self
+        
+        class Stream(FakeAsyncStream):
+            async def __aenter__(self):
+                await client._call('claude')
+                return self
+        
+        return Stream(split_text(json.dumps(ARCHITECTURE)))
+    
+    async def create(self, **kwargs):
+        await self._call('openai')
+        
+        async def chunks():
+            for text in split_text(json.dumps(ARCHITECTURE)):
+                yield fake_chunk(text)
+            yield fake_chunk(finish_reason="stop")
+        
+        return chunks()
+
+
+@pytest.fixture
+def fake_async_clients(monkeypatch):
+    """Sustituye los clientes asíncronos de ambos proveedores"""
+    FakeAsyncClient.calls = []
+    FakeAsyncClient.fail = set()
+    monkeypatch.setattr(architecture_service, 'AsyncAnthropic', FakeAsyncClient)
+    monkeypatch.setattr(architecture_service, 'AsyncOpenAI', FakeAsyncClient)
+    return FakeAsyncClient
+
+
+class FakeStream:
+    """Simula el context manager devuelto por Anthropic.messages.stream"""
+    
+    def __init__(self, chunks):
+        self.text_stream = iter(chunks)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        return False
+
+
+class TestStreaming:
+
+    def test_claude_stream_reports_tokens(self, service, analysis_results, sample_df, monkeypatch):
+        """El texto de Claude llega por fragmentos y se parsea al final"""
+        chunks = split_text(json.dumps(ARCHITECTURE))
+        monkeypatch.setattr(service.anthropic_client.messages, 'stream', lambda **kwargs: FakeStream(chunks))
+        
+        received = []
+        result = service.generate_architecture(analysis_results, sample_df, on_token=received.append)
+        
+        assert received == chunks
+        assert result['overview'] == 'Resumen'
+        assert result['provider'] == 'Claude'
+    
+    def test_openai_stream_reports_tokens(self, service, analysis_results, sample_df, monkeypatch):
+        """Los deltas de OpenAI se acumulan y se parsean al final"""
+        chunks = split_text(json.dumps(ARCHITECTURE))
+        stream = [fake_chunk(text) for text in chunks] + [fake_chunk(finish_reason="stop")]
+        monkeypatch.setattr(service.openai_client.chat.completions, 'create', lambda **kwargs: iter(stream))
+        
+        received = []
+        result = service.generate_architecture(
+            analysis_results, sample_df, provider="OpenAI", on_token=received.append
+        )
+        
+        assert received == chunks
+        assert result['provider'] == 'OpenAI'
+    
+    def test_openai_empty_stream_reports_finish_reason(self, service, analysis_results, sample_df, monkeypatch):
+        """Sin contenido se informa del motivo de parada del stream"""
+        monkeypatch.setattr(
+            service.openai_client.chat.completions,
+            'create',
+            lambda **kwargs: iter([fake_chunk(finish_reason="length")])
+        )
+        
+        with pytest.raises(Exception, match="límite de tokens"):
+            service.generate_architecture(analysis_results, sample_df, provider="OpenAI")
+
+
+class TestGenerateWithBoth:
+
+    def test_providers_run_concurrently(self, service, analysis_results, sample_df, fake_async_clients):
+        """Claude y OpenAI se solapan en el tiempo y se combinan"""
+        result = service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+        
+        (_, _, first_end), (_, second_start, _) = sorted(
+            fake_async_clients.calls, key=lambda call: call[1]
+        )
+        assert second_start < first_end
+        assert result['provider'] == 'Ambos'
+        assert result['validation']['agreement'] == 'high'
+    
+    def test_openai_failure_falls_back_to_claude(self, service, analysis_results, sample_df, fake_async_clients):
+        """Si OpenAI falla se devuelve el resultado de Claude con una nota"""
+        fake_async_clients.fail = {'openai'}
+        
+        result = service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+        
+        assert result['provider'] == 'Claude'
+        assert 'OpenAI no disponible' in result['validation_note']
+    
+    def test_recent_openai_failure_skips_openai(self, service, analysis_results, sample_df, fake_async_clients, monkeypatch):
+        """Tras un fallo reciente de OpenAI se genera solo con Claude, sin esperar a OpenAI"""
+        fake_async_clients.fail = {'openai'}
+        service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+        
+        fake_async_clients.fail = set()
+        fake_async_clients.calls = []
+        ArchitectureService.clear_cache()
+        monkeypatch.setattr(
+            service.anthropic_client.messages, 'stream',
+            lambda **kwargs: FakeStream([json.dumps(ARCHITECTURE)])
+        )
+        result = service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+        
+        assert fake_async_clients.calls == []
+        assert result['provider'] == 'Claude'
+        assert 'openai caído' in result['validation_note']
+        
+        # Pasado el TTL se vuelve a intentar con ambos
+        monkeypatch.setattr(architecture_service, 'OPENAI_FAILURE_TTL_SECONDS', 0)
+        result = service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+        
+        assert [call[0] for call in fake_async_clients.calls] == ['openai']
+        assert result['provider'] == 'Ambos'
+    
+    def test_claude_failure_raises(self, service, analysis_results, sample_df, fake_async_clients):
+        """Si Claude falla la validación cruzada falla"""
+        fake_async_clients.fail = {'claude'}
+        
+        with pytest.raises(Exception, match="validación cruzada"):
+            service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+
+    
+    def test_compare_uses_section_overlap(self, service):
+        """Mismo número de secciones con nombres distintos no es acuerdo alto"""
+        def architecture(*names):
+            return {'site_structure': {'main_sections': [
+                {'section_name': name, 'url_structure': f'/{name.lower()}'} for name in names
+            ]}}
+        
+        different = service._compare_architectures(architecture('Blog', 'Guías'), architecture('Tienda', 'Precios'))
+        similar = service._compare_architectures(architecture('Blog', 'Guías'), architecture(' blog', 'GUÍAS'))
+        
+        assert different['agreement'] == 'low'
+        assert different['section_similarity'] == 0
+        assert any('URLs' in difference for difference in different['differences'])
+        assert similar['agreement'] == 'high'
+        assert similar['section_similarity'] == 1
+
+
+class TestGenerateBatch:
+    
+    def test_batch_runs_variants_concurrently(self, service, analysis_results, sample_df, fake_async_clients):
+        """Las variantes se generan en paralelo y cada fallo queda en su posición"""
+        requests = [
+            {'analysis_results': analysis_results, 'df': sample_df, 'custom_instructions': 'Solo blog'},
+            {'analysis_results': analysis_results, 'df': sample_df, 'custom_instructions': 'Solo tienda'},
+            {'analysis_results': analysis_results, 'df': sample_df, 'provider': 'Gemini'},
+            {'analysis_results': analysis_results, 'df': sample_df, 'provider': 'Ambos'}
+        ]
+        
+        results = service.generate_batch(requests)
+        
+        assert results[0]['provider'] == 'Claude'
+        assert results[1]['provider'] == 'Claude'
+        assert isinstance(results[2], ValueError)
+        assert results[3]['provider'] == 'Ambos'
+        starts = [call[1] for call in fake_async_clients.calls]
+        ends = [call[2] for call in fake_async_clients.calls]
+        assert len(fake_async_clients.calls) == 4
+        assert max(starts) < min(ends)
+    
+    def test_batch_respects_concurrency(self, service, analysis_results, sample_df, fake_async_clients):
+        """Con concurrency=1 las generaciones no se solapan"""
+        requests = [
+            {'analysis_results': analysis_results, 'df': sample_df, 'custom_instructions': f'Variante {i}'}
+            for i in range(3)
+        ]
+        
+        service.generate_batch(requests, concurrency=1)
+        
+        calls = sorted(fake_async_clients.calls, key=lambda call: call[1])
+        assert all(previous[2] <= current[1] for previous, current in zip(calls, calls[1:]))
+
+class TestGenerationCache:
+
+    def test_repeated_generation_uses_cache(self, service, analysis_results, sample_df, monkeypatch):
+        """El mismo prompt y modelo no vuelven a llamar a Claude"""
+        calls = []
+        
+        def fake_stream(**kwargs):
+            calls.append(kwargs)
+            return FakeStream([json.dumps(ARCHITECTURE)])
+        
+        monkeypatch.setattr(service.anthropic_client.messages, 'stream', fake_stream)
+        
+        first = service.generate_architecture(analysis_results, sample_df)
+        first['overview'] = 'modificado'
+        second = service.generate_architecture(analysis_results, sample_df)
+        service.generate_architecture(analysis_results, sample_df, custom_instructions="Solo blog")
+        
+        assert len(calls) == 2
+        assert second['overview'] == 'Resumen'
+    
+    def test_both_reuses_cached_provider(self, service, analysis_results, sample_df, fake_async_clients):
+        """En 'Ambos' solo se repite el proveedor que falló"""
+        fake_async_clients.fail = {'openai'}
+        service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+        
+        fake_async_clients.fail = set()
+        fake_async_clients.calls = []
+        architecture_service._openai_failures.clear()
+        result = service.generate_architecture(analysis_results, sample_df, provider="Ambos")
+        
+        assert [call[0] for call in fake_async_clients.calls] == ['openai']
+        assert result['provider'] == 'Ambos'
+
+
+class TestPromptAndExport:
+
+    def test_prompt_keeps_non_ascii_topics(self, service, sample_df):
+        """Los topics se serializan sin escapar acentos"""
+        prompt = service._create_architecture_prompt({'topics': [{'topic': 'Diseño web'}]}, sample_df)
+        
+        assert '"topic":"Diseño web"' in prompt
+    
+    def test_export_to_document_renders_sections(self, service):
+        """El documento incluye secciones, JSON de navegación y fases"""
+        architecture = {
+            'overview': 'Resumen',
+            'site_structure': {
+                'home': {'title': 'Inicio'},
+                'main_sections': [{
+                    'section_name': 'Guías',
+                    'url_structure': '/guias',
+                    'subsections': [{'name': 'SEO', 'url': '/guias/seo'}]
+                }]
+            },
+            'navigation': {'primary_menu': [{'label': 'Guías'}]},
+            'implementation_roadmap': [{'phase': 1, 'duration': '1 mes'}]
+        }
+        
+        doc = service.export_to_document(architecture)
+        
+        assert '#### Guías' in doc
+        assert '- SEO (/guias/seo)' in doc
+        assert '"label": "Guías"' in doc
+        assert '### Fase 1' in doc
+    
+    def test_prompt_totals_ignore_missing_volume(self, service, analysis_results, sample_df, monkeypatch):
+        """Los totales se calculan una vez e ignoran volúmenes vacíos"""
+        df = sample_df.astype({'volume': float})
+        df.loc[2, 'volume'] = float('nan')
+        prompts = []
+        
+        def fake_generate(prompt, *args):
+            prompts.append(prompt)
+            return dict(ARCHITECTURE)
+        
+        monkeypatch.setattr(service, '_generate_with_claude', fake_generate)
+        
+        service.generate_architecture(analysis_results, df)
+        
+        assert '- Volumen total: 18,000' in prompts[0]
+        assert '- Total keywords analizadas: 3' in prompts[0]
+    
+    def test_static_instructions_go_to_cached_system_prompt(self, service, analysis_results, sample_df, monkeypatch):
+        """El esquema va en el sistema (cacheable) y los datos en el mensaje de usuario"""
+        sent = {}
+        
+        def fake_stream(**kwargs):
+            sent.update(kwargs)
+            return FakeStream([json.dumps(ARCHITECTURE)])
+        
+        monkeypatch.setattr(service.anthropic_client.messages, 'stream', fake_stream)
+        
+        service.generate_architecture(analysis_results, sample_df, custom_instructions="Solo blog")
+        
+        system_block = sent['system'][0]
+        user_prompt = sent['messages'][0]['content']
+        assert system_block['cache_control'] == {'type': 'ephemeral'}
+        assert 'site_structure:' in system_block['text']
+        assert 'site_structure' not in user_prompt
+        assert '# INSTRUCCIONES ADICIONALES\nSolo blog' in user_prompt
+    
+    def test_prompt_summarizes_top_topics_with_defaults(self, service, sample_df):
+        """Solo se envían los 50 primeros topics y los campos que faltan toman su valor por defecto"""
+        topics = [{'topic': f'T{i}', 'extra': 'x'} for i in range(60)]
+        
+        prompt = service._create_architecture_prompt({'topics': topics}, sample_df)
+        summary = json.loads(prompt.split('# TOPICS PRINCIPALES\n', 1)[1])
+        
+        assert len(summary) == 50
+        assert summary[0] == {'topic': 'T0', 'tier': 0, 'keyword_count': 0, 'volume': 0, 'priority': 'medium'}
+        assert '- Topics identificados: 60' in prompt
+    
+    def test_prompt_topics_are_distinct_and_by_volume(self, service, sample_df):
+        """Los topics repetidos entre análisis se envían una vez, ordenados por volumen"""
+        topics = [
+            {'topic': 'SEO Tools', 'volume': 100},
+            {'topic': 'Link Building', 'volume': 500},
+            {'topic': 'seo tools ', 'volume': 900},
+        ] + [{'topic': f'T{i}', 'volume': i} for i in range(60)]
+        
+        prompt = service._create_architecture_prompt({'topics': topics}, sample_df)
+        summary = json.loads(prompt.split('# TOPICS PRINCIPALES\n', 1)[1])
+        
+        names = [topic['topic'] for topic in summary]
+        assert len(summary) == 50
+        assert names[:3] == ['Link Building', 'SEO Tools', 'T59']
+        assert 'seo tools ' not in names
+        assert '- Topics identificados: 62' in prompt
+    
+    def test_output_budget_scales_with_topics(self, service, analysis_results, sample_df, monkeypatch):
+        """Pocos topics reservan menos tokens de salida; muchos se limitan al máximo"""
+        sent = {}
+        
+        def fake_stream(**kwargs):
+            sent.update(kwargs)
+            return FakeStream([json.dumps(ARCHITECTURE)])
+        
+        monkeypatch.setattr(service.anthropic_client.messages, 'stream', fake_stream)
+        assert service._output_budget(200) == service.max_tokens
+        
+        service.generate_architecture(analysis_results, sample_df)
+        
+        assert sent['max_tokens'] == 4600
+        assert service.last_max_tokens == 4600
+    
+    def test_output_budget_adapts_to_previous_responses(self, service):
+        """La media por topic de respuestas previas acota el presupuesto; una respuesta cortada la descarta"""
+        assert service._output_budget(50) == service.max_tokens
+        
+        service._record_output_tokens('x' * 4 * 3000, 16000, 20)
+        assert ArchitectureService.output_tokens_per_topic_ema == pytest.approx(150.05)
+        assert service._output_budget(50) == 11253
+        assert service._output_budget(10) == service.MIN_OUTPUT_TOKENS
+        
+        # La media es de la clase: un servicio nuevo (uno por clic en la app) la reutiliza
+        assert ArchitectureService(anthropic_key="sk-ant-test")._output_budget(50) == 11253
+        
+        service._record_output_tokens('x' * 4 * 4500, 4501, 20)
+        assert ArchitectureService.output_tokens_per_topic_ema is None
+        assert service._output_budget(50) == service.max_tokens
+    
+    def test_generation_records_tokens_per_topic(self, service, analysis_results, sample_df, monkeypatch):
+        """Cada generación actualiza la media con los topics enviados en el prompt"""
+        content = json.dumps(ARCHITECTURE)
+        monkeypatch.setattr(
+            service.anthropic_client.messages, 'stream', lambda **kwargs: FakeStream([content])
+        )
+        
+        service.generate_architecture(analysis_results, sample_df)
+        
+        assert ArchitectureService.output_tokens_per_topic_ema == pytest.approx((len(content) // 4 + 1) / 2)
+    
+    def test_max_tokens_is_configurable(self):
+        """El techo de tokens de salida se puede fijar al crear el servicio"""
+        service = ArchitectureService(anthropic_key="sk-ant-test", max_tokens=8000)
+        
+        assert service._output_budget(200) == 8000
+    
+    def test_prompt_is_memoized(self, service, analysis_results, sample_df, monkeypatch):
+        """El mismo análisis reutiliza el prompt sin volver a serializar los topics"""
+        first = service._create_architecture_prompt(analysis_results, sample_df, "Solo blog")
+        monkeypatch.setattr(architecture_service.fast_json, 'dumps', None)
+        second = service._create_architecture_prompt(analysis_results, sample_df, "Solo blog")
+        
+        assert second is first
+    
+    def test_prompt_with_unhashable_values_is_built(self, service, sample_df):
+        """Valores no hashables en los topics no rompen la construcción del prompt"""
+        prompt = service._create_architecture_prompt({'topics': [{'topic': ['a', 'b']}]}, sample_df)
+        
+        assert '"a"' in prompt
+
+class TestResponseParsing:
+
+    def test_claude_json_surrounded_by_text(self, service):
+        """Se extrae el primer objeto balanceado aunque haya llaves después"""
+        text = 'Aquí está:\n{"overview": "usa {llaves}"}\nNota: {no es JSON}'
+        
+        result = service._parse_claude_response(text)
+        
+        assert result['overview'] == 'usa {llaves}'
+        assert result['provider'] == 'Claude'
+    
+    def test_openai_schema_matches_prompt_outline(self):
+        """El esquema compacto del prompt nombra todos los campos del JSON Schema de OpenAI"""
+        def field_names(schema):
+            if schema['type'] == 'array':
+                return field_names(schema['items'])
+            if schema['type'] != 'object':
+                return set()
+            names = set(schema['properties'])
+            for item in schema['properties'].values():
+                names |= field_names(item)
+            return names
+        
+        schema = architecture_service._ARCHITECTURE_JSON_SCHEMA
+        outline = architecture_service._ARCHITECTURE_SYSTEM_PROMPT
+        
+        missing = {name for name in field_names(schema) if not re.search(rf'\b{name}\b', outline)}
+        assert not missing
+        assert schema['required'] == list(schema['properties'])
+        assert '"site_structure"' not in outline
+    
+    def test_openai_request_uses_structured_outputs(self, service):
+        """La petición a OpenAI exige el esquema en modo estricto"""
+        response_format = service._openai_request("prompt")['response_format']
+        
+        assert response_format['type'] == 'json_schema'
+        assert response_format['json_schema']['strict'] is True
+    
+    def test_older_openai_models_use_json_object(self):
+        """gpt-4-turbo no admite json_schema: se pide json_object y se extrae el objeto del texto"""
+        service = ArchitectureService(openai_key="sk-test", openai_model="gpt-4-turbo")
+        
+        result = service._parse_openai_response('Aquí está: {"overview": "Resumen"} Fin', "stop")
+        
+        assert service._openai_request("prompt")['response_format'] == {"type": "json_object"}
+        assert result['overview'] == 'Resumen'
+    
+    def test_openai_unparseable_content_raises(self, service):
+        """Sin objeto completo se informa del contenido recibido"""
+        with pytest.raises(ValueError, match="No se pudo parsear JSON de OpenAI"):
+            service._parse_openai_response('{"overview": "cortado', "length")
+
+
+class TestClients:
+
+    def test_clients_retry_transient_errors(self, service):
+        """Ambos clientes se configuran con reintentos con backoff"""
+        assert service.anthropic_client.max_retries == ArchitectureService.MAX_RETRIES
+        assert service.openai_client.max_retries == ArchitectureService.MAX_RETRIES
+    
+    def test_instances_share_connection_pool(self, service):
+        """Las instancias reutilizan el mismo pool HTTP por proveedor"""
+        other = ArchitectureService(anthropic_key="sk-ant-other", openai_key="sk-other")
+        
+        assert other.anthropic_client._client is service.anthropic_client._client
+        assert other.openai_client._client is service.openai_client._client
+        assert service.anthropic_client._client is not service.openai_client._client
+
+
+class TestRateLimiting:
+    
+    def test_limiters_are_shared_across_instances(self):
+        """Todas las instancias comparten el limitador de cada proveedor"""
+        first = ArchitectureService(anthropic_key="sk-ant-a")
+        second = ArchitectureService(anthropic_key="sk-ant-b")
+        
+        assert first.claude_rate_limiter is second.claude_rate_limiter
+        assert first.openai_rate_limiter is not first.claude_rate_limiter
+    
+    def test_claude_request_acquires_limiter(self, service, analysis_results, sample_df, monkeypatch):
+        """Cada petición a Claude reserva su estimación de tokens antes de enviarse"""
+        reserved = []
+        monkeypatch.setattr(service.claude_rate_limiter, 'acquire', reserved.append)
+        monkeypatch.setattr(
+            service.anthropic_client.messages, 'stream',
+            lambda **kwargs: FakeStream([json.dumps(ARCHITECTURE)])
+        )
+        
+        service.generate_architecture(analysis_results, sample_df)
+        
+        assert len(reserved) == 1
+        assert reserved[0] > 0
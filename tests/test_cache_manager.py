@@ -14,7 +14,7 @@ import sys
 ROOT_DIR = Path(__file__).parent.parent
 sys.path.insert(0, str(ROOT_DIR))
 
-from app.utils.cache_manager import CacheManager
+from app.utils.cache_manager import CacheManager, SemanticCache
 
 
 @pytest.fixture
@@ -452,5 +452,76 @@ class TestIntegration:
         assert info['cached_analyses'] == 0
 
 
+def letter_counts(text):
+    """Embedding de prueba: frecuencia de cada letra"""
+    return [text.count(letter) for letter in 'abcdefghijklmnopqrstuvwxyz']
+
+
+class TestSemanticCache:
+    """Tests para la caché semántica en memoria"""
+    
+    def test_similar_query_hits_within_namespace(self):
+        """Una consulta casi idéntica reutiliza el resultado solo en su espacio de nombres"""
+        cache = SemanticCache(tau=0.95, embed=letter_counts)
+        cache.set('gpt-4o|Topics', 'seo tools,keyword research', {'topics': ['SEO']})
+        
+        hit = cache.get('gpt-4o|Topics', 'keyword research,seo tools')
+        
+        assert hit == {'topics': ['SEO']}
+        assert cache.get('gpt-4o|Funnel', 'keyword research,seo tools') is None
+        assert cache.get('gpt-4o|Topics', 'zzz qqq') is None
+    
+    def test_hit_returns_copy(self):
+        """Modificar el resultado devuelto no altera la caché"""
+        cache = SemanticCache(embed=letter_counts)
+        cache.set('ns', 'seo tools', {'topics': ['SEO']})
+        
+        cache.get('ns', 'seo tools')['topics'].append('otro')
+        
+        assert cache.get('ns', 'seo tools') == {'topics': ['SEO']}
+    
+    def test_evicts_least_recently_used(self):
+        """Al llenarse se sustituye la entrada usada hace más tiempo"""
+        cache = SemanticCache(tau=0.99, max_entries=2, embed=letter_counts)
+        cache.set('ns', 'aaaa', {'id': 'a'})
+        cache.set('ns', 'bbbb', {'id': 'b'})
+        cache.get('ns', 'aaaa')
+        
+        cache.set('ns', 'cccc', {'id': 'c'})
+        
+        assert len(cache) == 2
+        assert cache.get('ns', 'aaaa') == {'id': 'a'}
+        assert cache.get('ns', 'bbbb') is None
+        assert cache.get('ns', 'cccc') == {'id': 'c'}
+    
+    def test_same_text_embedded_once(self):
+        """Un fallo seguido de set y los re-análisis reutilizan el embedding del texto"""
+        calls = []
+        
+        def counting_embed(text):
+            calls.append(text)
+            return letter_counts(text)
+        
+        cache = SemanticCache(max_entries=1, embed=counting_embed)
+        cache.get('ns', 'seo tools')
+        cache.set('ns', 'seo tools', {'id': 'a'})
+        cache.set('ns', 'rank tracker', {'id': 'b'})
+        
+        assert cache.get('ns', 'rank tracker') == {'id': 'b'}
+        assert cache.get('ns', 'seo tools') is None
+        assert calls == ['seo tools', 'rank tracker']
+    
+    def test_embedding_failure_disables_cache(self):
+        """Si el embedding falla la caché se desactiva sin lanzar errores"""
+        def failing_embed(text):
+            raise RuntimeError("modelo no disponible")
+        
+        cache = SemanticCache(embed=failing_embed)
+        cache.set('ns', 'seo tools', {'topics': []})
+        
+        assert cache.available is False
+        assert cache.get('ns', 'seo tools') is None
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
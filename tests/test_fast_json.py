@@ -0,0 +1,49 @@
+"""
+Tests unitarios para la serialización JSON rápida
+"""
+
+import json
+import pytest
+
+from app.utils import fast_json
+
+
+class TestFastJson:
+
+    def test_roundtrip_keeps_non_ascii(self):
+        """Los acentos no se escapan y el resultado se puede volver a leer"""
+        data = [{'keyword': 'diseño web', 'volume': 1000}]
+
+        encoded = fast_json.dumps(data)
+
+        assert 'diseño' in encoded
+        assert fast_json.loads(encoded) == data
+
+    def test_compact_by_default(self):
+        """Por defecto no hay espacios ni saltos de línea"""
+        assert fast_json.dumps({'a': [1, 2]}) == '{"a":[1,2]}'
+
+    def test_indent_option(self):
+        """Con indent=True el JSON se indenta"""
+        assert '\n  "a"' in fast_json.dumps({'a': 1}, indent=True)
+
+    def test_invalid_json_raises_stdlib_error(self):
+        """Los errores de parseo se capturan como json.JSONDecodeError"""
+        with pytest.raises(json.JSONDecodeError):
+            fast_json.loads('{"topics": ')
+
+    def test_stdlib_fallback_matches(self, monkeypatch):
+        """Sin orjson el resultado es el mismo JSON compacto"""
+        data = {'keyword': 'diseño web', 'volume': 1000, 'tags': ['a', 'b']}
+        expected = fast_json.dumps(data)
+
+        monkeypatch.setattr(fast_json, 'orjson', None)
+
+        assert fast_json.dumps(data) == expected
+        assert fast_json.loads(expected) == data
+
+    def test_non_string_keys(self):
+        """Las claves numéricas se serializan como string, igual que json.dumps"""
+        data = {1: 'tier 1', 'topic': 'seo'}
+
+        assert fast_json.loads(fast_json.dumps(data)) == json.loads(json.dumps(data))
@@ -0,0 +1,501 @@
+"""
+Tests unitarios para OpenAIService (sin llamadas reales a la API)
+"""
+
+import asyncio
+import json
+
+import pytest
+import pandas as pd
+
+from app.services.openai_service import MAX_RETRIES, OpenAIService
+from app.utils.cache_manager import SemanticCache
+
+
+@pytest.fixture
+def sample_df():
+    """DataFrame de ejemplo para tests"""
+    return pd.DataFrame({
+        'keyword': ['seo tools', 'keyword research', 'seo audit', 'backlink checker', 'rank tracker'],
+        'volume': [10000, 8000, 5000, 8000, 2000],
+        'traffic': [3000, 2400, 1500, 900, 600]
+    })
+
+
+@pytest.fixture
+def service():
+    """Instancia de OpenAIService con una key ficticia"""
+    OpenAIService.clear_topic_details_cache()
+    OpenAIService.clear_response_cache()
+    yield OpenAIService(api_key="sk-test")
+    OpenAIService.clear_topic_details_cache()
+    OpenAIService.clear_response_cache()
+
+
+def fake_completion(content):
+    """Respuesta no streaming de chat.completions"""
+    message = type('Message', (), {'content': content})()
+    choice = type('Choice', (), {'message': message, 'finish_reason': 'stop'})()
+    return type('Completion', (), {'choices': [choice]})()
+
+
+class FakeCompletions:
+    """Registra las llamadas a chat.completions.create y devuelve respuestas fijas"""
+    
+    def __init__(self, content):
+        self.content = content
+        self.calls = []
+    
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        return fake_completion(self.content)
+
+
+class TestCreateUniversePrompt:
+    
+    def test_static_instructions_come_first(self, service, sample_df):
+        """La tarea y el formato preceden a los datos para aprovechar la caché de prefijos"""
+        user_message = service.create_universe_prompt(sample_df, custom_instructions="Solo B2B")[1]['content']
+        
+        assert user_message.index('# FORMATO DE RESPUESTA') < user_message.index('# CONTEXTO')
+        assert user_message.index('# CONTEXTO') < user_message.index('Solo B2B')
+        assert user_message.endswith('rank tracker,2000,600')
+    
+    def test_prefix_is_shared_across_datasets(self, service, sample_df):
+        """Dos datasets con las mismas opciones comparten todo el prefijo estático"""
+        first = service.create_universe_prompt(sample_df)
+        second = service.create_universe_prompt(sample_df.head(2))
+        
+        prefix = first[1]['content'].split('# CONTEXTO')[0]
+        assert first[0] == second[0]
+        assert second[1]['content'].startswith(prefix)
+    
+    def test_keywords_sorted_by_volume_without_traffic(self, service, sample_df):
+        """Las keywords van de mayor a menor volumen y el tráfico es opcional"""
+        user_message = service.create_universe_prompt(sample_df.drop(columns=['traffic']))[1]['content']
+        table = user_message.split('# KEYWORDS A ANALIZAR (CSV)\n', 1)[1].splitlines()
+        
+        assert table[0] == 'keyword,volume'
+        assert table[1:3] == ['seo tools,10000', 'keyword research,8000']
+    
+    def test_task_prompt_is_built_once_per_options(self, service, sample_df):
+        """El bloque de tarea se reutiliza entre datasets y cambia con las opciones"""
+        OpenAIService._build_task_prompt.cache_clear()
+        
+        service.create_universe_prompt(sample_df, custom_instructions="Solo B2B")
+        service.create_universe_prompt(sample_df.head(2))
+        without_gaps = service.create_universe_prompt(sample_df, include_gaps=False)[1]['content']
+        
+        info = OpenAIService._build_task_prompt.cache_info()
+        assert (info.hits, info.misses) == (1, 2)
+        assert '"gaps"' not in without_gaps
+    
+    def test_keywords_trimmed_to_fit_context(self):
+        """Con un contexto pequeño (gpt-4) la tabla se recorta hasta caber"""
+        df = pd.DataFrame({
+            'keyword': [f'keyword de ejemplo número {i}' for i in range(2000)],
+            'volume': range(2000, 0, -1)
+        })
+        service = OpenAIService(api_key="sk-test", model="gpt-4")
+        
+        messages = service.create_universe_prompt(df)
+        table = messages[1]['content'].split('# KEYWORDS A ANALIZAR (CSV)\n', 1)[1].splitlines()
+        
+        assert service.last_prompt_tokens <= service.prompt_token_budget
+        assert 50 < len(table) - 1 < 1000
+        assert table[1] == 'keyword de ejemplo número 0,2000'
+
+
+class TestGetTopicsDetails:
+    
+    def test_one_call_for_all_topics(self, service, sample_df, monkeypatch):
+        """Todos los topics se resuelven con una única llamada"""
+        completions = FakeCompletions(json.dumps({
+            'SEO': ['seo tools', 'seo audit'],
+            'Links': ['backlink checker'],
+            'Otro': 'no es una lista'
+        }))
+        monkeypatch.setattr(service.client.chat, 'completions', completions)
+        
+        details = service.get_topics_details(['SEO', 'Links', 'Otro'], sample_df)
+        
+        assert len(completions.calls) == 1
+        assert details['SEO']['keyword'].tolist() == ['seo tools', 'seo audit']
+        assert details['Links']['keyword'].tolist() == ['backlink checker']
+        assert details['Otro'].empty
+    
+    def test_single_topic_reuses_batched_result(self, service, sample_df, monkeypatch):
+        """get_topic_details de un topic ya pedido en lote no repite la llamada"""
+        completions = FakeCompletions(json.dumps({'SEO': ['seo tools'], 'Links': ['backlink checker']}))
+        monkeypatch.setattr(service.client.chat, 'completions', completions)
+        
+        service.get_topics_details(['SEO', 'Links'], sample_df)
+        links = service.get_topic_details('Links', sample_df)
+        
+        assert len(completions.calls) == 1
+        assert links['keyword'].tolist() == ['backlink checker']
+    
+    def test_api_error_returns_empty_frames(self, service, sample_df, monkeypatch):
+        """Un error de la API devuelve DataFrames vacíos sin propagar la excepción"""
+        def failing_create(**kwargs):
+            raise RuntimeError("rate limit")
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', failing_create)
+        
+        details = service.get_topics_details(['SEO'], sample_df)
+        
+        assert details['SEO'].empty
+
+
+def fake_stream_chunk(content=None, finish_reason=None, usage=None):
+    """Chunk del stream de chat.completions (sin choices si solo trae el uso)"""
+    if usage is not None:
+        return type('Chunk', (), {'choices': [], 'usage': usage})()
+    delta = type('Delta', (), {'content': content})()
+    choice = type('Choice', (), {'delta': delta, 'finish_reason': finish_reason})()
+    return type('Chunk', (), {'choices': [choice], 'usage': None})()
+
+
+class TestAnalyzeKeywords:
+    
+    def test_streams_and_reports_progress(self, service, sample_df, monkeypatch):
+        """La respuesta llega por fragmentos, informa del progreso y guarda el uso"""
+        text = json.dumps({'summary': 'ok', 'topics': [{'topic': 'SEO', 'keyword_count': 2, 'volume': 100}]})
+        sent = {}
+        
+        def fake_create(**kwargs):
+            sent.update(kwargs)
+            return iter([
+                fake_stream_chunk(text[:20]),
+                fake_stream_chunk(text[20:]),
+                fake_stream_chunk(finish_reason='stop'),
+                fake_stream_chunk(usage={'total_tokens': 42})
+            ])
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', fake_create)
+        progress = []
+        
+        result = service.analyze_keywords(
+            service.create_universe_prompt(sample_df), sample_df,
+            on_progress=progress.append, use_cache=False, num_tiers=3
+        )
+        
+        assert sent['stream'] is True
+        assert progress == [20, len(text)]
+        assert result['topics'][0]['avg_volume_per_keyword'] == 50
+        assert service.last_usage == {'total_tokens': 42}
+        assert service.last_finish_reason == 'stop'
+    
+    def test_structured_output_schema_follows_sections(self, service, sample_df, monkeypatch):
+        """gpt-4o recibe un json_schema estricto con solo las secciones pedidas"""
+        sent = {}
+        
+        def fake_create(**kwargs):
+            sent.update(kwargs)
+            return iter([fake_stream_chunk('{"summary": "ok", "topics": []}'), fake_stream_chunk(finish_reason='stop')])
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', fake_create)
+        
+        service.analyze_keywords(
+            service.create_universe_prompt(sample_df, include_gaps=False), sample_df, include_gaps=False
+        )
+        
+        response_format = sent['response_format']
+        schema = response_format['json_schema']['schema']
+        assert response_format['type'] == 'json_schema'
+        assert response_format['json_schema']['strict'] is True
+        assert schema['required'] == ['summary', 'topics', 'trends']
+        assert schema['properties']['topics']['items']['additionalProperties'] is False
+    
+    def test_older_models_use_json_object(self, sample_df, monkeypatch):
+        """Los modelos sin structured outputs siguen usando json_object"""
+        service = OpenAIService(api_key="sk-test", model="gpt-4-turbo")
+        sent = {}
+        
+        def fake_create(**kwargs):
+            sent.update(kwargs)
+            return iter([fake_stream_chunk('{"summary": "ok", "topics": []}'), fake_stream_chunk(finish_reason='stop')])
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', fake_create)
+        
+        service.analyze_keywords(service.create_universe_prompt(sample_df), sample_df, use_cache=False)
+        
+        assert sent['response_format'] == {"type": "json_object"}
+    
+    def test_json_surrounded_by_text(self, service, sample_df, monkeypatch):
+        """Se extrae el primer objeto balanceado aunque haya texto y llaves alrededor"""
+        text = 'Aquí está: {"summary": "usa {llaves}", "topics": []} Nota: {no es JSON}'
+        monkeypatch.setattr(
+            service.client.chat.completions, 'create',
+            lambda **kwargs: iter([fake_stream_chunk(text), fake_stream_chunk(finish_reason='stop')])
+        )
+        
+        result = service.analyze_keywords(service.create_universe_prompt(sample_df), sample_df)
+        
+        assert result['summary'] == 'usa {llaves}'
+    
+    def test_empty_stream_reports_finish_reason(self, service, sample_df, monkeypatch):
+        """Sin contenido el error incluye el motivo de parada"""
+        monkeypatch.setattr(
+            service.client.chat.completions, 'create',
+            lambda **kwargs: iter([fake_stream_chunk(finish_reason='content_filter')])
+        )
+        
+        with pytest.raises(Exception, match="content_filter"):
+            service.analyze_keywords(service.create_universe_prompt(sample_df), sample_df)
+    
+    def test_oversized_prompt_fails_before_request(self, service, sample_df, monkeypatch):
+        """Un prompt que no cabe en el contexto falla sin llamar a la API"""
+        calls = []
+        monkeypatch.setattr(service.client.chat.completions, 'create', lambda **kwargs: calls.append(kwargs))
+        messages = [{"role": "user", "content": "palabra " * (service.prompt_token_budget + 1)}]
+        
+        with pytest.raises(Exception, match="tokens"):
+            service.analyze_keywords(messages, sample_df, use_cache=False)
+        
+        assert calls == []
+    
+    def test_topics_delivered_as_they_complete(self, service, sample_df, monkeypatch):
+        """on_topic recibe cada topic en el fragmento en que se cierra su objeto"""
+        text = json.dumps({'summary': 'ok', 'topics': [
+            {'topic': 'SEO', 'keyword_count': 2, 'volume': 100},
+            {'topic': 'SEM', 'keyword_count': 1, 'volume': 50}
+        ]})
+        split = text.index('}') + 1
+        delivered = []
+        
+        def fake_create(**kwargs):
+            yield fake_stream_chunk(text[:split - 5])
+            yield fake_stream_chunk(text[split - 5:split])
+            assert [topic['topic'] for topic in delivered] == ['SEO']
+            yield fake_stream_chunk(text[split:])
+            yield fake_stream_chunk(finish_reason='stop')
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', fake_create)
+        
+        result = service.analyze_keywords(
+            service.create_universe_prompt(sample_df), sample_df, use_cache=False, on_topic=delivered.append
+        )
+        
+        assert [topic['topic'] for topic in delivered] == ['SEO', 'SEM']
+        assert len(result['topics']) == 2
+    
+    def test_truncated_response_keeps_complete_topics(self, service, sample_df, monkeypatch):
+        """Una respuesta cortada por max_tokens devuelve los topics completos sin cachearla"""
+        text = json.dumps({'summary': 'ok', 'topics': [
+            {'topic': 'SEO', 'keyword_count': 2, 'volume': 100},
+            {'topic': 'SEM', 'keyword_count': 1, 'volume': 50}
+        ]})
+        truncated = text[:text.rindex('SEM')]
+        calls = []
+        
+        def fake_create(**kwargs):
+            calls.append(kwargs)
+            return iter([fake_stream_chunk(truncated), fake_stream_chunk(finish_reason='length')])
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', fake_create)
+        messages = service.create_universe_prompt(sample_df)
+        
+        result = service.analyze_keywords(messages, sample_df)
+        service.analyze_keywords(messages, sample_df)
+        
+        assert result['truncated'] is True
+        assert result['summary'] == 'ok'
+        assert [topic['topic'] for topic in result['topics']] == ['SEO']
+        assert len(calls) == 2
+    
+    def test_repeated_analysis_uses_cache(self, service, sample_df, monkeypatch):
+        """Los mismos mensajes no vuelven a llamar a la API salvo con use_cache=False"""
+        text = json.dumps({'summary': 'ok', 'topics': []})
+        calls = []
+        
+        def fake_create(**kwargs):
+            calls.append(kwargs)
+            return iter([fake_stream_chunk(text), fake_stream_chunk(finish_reason='stop')])
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', fake_create)
+        messages = service.create_universe_prompt(sample_df)
+        
+        first = service.analyze_keywords(messages, sample_df)
+        first['summary'] = 'modificado'
+        second = service.analyze_keywords(messages, sample_df)
+        service.analyze_keywords(messages, sample_df, use_cache=False)
+        
+        assert len(calls) == 2
+        assert second['summary'] == 'ok'
+    
+    def test_semantic_cache_reuses_near_identical_analysis(self, service, sample_df, monkeypatch):
+        """Keywords reordenadas e instrucciones casi iguales no vuelven a llamar a la API"""
+        monkeypatch.setattr(
+            OpenAIService, 'semantic_cache',
+            SemanticCache(tau=0.95, embed=lambda text: [text.count(c) for c in 'abcdefghijklmnopqrstuvwxyz'])
+        )
+        calls = []
+        
+        def fake_create(**kwargs):
+            calls.append(kwargs)
+            return iter([fake_stream_chunk('{"summary": "ok", "topics": []}'), fake_stream_chunk(finish_reason='stop')])
+        
+        monkeypatch.setattr(service.client.chat.completions, 'create', fake_create)
+        params = {'custom_instructions': 'Enfócate en herramientas SEO'}
+        reordered = sample_df.iloc[::-1].reset_index(drop=True)
+        similar = {'custom_instructions': 'Enfócate en las herramientas SEO'}
+        
+        service.analyze_keywords(service.create_universe_prompt(sample_df, **params), sample_df, **params)
+        result = service.analyze_keywords(service.create_universe_prompt(reordered, **similar), reordered, **similar)
+        service.analyze_keywords(
+            service.create_universe_prompt(sample_df, num_tiers=4, **params), sample_df, num_tiers=4, **params
+        )
+        
+        assert result['summary'] == 'ok'
+        assert len(calls) == 2
+
+
+class TestEnrichResults:
+    
+    def test_normalizes_types_and_average(self, service, sample_df):
+        """Los campos numéricos se convierten a int y la media evita dividir por 0"""
+        result = {'topics': [
+            {'topic': 'A', 'keyword_count': '4', 'volume': 1000.0, 'tier': '2'},
+            {'topic': 'B', 'keyword_count': 0, 'volume': 500, 'traffic': 'n/a'},
+            'no es un topic'
+        ]}
+        
+        enriched = service._enrich_results(result, sample_df)
+        first, second = enriched['topics'][:2]
+        
+        assert first['keyword_count'] == 4 and isinstance(first['keyword_count'], int)
+        assert first['volume'] == 1000 and first['tier'] == 2 and first['traffic'] == 0
+        assert first['avg_volume_per_keyword'] == 250.0
+        assert second['avg_volume_per_keyword'] == 0
+        assert second['tier'] == 1 and second['traffic'] == 0
+
+
+class TestCompareWithClaude:
+    
+    def test_sends_top_topics_by_volume_without_verbose_fields(self, service, sample_df, monkeypatch):
+        """La validación recibe los topics de más volumen y solo sus campos esenciales"""
+        completions = FakeCompletions('{"validation": "ok", "agreement_score": 90}')
+        monkeypatch.setattr(service.client.chat, 'completions', completions)
+        topics = [
+            {
+                'topic': f'topic {i}', 'tier': 1, 'priority': 'high', 'volume': i * 100,
+                'keyword_count': 3, 'description': 'texto largo', 'example_keywords': ['a', 'b']
+            }
+            for i in range(30)
+        ]
+        
+        result = service.compare_with_claude({'topics': topics}, sample_df)
+        
+        assert result['agreement_score'] == 90
+        prompt = completions.calls[0]['messages'][1]['content']
+        assert '"topic 29"' in prompt and '"topic 10"' in prompt
+        assert '"topic 9"' not in prompt
+        assert 'example_keywords' not in prompt and 'texto largo' not in prompt
+
+
+class TestClientReuse:
+    
+    def test_same_key_shares_client(self):
+        """Instancias con la misma API key comparten el cliente de OpenAI"""
+        first = OpenAIService(api_key="sk-shared")
+        second = OpenAIService(api_key="sk-shared")
+        other = OpenAIService(api_key="sk-other")
+        
+        assert first.client is second.client
+        assert first.client is not other.client
+    
+    def test_keys_share_http_pool(self):
+        """Clientes de distintas API keys usan el mismo pool de conexiones"""
+        first = OpenAIService(api_key="sk-pool-a")
+        second = OpenAIService(api_key="sk-pool-b")
+        
+        assert first.client._client is second.client._client
+    
+    def test_client_retries_transient_errors(self):
+        """El cliente reintenta con backoff los errores transitorios"""
+        service = OpenAIService(api_key="sk-retries")
+        
+        assert service.client.max_retries == MAX_RETRIES
+    
+    def test_missing_key_fails_before_building_prompt(self):
+        """Sin API key falla al crear el servicio, antes de preparar ningún prompt"""
+        with pytest.raises(ValueError, match="API key"):
+            OpenAIService(api_key="")
+
+
+class FakeAsyncStream:
+    """Stream asíncrono de chunks"""
+    
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeAsyncClient:
+    """Cliente AsyncOpenAI que registra el solapamiento de las llamadas"""
+    
+    def __init__(self, analysis_text, comparison_text='{"agreement_score": 80}', fail_on=None):
+        self.analysis_text = analysis_text
+        self.comparison_text = comparison_text
+        self.fail_on = fail_on
+        self.events = []
+        self.chat = type('Chat', (), {'completions': self})()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        return False
+    
+    async def create(self, **kwargs):
+        kind = 'analysis' if kwargs.get('stream') else 'comparison'
+        self.events.append(('start', kind))
+        await asyncio.sleep(0.01)
+        self.events.append(('end', kind))
+        
+        if self.fail_on and self.fail_on in kwargs['messages'][1]['content']:
+            raise RuntimeError("fallo simulado")
+        if kind == 'comparison':
+            return fake_completion(self.comparison_text)
+        return FakeAsyncStream([fake_stream_chunk(self.analysis_text), fake_stream_chunk(finish_reason='stop')])
+
+
+class TestAsyncAnalysis:
+    
+    def test_analyze_and_compare_run_concurrently(self, service, sample_df, monkeypatch):
+        """El análisis y la comparación se lanzan a la vez con el mismo cliente"""
+        client = FakeAsyncClient('{"summary": "ok", "topics": []}')
+        monkeypatch.setattr(service, '_async_client', lambda: client)
+        
+        result, comparison = service.analyze_and_compare(
+            service.create_universe_prompt(sample_df), sample_df, {'topics': []}
+        )
+        
+        assert result['summary'] == 'ok'
+        assert comparison == {'agreement_score': 80}
+        assert [event for event, _ in client.events[:2]] == ['start', 'start']
+        assert service.last_finish_reason == 'stop'
+    
+    def test_analyze_many_keeps_order_and_errors(self, service, sample_df, monkeypatch):
+        """Cada análisis ocupa su posición; un fallo no cancela los demás"""
+        client = FakeAsyncClient('{"summary": "ok", "topics": []}', fail_on='Funnel de conversión')
+        monkeypatch.setattr(service, '_async_client', lambda: client)
+        requests = [
+            {'messages': service.create_universe_prompt(sample_df, analysis_type=analysis_type), 'df': sample_df}
+            for analysis_type in ("Temática (Topics)", "Funnel de conversión", "Intención de búsqueda")
+        ]
+        
+        results = service.analyze_many(requests)
+        
+        assert results[0]['summary'] == 'ok' and results[2]['summary'] == 'ok'
+        assert isinstance(results[1], Exception)
+        assert [event for event, _ in client.events[:3]] == ['start'] * 3
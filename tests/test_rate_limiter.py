@@ -0,0 +1,69 @@
+"""
+Tests unitarios para el limitador de peticiones
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from app.utils.rate_limiter import RateLimiter, estimate_tokens
+
+
+@pytest.fixture
+def limiter():
+    """Limitador con una ventana corta para no alargar los tests"""
+    return RateLimiter(rpm=2, tpm=100, window_seconds=0.2)
+
+
+class TestRateLimiter:
+    
+    def test_requests_within_limit_do_not_wait(self, limiter):
+        """Las peticiones que caben en la ventana pasan sin esperar"""
+        start = time.monotonic()
+        limiter.acquire(10)
+        limiter.acquire(10)
+        
+        assert time.monotonic() - start < 0.1
+    
+    def test_request_limit_waits_for_window(self, limiter):
+        """Superar las peticiones por ventana espera a que se libere un hueco"""
+        limiter.acquire()
+        limiter.acquire()
+        
+        start = time.monotonic()
+        limiter.acquire()
+        
+        assert time.monotonic() - start >= 0.15
+    
+    def test_token_limit_waits_for_window(self, limiter):
+        """Superar los tokens por ventana también espera"""
+        limiter.acquire(80)
+        
+        start = time.monotonic()
+        limiter.acquire(30)
+        
+        assert time.monotonic() - start >= 0.15
+    
+    def test_oversized_request_passes_on_empty_window(self, limiter):
+        """Una petición mayor que el límite no se bloquea indefinidamente"""
+        start = time.monotonic()
+        limiter.acquire(500)
+        
+        assert time.monotonic() - start < 0.1
+    
+    def test_async_acquire_shares_window(self, limiter):
+        """La versión asíncrona respeta la misma ventana"""
+        async def burst():
+            start = time.monotonic()
+            await asyncio.gather(*(limiter.acquire_async() for _ in range(3)))
+            return time.monotonic() - start
+        
+        assert asyncio.run(burst()) >= 0.15
+
+
+class TestEstimateTokens:
+    
+    def test_estimate_sums_texts(self):
+        """Se suman todos los textos e ignoran los vacíos"""
+        assert estimate_tokens('a' * 40, '', None, 'b' * 40) == 21